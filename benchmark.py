@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+"""
+Benchmarks for httpd.py.
+
+    python benchmark.py parser [-n 20000]
+    python benchmark.py headers [-n 20000]
+    python benchmark.py load [-n 2000] [-c 50] [-m events] [--save FILE]
+                             [--baseline FILE] [--tolerance 0.2]
+    python benchmark.py proxy [-n 2000] [-c 50]
+    python benchmark.py backend [-p 9000]
+
+`parser` compares the incremental RequestParser with the old
+read-in-24-byte-chunks-and-split path on a typical browser request.
+
+`headers` compares building a 200 head for a file the old way (a dict
+of every header, mimetypes.guess_type and a freshly formatted date per
+answer) with the pre-encoded templates and the once-a-second Date.
+
+`load` starts httpd.py on a free local port against this repository
+(so the httptest/ tree is served), drives every scenario with a pool of
+client threads and prints requests per second and latency percentiles
+as JSON. With --save the report becomes a baseline; with --baseline
+the run fails (exit code 1) if any scenario is slower than the baseline
+by more than the tolerance.
+
+`proxy` starts the stand-in backend and httpd.py with a --proxy route
+to it and compares proxied requests with and without the pool of
+persistent upstream connections. `backend` just runs the stand-in
+backend: keep-alive JSON answers, /chunked for a chunked body and
+/slow?seconds=N for timeouts.
+"""
+import json
+import mimetypes
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+
+import httpd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (method, path, keep-alive)
+SCENARIOS = {
+    'small': ('GET', '/', False),
+    'small-keepalive': ('GET', '/', True),
+    'large': ('GET', '/httptest/wikipedia_russia.html', False),
+    'large-keepalive': ('GET', '/httptest/wikipedia_russia.html', True),
+    'not-found': ('GET', '/httptest/no_such_file.html', False),
+    'not-found-keepalive': ('GET', '/httptest/no_such_file.html', True),
+    'head': ('HEAD', '/httptest/dir2/page.html', False),
+    'head-keepalive': ('HEAD', '/httptest/dir2/page.html', True),
+}
+
+REQUEST = (
+    b'GET /httptest/wikipedia_russia_files/load.css?debug=false HTTP/1.1\r\n'
+    b'Host: localhost:8080\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) '
+    b'Gecko/20100101 Firefox/115.0\r\n'
+    b'Accept: text/css,*/*;q=0.1\r\n'
+    b'Accept-Language: ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3\r\n'
+    b'Accept-Encoding: gzip, deflate, br\r\n'
+    b'Connection: keep-alive\r\n'
+    b'Referer: http://localhost:8080/httptest/wikipedia_russia.html\r\n'
+    b'Sec-Fetch-Dest: style\r\n'
+    b'Sec-Fetch-Mode: no-cors\r\n'
+    b'Sec-Fetch-Site: same-origin\r\n'
+    b'If-Modified-Since: Tue, 01 Feb 2022 13:18:29 GMT\r\n'
+    b'\r\n'
+)
+
+
+class FakeSocket:
+    """
+    Hands out a prepared byte string like a socket would.
+    """
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def recv(self, size: int) -> bytes:
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return bytes(chunk)
+
+    def recv_into(self, buf) -> int:
+        chunk = self.data[self.pos:self.pos + len(buf)]
+        buf[:len(chunk)] = chunk
+        self.pos += len(chunk)
+        return len(chunk)
+
+
+def legacy_read(client_socket, chunklen: int = 24):
+    """
+    The request reading path before RequestParser: MyServer.read_response
+    followed by get_request on the decoded head.
+    """
+    buf = b''
+    delim = b'\r\n\r\n'
+    while True:
+        r = client_socket.recv(chunklen)
+        buf += r
+        if delim in buf:
+            buf = buf.split(delim)[0]
+            break
+        elif not r:
+            raise OSError('Server closed connection')
+    return httpd.get_request(buf.decode('utf-8'))
+
+
+def incremental_read(client_socket):
+    parser = httpd.RequestParser()
+    while True:
+        request = parser.next_request()
+        if request is not None:
+            return request
+        if not parser.read_from(client_socket):
+            raise OSError('Server closed connection')
+
+
+def bench_parser(number: int) -> dict:
+    results = {'request_bytes': len(REQUEST), 'requests': number}
+    for name, read in (('legacy', legacy_read),
+                       ('incremental', incremental_read)):
+        started = time.perf_counter()
+        for _ in range(number):
+            read(FakeSocket(REQUEST))
+        elapsed = time.perf_counter() - started
+        results[name] = {'us_per_request': round(elapsed / number * 1e6, 2),
+                         'requests_per_sec': round(number / elapsed)}
+    results['speedup'] = round(results['legacy']['us_per_request'] /
+                               results['incremental']['us_per_request'], 2)
+    return results
+
+
+def legacy_head(file: str, length: int, keep_alive: bool) -> bytes:
+    """
+    make_answer's status line and make_heads before the templates.
+    """
+    dct = {h: '' for h in httpd.HTTPhelper.headers}
+    dct['Date'] = httpd.httpdate(datetime.now(timezone.utc))
+    dct['Server'] = httpd.HTTPhelper.servername
+    dct['Content-Length'] = length
+    dct['Content-Type'] = mimetypes.guess_type(file)[0] or 'text/plain'
+    dct['Connection'] = 'keep-alive' if keep_alive else 'close'
+    headers = '\r\n'.join(f'{h}: {v}' for h, v in dct.items() if v != '')
+    lead = f'{httpd.HTTPhelper.version} 200 OK'.encode('utf-8')
+    return b'\r\n'.join((lead, (headers + '\r\n').encode('utf-8'), b''))
+
+
+def template_head(file: str, length: int, keep_alive: bool) -> bytes:
+    return httpd.make_head(httpd.HTTPStatus.OK, length,
+                           httpd.content_type(file),
+                           'keep-alive' if keep_alive else 'close')
+
+
+def bench_headers(number: int) -> dict:
+    file = 'httptest/wikipedia_russia_files/load.css'
+    results = {'requests': number}
+    for name, build in (('legacy', legacy_head),
+                        ('template', template_head)):
+        started = time.perf_counter()
+        for _ in range(number):
+            build(file, 98620, True)
+        elapsed = time.perf_counter() - started
+        results[name] = {'us_per_answer': round(elapsed / number * 1e6, 2),
+                         'answers_per_sec': round(number / elapsed)}
+    results['speedup'] = round(results['legacy']['us_per_answer'] /
+                               results['template']['us_per_answer'], 2)
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, args: list) -> subprocess.Popen:
+    """
+    Run httpd.py in its own process, so the client threads do not share
+    a GIL with it, and wait until it accepts connections.
+    """
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'httpd.py'), '127.0.0.1',
+         '-p', str(port), '-r', ROOT, '-v', '40'] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError('httpd.py did not start')
+
+
+def read_answer(sock, buf: bytes, head_only: bool) -> tuple:
+    """
+    Read one answer framed by Content-Length. Returns its status,
+    whether the server is closing the connection and the bytes received
+    after the answer.
+    """
+    while b'\r\n\r\n' not in buf:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise OSError('connection closed')
+        buf += chunk
+    head, buf = buf.split(b'\r\n\r\n', 1)
+    lines = head.split(b'\r\n')
+    status = int(lines[0].split()[1])
+    length, closing = 0, False
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection':
+            closing = value.strip().lower() == b'close'
+    if head_only or status == 304:
+        length = 0
+    while len(buf) < length:
+        chunk = sock.recv(max(65536, length - len(buf)))
+        if not chunk:
+            raise OSError('connection closed')
+        buf += chunk
+    return status, closing, buf[length:]
+
+
+class Countdown:
+    """
+    Hands out request slots to client threads until `number` are taken.
+    """
+    def __init__(self, number: int):
+        self.left = number
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self.lock:
+            self.left -= 1
+            return self.left >= 0
+
+
+def client(port: int, scenario: tuple, countdown: Countdown,
+           latencies: list, errors: list):
+    method, path, keep_alive = scenario
+    connection = 'keep-alive' if keep_alive else 'close'
+    request = (f'{method} {path} HTTP/1.1\r\nHost: localhost\r\n'
+               f'Connection: {connection}\r\n\r\n').encode('ascii')
+    sock, buf = None, b''
+    while countdown.take():
+        started = time.perf_counter()
+        try:
+            if sock is None:
+                sock = socket.create_connection(('127.0.0.1', port),
+                                                timeout=30)
+                buf = b''
+            sock.sendall(request)
+            status, closing, buf = read_answer(sock, buf, method == 'HEAD')
+            if status >= 500:
+                raise OSError(f'status {status}')
+        except OSError as exc:
+            errors.append(str(exc))
+            if sock:
+                sock.close()
+            sock = None
+            continue
+        latencies.append(time.perf_counter() - started)
+        if closing:
+            sock.close()
+            sock = None
+    if sock:
+        sock.close()
+
+
+def percentile(values: list, fraction: float) -> float:
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_scenario(port: int, scenario: tuple, number: int,
+                 concurrency: int) -> dict:
+    countdown = Countdown(number)
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client,
+                                args=(port, scenario, countdown, latencies,
+                                      errors))
+               for _ in range(concurrency)]
+    started = time.perf_counter()
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ms = [round(value * 1000, 2) for value in latencies] or [0]
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'seconds': round(elapsed, 3),
+            'requests_per_sec': round(len(latencies) / elapsed, 1),
+            'latency_ms': {'p50': percentile(ms, 0.5),
+                           'p90': percentile(ms, 0.9),
+                           'p99': percentile(ms, 0.99),
+                           'max': ms[-1]}}
+
+
+def bench_load(opts) -> dict:
+    names = opts.scenarios.split(',') if opts.scenarios else list(SCENARIOS)
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise ValueError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+    args = ['-m', opts.mode, '-w', str(opts.workers),
+            '-n', str(opts.processes)]
+    port = free_port()
+    server = start_server(port, args)
+    try:
+        results = {name: run_scenario(port, SCENARIOS[name], opts.number,
+                                      opts.concurrency)
+                   for name in names}
+    finally:
+        server.terminate()
+        server.wait()
+    return {'config': {'mode': opts.mode, 'workers': opts.workers,
+                       'processes': opts.processes,
+                       'requests': opts.number,
+                       'concurrency': opts.concurrency},
+            'results': results}
+
+
+class Backend(BaseHTTPRequestHandler):
+    """
+    Stand-in application backend for proxy routes.
+    """
+    protocol_version = 'HTTP/1.1'  # persistent connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path.endswith('/slow'):
+            time.sleep(float(query.partition('=')[2] or 1))
+        body = json.dumps({
+            'path': self.path,
+            'host': self.headers.get('Host'),
+            'forwarded_for': self.headers.get('X-Forwarded-For')}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if path.endswith('/chunked'):
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            if self.command == 'GET':
+                for part in (body[:10], body[10:]):
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+                self.wfile.write(b'0\r\n\r\n')
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def start_backend(port: int) -> subprocess.Popen:
+    backend = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'backend',
+         '-p', str(port)])
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return backend
+        except OSError:
+            time.sleep(0.05)
+    backend.kill()
+    raise RuntimeError('backend did not start')
+
+
+def bench_proxy(opts) -> dict:
+    """
+    Proxied keep-alive requests with a new upstream connection per
+    request (--proxy-pool 0) and with pooled ones.
+    """
+    backend_port = free_port()
+    backend = start_backend(backend_port)
+    results = {}
+    try:
+        for name, pool in (('no-pool', 0), ('pool', 32)):
+            port = free_port()
+            server = start_server(port, [
+                '-m', 'threads', '-w', str(opts.concurrency),
+                '--proxy-pool', str(pool),
+                '--proxy', f'/api/=http://127.0.0.1:{backend_port}'])
+            try:
+                results[name] = run_scenario(
+                    port, ('GET', '/api/items', True), opts.number,
+                    opts.concurrency)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        backend.terminate()
+        backend.wait()
+    results['speedup'] = round(results['pool']['requests_per_sec'] /
+                               results['no-pool']['requests_per_sec'], 2)
+    return results
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Regressions of the report against the baseline: lower throughput,
+    higher p99 latency or new errors beyond the tolerance.
+    """
+    regressions = []
+    for name, result in report['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        if result['requests_per_sec'] < \
+                base['requests_per_sec'] * (1 - tolerance):
+            regressions.append(
+                f'{name}: {result["requests_per_sec"]} req/s, '
+                f'baseline {base["requests_per_sec"]}')
+        if result['latency_ms']['p99'] > \
+                base['latency_ms']['p99'] * (1 + tolerance):
+            regressions.append(
+                f'{name}: p99 {result["latency_ms"]["p99"]} ms, '
+                f'baseline {base["latency_ms"]["p99"]}')
+        if result['errors'] > base['errors']:
+            regressions.append(f'{name}: {result["errors"]} errors, '
+                               f'baseline {base["errors"]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage='%prog parser|headers|load|proxy|backend '
+                            '[options]')
+    op.add_option("-n", "--number", action="store", type=int, default=None,
+                  help='requests (per scenario for load)')
+    op.add_option("-c", "--concurrency", action="store", type=int,
+                  default=50)
+    op.add_option("-m", "--mode", action="store", default='events')
+    op.add_option("-w", "--workers", action="store", type=int, default=3)
+    op.add_option("-P", "--processes", action="store", type=int, default=1)
+    op.add_option("-s", "--scenarios", action="store", default='',
+                  help=f'comma separated, from: {", ".join(SCENARIOS)}')
+    op.add_option("--save", action="store", default=None,
+                  help='write the report to this baseline file')
+    op.add_option("--baseline", action="store", default=None,
+                  help='fail on regressions against this baseline file')
+    op.add_option("--tolerance", action="store", type=float, default=0.2)
+    op.add_option("-p", "--port", action="store", type=int, default=9000,
+                  help='port of the stand-in backend')
+    (opts, args) = op.parse_args()
+    if args[:1] == ['parser']:
+        print(json.dumps(bench_parser(opts.number or 20000), indent=2))
+    elif args[:1] == ['headers']:
+        print(json.dumps(bench_headers(opts.number or 20000), indent=2))
+    elif args[:1] == ['proxy']:
+        opts.number = opts.number or 2000
+        print(json.dumps(bench_proxy(opts), indent=2))
+    elif args[:1] == ['backend']:
+        ThreadingHTTPServer.request_queue_size = 128
+        ThreadingHTTPServer(('127.0.0.1', opts.port), Backend).serve_forever()
+    elif args[:1] == ['load']:
+        opts.number = opts.number or 2000
+        report = bench_load(opts)
+        print(json.dumps(report, indent=2))
+        if opts.save:
+            with open(opts.save, 'w') as f:
+                json.dump(report, f, indent=2)
+        if opts.baseline:
+            with open(opts.baseline) as f:
+                regressions = compare(report, json.load(f), opts.tolerance)
+            for regression in regressions:
+                print(f'REGRESSION {regression}', file=sys.stderr)
+            sys.exit(1 if regressions else 0)
+    else:
+        op.error('choose a benchmark: parser, headers, load or proxy')
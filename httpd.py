@@ -1,121 +1,2078 @@
+import errno
+import glob
+import gzip
+import heapq
+import html
+import ipaddress
+import itertools
 import logging
 import mimetypes
+import mmap
 import os
+import re
+import selectors
+import signal
 import socket
+import ssl
+import stat as stat_mode
+import subprocess
+import sys
+import tempfile
 import threading
+import time
 import uuid
-from collections import namedtuple
-from datetime import datetime
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from http import HTTPStatus
 from optparse import OptionParser
 from pathlib import Path
-from queue import Queue
+from queue import Empty, Full, Queue
 from typing import NamedTuple
-from urllib.parse import unquote
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always there
+    brotli = None
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:  # HTTP/2 is optional
+    h2 = None
 
 
 class HTTPhelper:
-    version = 'HTTP/1.0'
+    version = 'HTTP/1.1'
     servername = 'OTUServer by AlexK'
     headers = ['Date', 'Server', 'Content-Length', 'Content-Type',
-               'Connection']
+               'Content-Encoding', 'Content-Range', 'Accept-Ranges', 'Vary',
+               'Last-Modified', 'ETag', 'Cache-Control', 'Retry-After',
+               'Transfer-Encoding', 'Connection']
+    connection_headers = {value: f'Connection: {value}\r\n\r\n'.encode(
+        'ascii') for value in ('close', 'keep-alive', 'Upgrade')}
+    templates = {}  # (status, content type) -> pre-encoded head start
+    # headers of one connection, never passed on by the proxy
+    hop_by_hop = ('connection', 'keep-alive', 'proxy-connection', 'te',
+                  'trailer', 'transfer-encoding', 'upgrade')
+    mimetypes.init()
+    mime_types = dict(mimetypes.types_map)
+    max_ranges = 16
+    # content codings by preference, with their precompressed suffixes
+    encodings = {'br': '.br', 'gzip': '.gz'}
+    compressible = ('text/', 'application/javascript',
+                    'application/x-javascript', 'application/json',
+                    'application/xml', 'application/xhtml+xml',
+                    'image/svg+xml')
+    compress_min_size = 256  # bigger files up to the cache's limit too
+    # `address` is percent-decoded, `target` the request target as sent
     request = namedtuple(
-        'Request', ['method', 'address', 'version', 'query_string'],
-        defaults=(None,))
+        'Request',
+        ['method', 'address', 'version', 'query_string', 'headers',
+         'target'],
+        defaults=(None, None, None))
+    # `data` goes out first as is, then `length` bytes of `file` starting
+    # at `offset` are streamed from the disk without reading them in.
+    # `more` holds further (data, offset, length) segments of the same
+    # file, used by multipart range answers. `stream` is an iterator of
+    # body chunks produced while sending (directory listings), sent
+    # after everything else.
+    answer = namedtuple(
+        'Answer', ['data', 'file', 'offset', 'length', 'more', 'stream'],
+        defaults=(None, 0, 0, (), None))
+
+
+def status_head(code: HTTPStatus, ctype: str = '') -> bytes:
+    """
+    Pre-encoded status line, Server and Content-Type: the part of the
+    head that only depends on the status and the content type.
+    """
+    head = HTTPhelper.templates.get((code, ctype))
+    if head is None:
+        head = (f'{HTTPhelper.version} {code.value} {code.phrase}\r\n'
+                f'Server: {HTTPhelper.servername}\r\n')
+        if ctype:
+            head += f'Content-Type: {ctype}\r\n'
+        head = HTTPhelper.templates[(code, ctype)] = head.encode('utf-8')
+    return head
+
+
+def date_header() -> bytes:
+    """
+    Pre-encoded Date header, formatted at most once per second.
+    """
+    global _date_header
+    second, header = _date_header
+    now = int(time.time())
+    if second != now:
+        date = httpdate(datetime.fromtimestamp(now, timezone.utc))
+        header = f'Date: {date}\r\n'.encode('ascii')
+        _date_header = (now, header)
+    return header
+
+
+_date_header = (0, b'')
+
+
+def make_head(code: HTTPStatus, length: int or str = '', ctype: str = '',
+              connection: str = 'close', extra: dict or None = None) -> bytes:
+    """
+    Status line and headers up to the empty line that ends them.
+    `extra` holds other headers from HTTPhelper.headers, empty values
+    are left out. A content type that varies per answer (multipart
+    boundaries) goes into `extra` so it does not become a template.
+    """
+    parts = [status_head(code, ctype), date_header()]
+    if length != '':
+        parts.append(b'Content-Length: %d\r\n' % length)
+    if extra:
+        parts.append(''.join(f'{h}: {v}\r\n' for h, v in extra.items()
+                             if v != '').encode('utf-8'))
+    parts.append(HTTPhelper.connection_headers[connection])
+    return b''.join(parts)
+
+
+def content_type(file: Path) -> str:
+    """
+    MIME type by the file suffix from a table built at import, with
+    mimetypes as the fallback for unusual names (upper case, .tar.gz).
+    """
+    ctype = HTTPhelper.mime_types.get(os.path.splitext(file)[1])
+    if ctype is None:
+        ctype = mimetypes.guess_type(file)[0] or 'text/plain'
+    return ctype
+
+
+def make_answer(code: HTTPStatus, file: Path or None = None,
+                method: str or None = None,
+                keep_alive: bool = False,
+                extra: dict or None = None,
+                size: int or None = None) -> NamedTuple:
+    """
+    Cook HTTP-answer with provided args. File contents are not read
+    here: a GET answer refers to the file for the sender to stream.
+    """
+    connection = 'keep-alive' if keep_alive else 'close'
+    if not code == 200 or not file:
+        # 304 describes the cached body, so it has no length of its own
+        length = '' if code == HTTPStatus.NOT_MODIFIED else 0
+        return HTTPhelper.answer(make_head(code, length,
+                                           connection=connection,
+                                           extra=extra))
+    length = os.path.getsize(file) if size is None else size
+    extra = dict(extra or {})
+    ctype = extra.pop('Content-Type', None) or content_type(file)
+    data = make_head(code, length, ctype, connection, extra)
+    if method == 'GET':
+        return HTTPhelper.answer(data, file, 0, length)
+    elif method == 'HEAD':  # only headers without content
+        return HTTPhelper.answer(data)
+
+
+def answer_size(answer) -> int:
+    """
+    Bytes of an answer, headers included, without its stream.
+    """
+    return len(answer.data) + answer.length + sum(
+        len(data) + length for data, _, length in answer.more)
+
+
+def make_body_answer(body: bytes, ctype: str,
+                     code: HTTPStatus = HTTPStatus.OK,
+                     method: str = 'GET', keep_alive: bool = False,
+                     extra: dict or None = None) -> NamedTuple:
+    """
+    Answer with a body generated in memory rather than read from a file.
+    """
+    connection = 'keep-alive' if keep_alive else 'close'
+    head = make_head(code, len(body), ctype, connection, extra)
+    return HTTPhelper.answer(head + (body if method != 'HEAD' else b''))
+
+
+def make_stream_answer(chunks, ctype: str, method: str = 'GET',
+                       keep_alive: bool = False, chunked: bool = True,
+                       extra: dict or None = None) -> NamedTuple:
+    """
+    Answer with a body of unknown length, sent chunk by chunk as the
+    iterator makes it. HTTP/1.0 clients get it delimited by the close.
+    """
+    extra = dict(extra or {})
+    if chunked:
+        extra['Transfer-Encoding'] = 'chunked'
+    else:
+        keep_alive = False
+    connection = 'keep-alive' if keep_alive else 'close'
+    head = make_head(HTTPStatus.OK, ctype=ctype, connection=connection,
+                     extra=extra)
+    if method == 'HEAD':
+        return HTTPhelper.answer(head)
+    return HTTPhelper.answer(
+        head, stream=chunk_frames(chunks) if chunked else iter(chunks))
+
+
+def chunk_frames(chunks):
+    """
+    Chunked transfer coding of the byte strings, with the last chunk.
+    """
+    for chunk in chunks:
+        if chunk:
+            yield b'%x\r\n%s\r\n' % (len(chunk), chunk)
+    yield b'0\r\n\r\n'
+
+
+def make_range_answer(file: Path, size: int, ranges: list,
+                      keep_alive: bool = False,
+                      extra: dict or None = None) -> NamedTuple:
+    """
+    206 answer for the given (start, end) byte ranges of the file: a plain
+    slice for one range, multipart/byteranges for several.
+    """
+    code = HTTPStatus.PARTIAL_CONTENT
+    connection = 'keep-alive' if keep_alive else 'close'
+    extra = dict(extra or {})
+    ctype = extra.pop('Content-Type', None) or content_type(file)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        extra['Content-Range'] = f'bytes {start}-{end}/{size}'
+        head = make_head(code, end - start + 1, ctype, connection, extra)
+        return HTTPhelper.answer(head, file, start, end - start + 1)
+    boundary = uuid.uuid4().hex
+    segments = []
+    for start, end in ranges:
+        part = (f'--{boundary}\r\n'
+                f'Content-Type: {ctype}\r\n'
+                f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n')
+        if segments:  # CRLF ending the previous part's body
+            part = '\r\n' + part
+        segments.append([part.encode('utf-8'), start, end - start + 1])
+    segments.append([f'\r\n--{boundary}--\r\n'.encode('utf-8'), 0, 0])
+    extra['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+    head = make_head(code, sum(len(d) + n for d, _, n in segments),
+                     connection=connection, extra=extra)
+    segments[0][0] = head + segments[0][0]
+    data, offset, length = segments[0]
+    return HTTPhelper.answer(data, file, offset, length,
+                             tuple(tuple(seg) for seg in segments[1:]))
+
+
+class MethodNotAllowed(ValueError):
+    pass
+
+
+class HeadersTooLarge(ValueError):
+    pass
+
+
+def get_request(arg: str) -> NamedTuple or None:
+    lines = arg.split('\r\n')
+    splitted_first_string = lines[0].split()
+    if len(splitted_first_string) != 3:
+        raise ValueError('Bad request')
+    method = splitted_first_string[0]
+    if method not in ('GET', 'HEAD'):
+        raise MethodNotAllowed(f'Unsupported method {method}')
+    # the query stays encoded, a proxied request passes it on as is
+    address, _, query_string = splitted_first_string[1].partition('?')
+    address = unquote(address)
+    version = splitted_first_string[2]
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(':')
+        if not colon:
+            raise ValueError(f'Bad header line {line}')
+        headers[name.strip().lower()] = value.strip()
+    return HTTPhelper.request(method, address, version,
+                              query_string or None, headers,
+                              splitted_first_string[1])
+
+
+class RequestParser:
+    """
+    Incremental request-head parser for one connection. Received bytes
+    go into a growing bytearray through a reusable chunk buffer; only
+    the bytes that arrived since the last call are scanned for the end
+    of the head, and whatever follows a complete head (a body to skip,
+    pipelined requests) stays buffered for the next call.
+    """
+    max_size = 8192
+    max_headers = 100
+
+    def __init__(self, chunk_size: int = 4096):
+        self.buf = bytearray()
+        self.chunk = bytearray(chunk_size)
+        self.view = memoryview(self.chunk)
+        self.scanned = 0  # bytes of buf known not to hold the delimiter
+        self.skip = 0  # body bytes of the previous request to drop
+        self.upgrade = None  # request switching the connection to h2c
+
+    def read_from(self, sock) -> int:
+        """
+        Append one recv() worth of bytes; 0 means the peer closed.
+        """
+        n = sock.recv_into(self.chunk)
+        self.buf += self.view[:n]
+        return n
+
+    def feed(self, data: bytes):
+        self.buf += data
+
+    @property
+    def empty(self) -> bool:
+        return not self.buf
+
+    def next_request(self) -> NamedTuple or None:
+        """
+        Parsed Request if a complete head is buffered, None if more bytes
+        are needed. Raises ValueError on malformed heads, its
+        MethodNotAllowed subclass for methods other than GET and HEAD and
+        HeadersTooLarge when a head exceeds the limits.
+        """
+        if self.skip:
+            dropped = min(self.skip, len(self.buf))
+            del self.buf[:dropped]
+            self.skip -= dropped
+            if self.skip:
+                return
+        end = self.buf.find(b'\r\n\r\n', max(self.scanned - 3, 0))
+        if end < 0:
+            self.scanned = len(self.buf)
+            if self.scanned > self.max_size:
+                raise HeadersTooLarge('Request head too large')
+            return
+        if end > self.max_size:
+            raise HeadersTooLarge('Request head too large')
+        head = bytes(self.buf[:end])
+        del self.buf[:end + 4]
+        self.scanned = 0
+        if head.count(b'\r\n') > self.max_headers:
+            raise HeadersTooLarge('Too many request headers')
+        logging.debug(f'Received {head}')
+        request = get_request(head.decode('utf-8'))
+        length = request.headers.get('content-length', '0')
+        if not length.isdigit():
+            raise ValueError(f'Bad Content-Length {length}')
+        if 'transfer-encoding' in request.headers:
+            raise ValueError('Request bodies are not supported')
+        self.skip = int(length)
+        return request
+
+
+def make_etag(stat: os.stat_result, encoding: str or None = None) -> str:
+    """
+    Strong validator built from inode, mtime and size: changes whenever
+    the file is replaced or modified, and costs no reading. Every content
+    coding of a file is a representation with its own tag.
+    """
+    suffix = f'-{encoding}' if encoding else ''
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}{suffix}"'
+
+
+def is_compressible(ctype: str) -> bool:
+    return ctype.startswith(HTTPhelper.compressible)
+
+
+def accepted_encodings(header: str) -> list:
+    """
+    Content codings from Accept-Encoding that we can produce, most
+    preferred first (by q-value, then by HTTPhelper.encodings order).
+    """
+    weights = {}
+    for item in header.lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip()] = q
+    order = list(HTTPhelper.encodings)
+    found = [c for c in order if weights.get(c, weights.get('*', 0)) > 0]
+    return sorted(found, key=lambda c: (-weights.get(c, weights.get('*')),
+                                        order.index(c)))
+
+
+def compress(data: bytes, encoding: str, best: bool = False) -> bytes:
+    """
+    Fast settings for on-the-fly compression, the best ones for
+    precompressing.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else 5)
+    return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+
+
+def precompress(root: str) -> int:
+    """
+    Write .gz (and .br, with brotli installed) siblings next to every
+    compressible file under root that is not up to date yet, keeping
+    only those that are smaller than the original. Returns the number
+    of files written.
+    """
+    written = 0
+    suffixes = tuple(HTTPhelper.encodings.values())
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name.endswith(suffixes) or not is_compressible(
+                    content_type(Path(name))):
+                continue
+            stat = os.stat(path)
+            if stat.st_size < HTTPhelper.compress_min_size:
+                continue
+            data = None
+            for encoding, suffix in HTTPhelper.encodings.items():
+                if encoding == 'br' and brotli is None:
+                    continue
+                target = path + suffix
+                if (os.path.exists(target) and
+                        os.stat(target).st_mtime_ns >= stat.st_mtime_ns):
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                packed = compress(data, encoding, best=True)
+                if len(packed) >= len(data):
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(packed)
+                logging.info(f'Precompressed {target}')
+                written += 1
+    return written
+
+
+def read_manifest(path: str) -> list:
+    """
+    Preload manifest: one URL path or glob under the root a line
+    (`/httptest/*.css`, `/static/**/*.js`), `#` starts a comment.
+    """
+    patterns = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                patterns.append(line)
+    return patterns
+
+
+def top_paths(log: str, top: int = 1000) -> list:
+    """
+    The `top` URL paths most often answered with 200, 206 or 304 to GET
+    and HEAD requests in a common or combined access log, as patterns
+    for the preload manifest.
+    """
+    request = re.compile(r'"(?:GET|HEAD) (.+?) HTTP/[\d.]+" (?:200|206|304) ')
+    counts = Counter()
+    with open(log, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = request.search(line)
+            if match:  # logged percent-encoded, as requested
+                counts[unquote(match.group(1).partition('?')[0])] += 1
+    return [glob.escape(path) for path, _ in counts.most_common(top)]
+
+
+def readahead(path: str or Path) -> int:
+    """
+    Have the kernel read a file into the page cache in the background
+    (posix_fadvise WILLNEED). Returns the file size.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+        return size
+    finally:
+        os.close(fd)
+
+
+def listen_address(spec: str, port: int = 8080) -> tuple:
+    """
+    (family, address) to bind for a listener spec: PORT, HOST:PORT,
+    [IPV6]:PORT, a bare host (on `port`) or unix:PATH.
+    """
+    if spec.startswith('unix:'):
+        return socket.AF_UNIX, spec[5:]
+    host = spec
+    if spec.isdigit():
+        host, port = '', int(spec)
+    elif spec.startswith('['):
+        host, _, rest = spec[1:].partition(']')
+        if rest:
+            port = int(rest[1:]) if rest.startswith(':') else None
+            if port is None:
+                raise ValueError(f'Bad listen address {spec}')
+    elif spec.count(':') == 1:
+        host, port = spec.split(':')
+        port = int(port)
+    if not host:
+        return socket.AF_INET, ('', port)
+    family, _, _, _, address = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    return family, address
+
+
+def address_name(sock) -> str:
+    address = sock.getsockname()
+    if sock.family == socket.AF_UNIX:
+        return f'unix:{address}'
+    if sock.family == socket.AF_INET6:
+        return f'[{address[0]}]:{address[1]}'
+    return f'{address[0]}:{address[1]}'
+
+
+def remove_stale_socket(path: str):
+    """
+    Unlink a Unix socket file left behind by a server that is gone.
+    """
+    try:
+        if not stat_mode.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def nodelay(sock):
+    """
+    Send small writes at once instead of waiting for the peer's ACK.
+    """
+    if sock.family != socket.AF_UNIX:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def make_tls_context(cert: str, key: str) -> ssl.SSLContext:
+    """
+    Server-side TLS context: TLS 1.2 and newer, HTTP/1.1 by ALPN and
+    session tickets for cheap resumption. The ticket keys live in the
+    context, so pre-forked children resume each other's sessions. Kernel
+    TLS offload is asked for where Python and OpenSSL support it.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    context.set_alpn_protocols(['http/1.1'])
+    context.options &= ~ssl.OP_NO_TICKET
+    context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+    return context
+
+
+def make_self_signed(cert: str, key: str, host: str = 'localhost'):
+    """
+    Write a self-signed P-256 certificate and key for local testing with
+    the openssl command line tool.
+    """
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'ec',
+         '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+         '-days', '365', '-subj', f'/CN={host}',
+         '-addext', f'subjectAltName=DNS:{host},IP:127.0.0.1',
+         '-keyout', key, '-out', cert],
+        check=True, capture_output=True)
+
+
+def uses_ktls(sock) -> bool:
+    """
+    Whether the kernel encrypts what is sent on this TLS socket, so that
+    sendfile can be used on it (Python 3.12+ with OP_ENABLE_KTLS).
+    """
+    sslobj = getattr(sock, '_sslobj', None)
+    uses = getattr(sslobj, 'uses_ktls_for_send', None)
+    return bool(uses and uses())
+
+
+def count_handshake(metrics, sock, started: float):
+    if metrics:
+        metrics.observe('otus_stage_seconds', time.perf_counter() - started,
+                        'stage="handshake"')
+        resumed = 'true' if sock.session_reused else 'false'
+        metrics.inc('otus_tls_handshakes_total', labels=f'resumed="{resumed}"')
+
+
+def observe_stage(metrics, timings, stage: str, seconds: float):
+    """
+    Account a request handling stage in the metrics histogram and in
+    the request's own timings, if it is traced for the slow request log.
+    """
+    if metrics:
+        metrics.observe('otus_stage_seconds', seconds, f'stage="{stage}"')
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def not_modified(request, stat: os.stat_result, etag: str) -> bool:
+    """
+    Evaluate If-None-Match (which wins when present) and
+    If-Modified-Since against the file's current validators.
+    """
+    headers = request.headers or {}
+    if 'if-none-match' in headers:
+        tags = [t.strip() for t in headers['if-none-match'].split(',')]
+        # weak comparison, as RFC 7232 asks for If-None-Match
+        return '*' in tags or etag in [t.removeprefix('W/') for t in tags]
+    if 'if-modified-since' in headers:
+        try:
+            since = parsedate_to_datetime(headers['if-modified-since'])
+        except (TypeError, ValueError):
+            return False
+        return int(stat.st_mtime) <= since.timestamp()
+    return False
+
+
+def parse_ranges(header: str, size: int) -> list or None:
+    """
+    Parse a `Range: bytes=...` header into sorted, merged inclusive
+    (start, end) pairs. Returns None if the header should be ignored
+    (other unit, bad syntax, too many ranges) and an empty list if no
+    range is satisfiable.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash or not (first.isdigit() or last.isdigit()):
+            return
+        if first and last and not (first.isdigit() and last.isdigit()):
+            return
+        if not first:  # suffix range: the last N bytes
+            if int(last) == 0 or size == 0:
+                continue
+            ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > HTTPhelper.max_ranges:
+        return
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(request, etag: str, last_modified: str) -> bool:
+    """
+    If-Range takes an entity tag (strong comparison) or an HTTP-date
+    (exact match); Range is only honoured when it matches.
+    """
+    value = (request.headers or {}).get('if-range')
+    if value is None:
+        return True
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag
+    return value == last_modified
+
+
+def remove_dot_segments(path: str) -> str:
+    """
+    Resolve `.` and `..` segments of a decoded absolute path (RFC 3986,
+    5.2.4), never above the root, so a URL prefix check on the result
+    holds for what is served or forwarded.
+    """
+    parts = path.split('/')
+    segments = []
+    for segment in parts[1:]:
+        if segment == '..':
+            if segments:
+                segments.pop()
+        elif segment != '.':
+            segments.append(segment)
+    if parts[-1] in ('.', '..'):
+        segments.append('')  # a directory, keep the trailing slash
+    return '/' + '/'.join(segments)
+
+
+def wants_keep_alive(request) -> bool:
+    """
+    HTTP/1.1 connections are persistent unless the client asks to close
+    them, HTTP/1.0 ones only if the client asks to keep them open.
+    """
+    connection = (request.headers or {}).get('connection', '').lower()
+    if request.version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+def httpdate(dt: datetime) -> str:
+    """
+    Return a string representation of a date according to RFC 1123
+    (HTTP/1.1). `dt` must be in UTC; the current date for the Date
+    header comes from date_header().
+    """
+    weekday = ["Mon", "Tue", "Wed", "Thu",
+               "Fri", "Sat", "Sun"][dt.weekday()]
+    month = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul",
+             "Aug", "Sep", "Oct", "Nov", "Dec"][dt.month - 1]
+    string = "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+        weekday, dt.day, month,
+        dt.year, dt.hour, dt.minute, dt.second
+    )
+    return string
+
+
+def entry_stat(entry: os.DirEntry) -> os.stat_result or None:
+    try:
+        return entry.stat()
+    except OSError:  # dangling symlink or removed meanwhile
+        return None
+
+
+def list_directory(directory: Path, url: str, query: str or None = None,
+                   page_size: int = 1000, max_sorted_pages: int = 10):
+    """
+    HTML listing of one page of the directory, produced in chunks while
+    os.scandir goes through it. `query` picks the page, sort=name|size|
+    mtime|none and order=asc|desc. Sorted pages keep only the entries up
+    to the end of the page, so they go up to `max_sorted_pages` (a
+    deeper page number gets the last of them); sort=none keeps one chunk
+    at a time and has no limit.
+    """
+    params = parse_qs(query or '')
+    sort = params.get('sort', ['name'])[0]
+    if sort not in ('name', 'size', 'mtime', 'none'):
+        sort = 'name'
+    reverse = params.get('order', ['asc'])[0] == 'desc'
+    page = params.get('page', ['1'])[0]
+    page = max(int(page), 1) if page.isdigit() else 1
+    if sort != 'none':  # the entries up to the page's end are held
+        page = min(page, max_sorted_pages)
+    start = (page - 1) * page_size
+    title = html.escape(url)
+    links = []
+    for column, label in (('name', 'Name'), ('mtime', 'Last modified'),
+                          ('size', 'Size')):
+        order = 'desc' if column == sort and not reverse else 'asc'
+        links.append(f'<th><a href="?sort={column}&amp;order={order}">'
+                     f'{label}</a></th>')
+    yield (f'<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+           f'<title>Index of {title}</title></head>\n'
+           f'<body><h1>Index of {title}</h1>\n<table>\n'
+           f'<tr>{"".join(links)}</tr>\n'
+           f'<tr><td><a href="../">../</a></td><td></td><td>-</td></tr>\n'
+           ).encode('utf-8')
+    total = None
+    with os.scandir(directory) as entries:
+        if sort == 'none':
+            page_entries = itertools.islice(entries, start, start + page_size)
+        else:
+            if sort == 'name':
+                def key(entry):
+                    return entry.name
+            else:
+                field = 'st_size' if sort == 'size' else 'st_mtime'
+
+                def key(entry):
+                    stat = entry_stat(entry)
+                    return getattr(stat, field, 0), entry.name
+
+            def counting(iterator):
+                nonlocal total
+                total = 0
+                for entry in iterator:
+                    total += 1
+                    yield entry
+            pick = heapq.nlargest if reverse else heapq.nsmallest
+            page_entries = pick(start + page_size, counting(entries),
+                                key=key)[start:]
+        rows = []
+        shown = 0
+        for entry in page_entries:
+            shown += 1
+            stat = entry_stat(entry)
+            is_dir = entry.is_dir()
+            name = entry.name + ('/' if is_dir else '')
+            href = quote(name, errors='surrogateescape')
+            modified = time.strftime(
+                '%Y-%m-%d %H:%M', time.gmtime(stat.st_mtime)) if stat else ''
+            size = '-' if is_dir or stat is None else stat.st_size
+            rows.append(f'<tr><td><a href="{href}">{html.escape(name)}</a>'
+                        f'</td><td>{modified}</td><td>{size}</td></tr>\n')
+            if len(rows) == 100:
+                yield ''.join(rows).encode('utf-8', 'replace')
+                rows = []
+        if rows:
+            yield ''.join(rows).encode('utf-8', 'replace')
+        more = (start + shown < total if total is not None
+                else shown == page_size and next(entries, None) is not None)
+    nav = []
+    order = 'desc' if reverse else 'asc'
+    if page > 1:
+        nav.append(f'<a href="?sort={sort}&amp;order={order}&amp;'
+                   f'page={page - 1}">previous</a>')
+    if more and sort != 'none' and page == max_sorted_pages:
+        nav.append('<a href="?sort=none">unsorted, all entries</a>')
+    elif more:
+        nav.append(f'<a href="?sort={sort}&amp;order={order}&amp;'
+                   f'page={page + 1}">next</a>')
+    counts = f' of {total}' if total is not None else ''
+    yield (f'</table>\n<p>Entries {start + 1 if shown else 0}-'
+           f'{start + shown}{counts} {" ".join(nav)}</p>\n'
+           f'</body></html>\n').encode('utf-8')
+
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache of small static files. Keeps the body and the
+    serialized headers that do not change between answers (everything
+    but Date and Connection), keyed by resolved path. An entry is only
+    used while the file's mtime and size match the ones it was read at.
+    """
+    entry = namedtuple('CacheEntry', ['mtime', 'size', 'headers', 'body'])
+
+    def __init__(self, max_bytes: int, max_file_size: int = 256 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str, stat: os.stat_result) -> NamedTuple or None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None or entry.mtime != stat.st_mtime_ns
+                    or entry.size != stat.st_size):
+                self.misses += 1
+                return
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, stat: os.stat_result, headers: bytes,
+            body: bytes) -> NamedTuple:
+        entry = ResponseCache.entry(stat.st_mtime_ns, stat.st_size,
+                                    headers, body)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total_bytes -= len(old.headers) + len(old.body)
+            self.entries[key] = entry
+            self.total_bytes += len(headers) + len(body)
+            while self.total_bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.total_bytes -= len(old.headers) + len(old.body)
+                self.evictions += 1
+        return entry
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class PathCache:
+    """
+    URL path -> (resolved file, stat) memo, so repeated requests skip
+    resolve() and stat() until the entry is `ttl` seconds old. `file` is
+    None for paths escaping the root and `stat` is None for missing
+    files, so 403 and 404 answers are cached too. Bounded LRU.
+    """
+    entry = namedtuple('PathEntry', ['file', 'stat', 'expires'])
+
+    def __init__(self, ttl: float = 1.0, max_entries: int = 4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, address: str) -> NamedTuple or None:
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry is None:
+                return
+            if entry.expires < time.monotonic():
+                del self.entries[address]
+                return
+            self.entries.move_to_end(address)
+            return entry
+
+    def put(self, address: str, file: Path or None,
+            stat: os.stat_result or None):
+        entry = PathCache.entry(file, stat, time.monotonic() + self.ttl)
+        with self.lock:
+            self.entries[address] = entry
+            self.entries.move_to_end(address)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class MmapCache:
+    """
+    Read-only mappings of large files, shared by all workers and
+    connections. Answers carry memoryview slices of a mapping instead of
+    a file to open, so a hot file is opened and mapped once and ranges
+    are just slices. A mapping is dropped when the file's mtime or size
+    changes or on LRU eviction; the kernel unmaps it as soon as the last
+    answer still sending from it is gone.
+    """
+    entry = namedtuple('MmapEntry', ['mtime', 'size', 'map'])
+
+    def __init__(self, max_bytes: int, min_file_size: int = 1 << 20):
+        self.max_bytes = max_bytes
+        self.min_file_size = min_file_size
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, file: Path, stat: os.stat_result) -> memoryview or None:
+        key = str(file)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and (entry.mtime, entry.size) == (stat.st_mtime_ns,
+                                                       stat.st_size):
+                self.entries.move_to_end(key)
+                return memoryview(entry.map)
+            if entry:
+                self.drop(key)
+        if not self.min_file_size <= stat.st_size <= self.max_bytes:
+            return
+        try:
+            with open(file, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as exc:
+            logging.error(f'Cannot map {file}: {exc}')
+            return
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = MmapCache.entry(stat.st_mtime_ns,
+                                                len(mapping), mapping)
+            self.total_bytes += len(mapping)
+            while self.total_bytes > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+        return memoryview(mapping)
+
+    def drop(self, key: str):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.size
+        try:
+            entry.map.close()
+        except BufferError:  # still being sent, unmapped when released
+            pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'files': len(self.entries), 'bytes': self.total_bytes}
+
+
+class ClientLimits:
+    """
+    Fair share per client: caps on the connections open from one address
+    and from its subnet (/24 for IPv4, /64 for IPv6), and token buckets
+    for the requests and the answer bytes of one address. Bytes are
+    charged after an answer, so a big file is let through and the debt
+    paid off before the next request. Addresses and subnets share one
+    bounded LRU table of small lists; an entry with no connections and
+    full buckets means nothing and is dropped when met. Evicting an entry
+    with open connections forgets them, so a flood of new addresses
+    makes the limits lenient rather than strict. Unix socket clients
+    are not limited.
+    """
+    def __init__(self, max_conns: int = 0, max_subnet_conns: int = 0,
+                 rate: float = 0.0, burst: int = 20, bandwidth: int = 0,
+                 max_entries: int = 1 << 16):
+        self.max_conns = max_conns
+        self.max_subnet_conns = max_subnet_conns
+        self.rate = rate  # requests per second, 0 for no limit
+        self.burst = max(burst, 1)
+        self.bandwidth = bandwidth  # bytes per second, 0 for no limit
+        self.max_entries = max_entries
+        # key -> [connections, request tokens, byte tokens, last refill]
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def client(addr) -> str or None:
+        return addr[0] if isinstance(addr, tuple) else None
+
+    @staticmethod
+    def subnet(ip: str) -> str:
+        if ':' in ip:
+            return str(ipaddress.IPv6Network(f'{ip}/64', strict=False))
+        return ip.rpartition('.')[0] + '.0/24'
+
+    def entry(self, key: str, now: float) -> list:
+        """
+        The key's entry with its buckets refilled up to now. Called with
+        the lock held.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [0, self.burst, self.bandwidth, now]
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return entry
+        self.entries.move_to_end(key)
+        elapsed = now - entry[3]
+        entry[1] = min(self.burst, entry[1] + elapsed * self.rate)
+        entry[2] = min(self.bandwidth, entry[2] + elapsed * self.bandwidth)
+        entry[3] = now
+        return entry
+
+    def forget(self, key: str, entry: list):
+        if (not entry[0] and entry[1] >= self.burst
+                and entry[2] >= self.bandwidth):
+            del self.entries[key]
+
+    def connect(self, addr) -> bool:
+        """
+        Count a new connection, False if it is one too many.
+        """
+        ip = self.client(addr)
+        if ip is None or not (self.max_conns or self.max_subnet_conns):
+            return True
+        now = time.monotonic()
+        with self.lock:
+            own = self.entry(ip, now)
+            net = self.entry(self.subnet(ip), now)
+            if ((self.max_conns and own[0] >= self.max_conns) or
+                    (self.max_subnet_conns
+                     and net[0] >= self.max_subnet_conns)):
+                return False
+            own[0] += 1
+            net[0] += 1
+        return True
+
+    def disconnect(self, addr):
+        ip = self.client(addr)
+        if ip is None or not (self.max_conns or self.max_subnet_conns):
+            return
+        now = time.monotonic()
+        with self.lock:
+            for key in (ip, self.subnet(ip)):
+                entry = self.entry(key, now)
+                entry[0] = max(entry[0] - 1, 0)
+                self.forget(key, entry)
+
+    def allow(self, addr) -> float:
+        """
+        Take a request token: 0 if there is one, otherwise the seconds
+        until the client may try again.
+        """
+        ip = self.client(addr)
+        if ip is None or not (self.rate or self.bandwidth):
+            return 0.0
+        with self.lock:
+            entry = self.entry(ip, time.monotonic())
+            wait = 0.0
+            if self.rate and entry[1] < 1:
+                wait = (1 - entry[1]) / self.rate
+            if self.bandwidth and entry[2] < 0:
+                wait = max(wait, -entry[2] / self.bandwidth)
+            if not wait and self.rate:
+                entry[1] -= 1
+            return wait
+
+    def charge(self, addr, size: int):
+        ip = self.client(addr)
+        if ip is None or not self.bandwidth:
+            return
+        with self.lock:
+            entry = self.entry(ip, time.monotonic())
+            entry[2] -= size
+            self.forget(ip, entry)
+
+
+class Metrics:
+    """
+    Counters and fixed-bucket histograms for the Prometheus text format.
+    Label sets are passed pre-formatted (e.g. 'stage="read"') so an
+    update is a dict lookup and an add under one uncontended lock.
+    """
+    buckets = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    help = {
+        'otus_connections_accepted_total':
+            ('counter', 'Accepted client connections.'),
+        'otus_responses_total': ('counter', 'Answers by status code.'),
+        'otus_response_bytes_total':
+            ('counter', 'Bytes of answers, headers included.'),
+        'otus_queue_wait_seconds':
+            ('histogram', 'Time accepted sockets wait for a worker.'),
+        'otus_stage_seconds':
+            ('histogram', 'Time spent per request handling stage.'),
+        'otus_queue_depth': ('gauge', 'Sockets waiting for a worker.'),
+        'otus_workers': ('gauge', 'Threads in the worker pool.'),
+        'otus_busy_workers': ('gauge', 'Workers serving a connection.'),
+        'otus_connections_shed_total':
+            ('counter', 'Connections answered 503 on a full queue.'),
+        'otus_open_connections':
+            ('gauge', 'Connections held by the event loop.'),
+        'otus_cache_hits_total': ('counter', 'Response cache hits.'),
+        'otus_cache_misses_total': ('counter', 'Response cache misses.'),
+        'otus_cache_evictions_total':
+            ('counter', 'Entries evicted from the response cache.'),
+        'otus_cache_bytes': ('gauge', 'Bytes held by the response cache.'),
+        'otus_cache_entries': ('gauge', 'Entries in the response cache.'),
+        'otus_tls_handshakes_total':
+            ('counter', 'Completed TLS handshakes, by session resumption.'),
+        'otus_mmap_bytes': ('gauge', 'Bytes of files mapped in memory.'),
+        'otus_mmap_files': ('gauge', 'Files mapped in memory.'),
+        'otus_access_log_dropped_total':
+            ('counter', 'Access log lines dropped on a full buffer.'),
+        'otus_upstream_requests_total':
+            ('counter', 'Proxied requests, by upstream connection reuse.'),
+        'otus_warm': ('gauge', '1 once the preload warm-up is done.'),
+        'otus_limited_total':
+            ('counter', 'Connections and requests over a client limit.'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value: int = 1, labels: str = ''):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, labels: str = ''):
+        key = (name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            hist[bisect_left(self.buckets, seconds)] += 1
+            hist[-1] += seconds
+
+    def count_answer(self, answer):
+        size = answer_size(answer)
+        code = answer.data[9:12].decode('ascii')
+        with self.lock:
+            key = ('otus_responses_total', f'code="{code}"')
+            self.counters[key] = self.counters.get(key, 0) + 1
+            key = ('otus_response_bytes_total', '')
+            self.counters[key] = self.counters.get(key, 0) + size
+
+    def render(self, gauges: dict or None = None,
+               totals: dict or None = None) -> bytes:
+        """
+        All metrics in the Prometheus text exposition format. `gauges`
+        and `totals` (counters kept elsewhere) map names to current
+        values sampled by the caller.
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v))
+                                for k, v in self.histograms.items())
+        typed = set()
+
+        def header(name, kind):
+            if name in typed:
+                return
+            typed.add(name)
+            lines.append(f'# HELP {name} '
+                         f'{self.help.get(name, (kind, name))[1]}')
+            lines.append(f'# TYPE {name} {kind}')
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{{{labels}}} {value}' if labels
+                         else f'{name} {value}')
+        for (name, labels), hist in histograms:
+            header(name, 'histogram')
+            prefix = f'{labels},' if labels else ''
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), hist[:-1]):
+                total += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {total}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}_sum{suffix} {hist[-1]:.6f}')
+            lines.append(f'{name}_count{suffix} {total}')
+        for name, value in sorted((totals or {}).items()):
+            header(name, 'counter')
+            lines.append(f'{name} {value}')
+        for name, value in sorted((gauges or {}).items()):
+            header(name, 'gauge')
+            lines.append(f'{name} {value}')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class Timings(dict):
+    """
+    Seconds per handling stage of one request, from its complete head to
+    the last byte of its answer, for the slow request log. `request` and
+    `code` are filled in once it is answered.
+    """
+    request = None
+    code = '-'
+
+
+class Profiler(threading.Thread):
+    """
+    Wall-clock sampling profiler of the running server: every `interval`
+    seconds the stacks of all other threads are taken from
+    sys._current_frames() and counted. The result is written in the
+    collapsed stack format of flamegraph.pl and speedscope, one
+    `thread;file:function;... count` line per distinct stack. Nothing
+    runs unless a profile was asked for.
+    """
+    def __init__(self, path: str, seconds: float = 10.0,
+                 interval: float = 0.01):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.seconds = seconds
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + self.seconds
+        while (not self.stopped.wait(self.interval)
+               and time.monotonic() < deadline):
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:'
+                                 f'{code.co_name}')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        logging.info(f'Profile of {samples} samples written to {self.path}')
+
+    def stop(self):
+        self.stopped.set()
+
+
+class AccessLog(threading.Thread):
+    """
+    Access log in the Common or Combined Log Format, written off the
+    request path. Serving threads only append a tuple to a bounded ring
+    buffer; this thread formats whatever has piled up and writes it with
+    one append per batch. When the buffer is full new lines are dropped
+    and counted, or with `block` the serving thread waits for room.
+    """
+    formats = ('common', 'combined')
+    unsafe = re.compile(r'[\x00-\x1f\x7f"\\]')
+
+    def __init__(self, path: str, fmt: str = 'combined',
+                 capacity: int = 8192, block: bool = False,
+                 flush_interval: float = 1.0, batch: int = 256):
+        threading.Thread.__init__(self, daemon=True)
+        if fmt not in AccessLog.formats:
+            raise ValueError(f'Unknown access log format {fmt}')
+        self.path = path
+        self.combined = fmt == 'combined'
+        self.capacity = capacity
+        self.block = block
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self.buffer = deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.file = None
+        self.__reopen = False
+        self.__shutdown_request = False
+
+    def log(self, addr, request, answer):
+        """
+        Queue one line. Formatting and I/O happen in the writer thread.
+        """
+        head_end = answer.data.find(b'\r\n\r\n') + 4
+        size = len(answer.data) - head_end + answer.length + sum(
+            len(data) + length for data, _, length in answer.more)
+        record = (addr[0] if isinstance(addr, tuple) else '-', time.time(),
+                  request, answer.data[9:12].decode('ascii'), size)
+        with self.cond:
+            if len(self.buffer) >= self.capacity:
+                if not self.block:
+                    self.dropped += 1
+                    return
+                self.cond.wait_for(
+                    lambda: len(self.buffer) < self.capacity
+                    or self.__shutdown_request)
+            self.buffer.append(record)
+            if len(self.buffer) >= self.batch:
+                self.cond.notify_all()
+
+    @staticmethod
+    def escape(value: str) -> str:
+        """
+        Escape control characters, `"` and `\\` as \\xHH like nginx
+        does, so no field can end a quoted string or the line.
+        """
+        return AccessLog.unsafe.sub(
+            lambda match: f'\\x{ord(match.group()):02X}', value)
+
+    def format(self, record) -> str:
+        """
+        One log line. The request target is logged as it arrived, still
+        percent-encoded, and every client-supplied field is escaped.
+        """
+        host, stamp, request, code, size = record
+        when = time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(stamp))
+        line = f'{host} - - [{when}] '
+        if request is None:
+            line += '"-"'
+        else:
+            target = request.target
+            if target is None:  # made up by the server, e.g. warm-up
+                query = request.query_string
+                target = quote(request.address) + (f'?{query}' if query
+                                                   else '')
+            line += '"' + self.escape(
+                f'{request.method} {target} {request.version}') + '"'
+        line += f' {code} {size or "-"}'
+        if self.combined:
+            headers = request.headers if request else {}
+            referer = self.escape(headers.get('referer', '-'))
+            agent = self.escape(headers.get('user-agent', '-'))
+            line += f' "{referer}" "{agent}"'
+        return line + '\n'
+
+    def reopen(self, *args):
+        """
+        Reopen the file before the next write, e.g. after logrotate moved
+        it away. Only sets a flag, so it is safe in a signal handler.
+        """
+        self.__reopen = True
+
+    def run(self):
+        self.file = open(self.path, 'ab', buffering=0)
+        while True:
+            with self.cond:
+                self.cond.wait_for(
+                    lambda: len(self.buffer) >= self.batch
+                    or self.__shutdown_request, self.flush_interval)
+                records = list(self.buffer)
+                self.buffer.clear()
+                self.cond.notify_all()
+                stop = self.__shutdown_request
+            if self.__reopen:
+                self.__reopen = False
+                self.file.close()
+                self.file = open(self.path, 'ab', buffering=0)
+            if records:
+                try:
+                    self.file.write(''.join(
+                        map(self.format, records)).encode('utf-8'))
+                except OSError as exc:
+                    logging.error(f'Cannot write access log: {exc}')
+            if stop:
+                break
+        self.file.close()
+
+    def close(self):
+        with self.cond:
+            self.__shutdown_request = True
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join()
+
+
+class UpstreamReader:
+    """
+    Buffered reads of an upstream answer from a blocking socket with a
+    read timeout.
+    """
+    max_head = 65536
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+
+    def fill(self, size: int = 65536) -> bytes:
+        chunk = self.sock.recv(size)
+        if not chunk:
+            raise ConnectionError('Upstream closed the connection')
+        return chunk
+
+    def line(self) -> bytes:
+        while True:
+            end = self.buf.find(b'\r\n')
+            if end >= 0:
+                line = bytes(self.buf[:end])
+                del self.buf[:end + 2]
+                return line
+            if len(self.buf) > self.max_head:
+                raise ValueError('Upstream head too large')
+            self.buf += self.fill()
+
+    def read(self, size: int) -> bytes:
+        """
+        Up to `size` bytes, at least one.
+        """
+        if not self.buf:
+            return self.fill(min(size, 65536))
+        chunk = bytes(self.buf[:size])
+        del self.buf[:size]
+        return chunk
+
+    def head(self) -> tuple:
+        """
+        (version, status, reason, [(name, value)]) of the next answer,
+        skipping 1xx interim answers.
+        """
+        while True:
+            version, _, rest = self.line().decode('latin-1').partition(' ')
+            status, _, reason = rest.partition(' ')
+            if not version.startswith('HTTP/') or not status.isdigit():
+                raise ValueError(f'Bad upstream status line {version}')
+            headers = []
+            while True:
+                line = self.line()
+                if not line:
+                    break
+                name, colon, value = line.decode('latin-1').partition(':')
+                if not colon:
+                    raise ValueError(f'Bad upstream header line {line}')
+                headers.append((name.strip(), value.strip()))
+            if not 100 <= int(status) < 200:
+                return version, int(status), reason, headers
+
+    def body(self, length: int or None, chunked: bool):
+        """
+        Body chunks: `length` bytes, the chunked coding decoded, or all
+        bytes up to the close when neither is given.
+        """
+        if chunked:
+            while True:
+                size = int(self.line().split(b';')[0], 16)
+                if not size:
+                    while self.line():  # trailers
+                        pass
+                    return
+                while size:
+                    chunk = self.read(size)
+                    size -= len(chunk)
+                    yield chunk
+                if self.line():
+                    raise ValueError('Bad upstream chunk')
+        elif length is None:
+            if self.buf:
+                yield bytes(self.buf)
+                self.buf.clear()
+            while True:
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    return
+                yield chunk
+        else:
+            while length:
+                chunk = self.read(length)
+                length -= len(chunk)
+                yield chunk
+
+
+class Upstream:
+    """
+    One backend of a proxy route: a pool of idle persistent connections
+    and its health. After `max_fails` failures in a row the backend is
+    skipped for `fail_timeout` seconds.
+    """
+    def __init__(self, url: str, connect_timeout: float = 1.0,
+                 read_timeout: float = 30.0, max_idle: int = 32,
+                 idle_timeout: float = 4.0, max_fails: int = 1,
+                 fail_timeout: float = 10.0):
+        parts = urlsplit(url)
+        if parts.scheme != 'http' or not parts.hostname:
+            raise ValueError(f'Unsupported upstream {url}')
+        self.name = parts.netloc
+        self.address = (parts.hostname, parts.port or 80)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        # below the usual keep-alive timeout of backends, so that a pooled
+        # connection is rarely closed by the other side while idle
+        self.idle_timeout = idle_timeout
+        self.max_fails = max_fails
+        self.fail_timeout = fail_timeout
+        self.idle = deque()  # (socket, released at), most recent last
+        self.fails = 0
+        self.down_until = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return self.down_until <= time.monotonic()
+
+    def acquire(self) -> tuple:
+        """
+        (socket, reused): the most recently used idle connection that is
+        still fresh, otherwise a new one.
+        """
+        stale = []
+        with self.lock:
+            if self.idle:
+                sock, released = self.idle.pop()
+                if released > time.monotonic() - self.idle_timeout:
+                    return sock, True
+                # the older ones are staler still
+                stale = [sock] + [old for old, _ in self.idle]
+                self.idle.clear()
+        for sock in stale:
+            sock.close()
+        sock = socket.create_connection(self.address,
+                                        timeout=self.connect_timeout)
+        nodelay(sock)
+        sock.settimeout(self.read_timeout)
+        return sock, False
+
+    def release(self, sock):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def succeeded(self):
+        self.fails = 0
+
+    def failed(self, exc: Exception):
+        with self.lock:
+            self.fails += 1
+            if self.fails < self.max_fails:
+                return
+            self.fails = 0
+            self.down_until = time.monotonic() + self.fail_timeout
+        logging.warning(f'Upstream {self.name} failed: {exc}, skipping it '
+                        f'for {self.fail_timeout} seconds')
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for sock, _ in idle:
+            sock.close()
+
+
+class SelectorThread(threading.Thread):
+    """
+    One non-blocking selector loop for sockets that other threads hand
+    over with add(). A socket is kept with its state and a deadline
+    `timeout` seconds away: begin() is called when it arrives, step()
+    when its registered events fire and expire() once the deadline
+    passed. Subclasses end with a socket by forget() or drop().
+    """
+    def __init__(self, timeout: float):
+        threading.Thread.__init__(self, daemon=True)
+        self.timeout = timeout
+        self.selector = selectors.DefaultSelector()
+        self.incoming = deque()
+        self.pending = {}  # socket -> [state, deadline]
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.__shutdown_request = False
+
+    def add(self, sock, state=None):
+        """
+        Called from another thread with a non-blocking socket; closed
+        at once if the loop is stopping.
+        """
+        if self.__shutdown_request:
+            sock.close()
+            return
+        self.incoming.append((sock, state))
+        try:
+            self.waker.send(b'\0')
+        except BlockingIOError:  # a wakeup is already pending
+            pass
+
+    def run(self):
+        while not self.__shutdown_request:
+            for key, _ in self.selector.select(timeout=0.5):
+                if key.fileobj is not self.wakeup:
+                    self.step(key.fileobj)
+                    continue
+                try:
+                    self.wakeup.recv(4096)
+                except BlockingIOError:
+                    pass
+                while self.incoming:
+                    sock, state = self.incoming.popleft()
+                    self.pending[sock] = [state,
+                                          time.monotonic() + self.timeout]
+                    self.begin(sock)
+            now = time.monotonic()
+            for sock, (_, deadline) in list(self.pending.items()):
+                if deadline < now:
+                    self.expire(sock)
+        for sock in list(self.pending):
+            self.drop(sock)
+        self.selector.close()
+
+    def begin(self, sock):
+        self.step(sock)
+
+    def step(self, sock):
+        raise NotImplementedError
+
+    def expire(self, sock):
+        self.drop(sock)
+
+    def watch(self, sock, events: int):
+        try:
+            self.selector.modify(sock, events)
+        except KeyError:
+            self.selector.register(sock, events)
+
+    def forget(self, sock):
+        """
+        Stop watching the socket and return its state.
+        """
+        try:
+            self.selector.unregister(sock)
+        except KeyError:
+            pass
+        return self.pending.pop(sock)[0]
+
+    def drop(self, sock):
+        state = self.forget(sock)
+        sock.close()
+        return state
 
+    def stop(self):
+        """
+        End the loop and close the sockets it holds, without waiting.
+        """
+        self.__shutdown_request = True
+        try:
+            self.waker.send(b'\0')
+        except OSError:
+            pass
+
+    def close(self):
+        self.stop()
+        if self.is_alive():
+            self.join(timeout=1.0)
 
-def make_heads(**kwargs) -> str:
+
+class Handshaker(SelectorThread):
     """
-    kwargs expected:
-    * length - len(<content>)
-    * type - Path('file.suff').suffix()
+    Completes TLS handshakes for the threads mode, so slow or silent
+    clients do not hold a worker thread. Sockets that finished the
+    handshake go to `dispatch`.
     """
-    dct = {h: '' for h in HTTPhelper.headers}
-    dct['Date'] = httpdate()
-    dct['Server'] = HTTPhelper.servername
-    dct['Content-Length'] = kwargs.get('length', '')
-    file = kwargs.get('file')
-    if file:
-        dct['Content-Type'] = mimetypes.guess_type(
-            kwargs.get('file'))[0] or 'text/plain'
-    dct['Connection'] = 'close'
-    result_string = '\r\n'.join([f'{h}: {v}' for h, v in dct.items() if v])
-    result_string += '\r\n'
-    return bytes(result_string.encode('utf-8'))
+    def __init__(self, dispatch, timeout: float,
+                 metrics: Metrics or None = None, on_drop=None):
+        SelectorThread.__init__(self, timeout)
+        self.dispatch = dispatch
+        self.on_drop = on_drop  # called with the addr of a failed socket
+        self.metrics = metrics
 
+    def add(self, sock: ssl.SSLSocket, addr):
+        SelectorThread.add(self, sock, (addr, time.perf_counter()))
 
-def make_answer(code: HTTPStatus, file: Path or None = None,
-                method: str or None = None) -> bytes:
+    def step(self, sock: ssl.SSLSocket):
+        try:
+            sock.do_handshake()
+        except ssl.SSLWantReadError:
+            return self.watch(sock, selectors.EVENT_READ)
+        except ssl.SSLWantWriteError:
+            return self.watch(sock, selectors.EVENT_WRITE)
+        except OSError as exc:
+            logging.debug(f'TLS handshake failed: {exc}')
+            self.drop(sock)
+            return
+        addr, started = self.forget(sock)
+        count_handshake(self.metrics, sock, started)
+        self.dispatch(sock, addr)
+
+    def expire(self, sock):
+        logging.debug(f'TLS handshake with {self.pending[sock][0][0]} '
+                      f'timed out')
+        self.drop(sock)
+
+    def drop(self, sock):
+        addr, _ = SelectorThread.drop(self, sock)
+        if self.on_drop:
+            self.on_drop(addr)
+
+
+class Lingerer(SelectorThread):
     """
-    Cook HTTP-answer with provided args.
+    Lingering close of refused connections: the rest of the answer is
+    sent, the write side shut down and the client's request bytes read
+    and dropped until it closes or `timeout` passes. Closing with unread
+    input makes the kernel reset the connection, and the client could
+    lose the answer. At most `max_sockets` linger, more are closed at
+    once.
     """
-    string = f'{HTTPhelper.version} {code.value} {code.phrase}'
-    lead = bytes(string.encode('utf-8'))
-    if not code == 200 or not file:
-        headers = make_heads()
-        return b'\r\n'.join((lead, headers))
-    length = os.path.getsize(file)
-    headers = make_heads(length=length, file=file)
-    if method == 'GET':
-        with open(file, 'rb') as f:
-            bytes_read = f.read()
-        return b'\r\n'.join((lead, headers, bytes_read))
-    elif method == 'HEAD':  # only headers without content
-        headers += b'\r\n'
-        return b'\r\n'.join((lead, headers))
+    def __init__(self, timeout: float = 1.0, max_sockets: int = 1024):
+        SelectorThread.__init__(self, timeout)
+        self.max_sockets = max_sockets
+
+    def add(self, sock, data: bytes = b''):
+        """
+        The socket and the part of the answer that is not sent yet.
+        """
+        if len(self.pending) + len(self.incoming) >= self.max_sockets:
+            sock.close()
+            return
+        SelectorThread.add(self, sock, data)
 
+    def begin(self, sock):
+        self.selector.register(sock, selectors.EVENT_WRITE)
+        self.step(sock)
 
-def get_request(arg: str) -> NamedTuple or None:
-    splitted_first_string = arg.split('\r\n')[0].split()
-    if len(splitted_first_string) != 3:
-        raise ValueError('Bad request')
-    method = splitted_first_string[0]
-    if method not in ('GET', 'HEAD'):
-        raise ValueError(f'Ansupported method {method}')
-    address = unquote(splitted_first_string[1])
-    version = splitted_first_string[2]
-    if '?' in address:
-        address, query_string = address.split('?')
-        return HTTPhelper.request(method, address, version, query_string)
-    return HTTPhelper.request(method, address, version)
+    def step(self, sock):
+        entry = self.pending[sock]
+        try:
+            if entry[0]:
+                entry[0] = entry[0][sock.send(entry[0]):]
+                if entry[0]:
+                    return
+            if self.selector.get_key(sock).events != selectors.EVENT_READ:
+                sock.shutdown(socket.SHUT_WR)
+                self.selector.modify(sock, selectors.EVENT_READ)
+            while sock.recv(65536):
+                pass
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            pass
+        self.drop(sock)  # the client closed, or reset the connection
 
 
-def httpdate(dt: datetime = datetime.now()) -> str:
+class Idler(SelectorThread):
     """
-    Return a string representation of a date according to RFC 1123
-    (HTTP/1.1)
+    Holds the idle keep-alive connections of the threads mode instead of
+    a worker blocked in recv(): a connection is handed to `resume` as
+    soon as its next request arrives and closed after `timeout` seconds
+    of silence.
     """
-    weekday = ["Mon", "Tue", "Wed", "Thu",
-               "Fri", "Sat", "Sun"][dt.weekday()]
-    month = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul",
-             "Aug", "Sep", "Oct", "Nov", "Dec"][dt.month - 1]
-    string = "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
-        weekday, dt.day, month,
-        dt.year, dt.hour, dt.minute, dt.second
-    )
-    return string
+    def __init__(self, resume, timeout: float, on_drop=None):
+        SelectorThread.__init__(self, timeout)
+        self.resume = resume  # called with the socket, addr and served
+        self.on_drop = on_drop  # called with the addr of a closed socket
+
+    def add(self, sock, addr, served: int):
+        SelectorThread.add(self, sock, (addr, served))
+
+    def begin(self, sock):
+        self.watch(sock, selectors.EVENT_READ)
+
+    def step(self, sock):
+        addr, served = self.forget(sock)
+        self.resume(sock, addr, served)
+
+    def drop(self, sock):
+        addr, _ = SelectorThread.drop(self, sock)
+        if self.on_drop:
+            self.on_drop(addr)
+
+
+class H2Body:
+    """
+    What is left of an answer's body for HTTP/2 DATA frames: the bytes
+    after the head, file regions read with pread, then stream chunks.
+    """
+    def __init__(self, answer, start: int):
+        self.parts = deque()  # bytes, or (offset, length) of the file
+        segments = ((answer.data[start:], answer.offset, answer.length),) \
+            + tuple(answer.more)
+        for data, offset, length in segments:
+            if data:
+                self.parts.append(memoryview(data))
+            if length:
+                self.parts.append((offset, length))
+        self.file = open(answer.file, 'rb') \
+            if answer.file and any(isinstance(part, tuple)
+                                   for part in self.parts) else None
+        self.stream = answer.stream
+        self.pending = b''  # rest of a stream chunk
+
+    @property
+    def empty(self) -> bool:
+        return not self.parts and self.stream is None
+
+    def read(self, size: int) -> bytes:
+        """
+        Up to `size` bytes, b'' at the end of the body.
+        """
+        if self.parts:
+            part = self.parts[0]
+            if isinstance(part, tuple):
+                offset, length = part
+                chunk = os.pread(self.file.fileno(), min(size, length), offset)
+                if not chunk:
+                    raise OSError(f'{self.file.name} changed while sending')
+                if len(chunk) == length:
+                    self.parts.popleft()
+                else:
+                    self.parts[0] = (offset + len(chunk), length - len(chunk))
+                return chunk
+            chunk = part[:size]
+            if len(chunk) == len(part):
+                self.parts.popleft()
+            else:
+                self.parts[0] = part[size:]
+            return bytes(chunk)
+        if self.stream is None:
+            return b''
+        chunk = self.pending or next(self.stream, None)
+        if chunk is None:
+            self.stream = None
+            return b''
+        self.pending = chunk[size:]
+        return chunk[:size]
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        if self.stream:
+            self.stream.close()
+
+
+class H2Session:
+    """
+    HTTP/2 side of one connection on top of the h2 state machine, with
+    no I/O of its own: the serving loop feeds it received bytes and
+    sends what pump() returns. Requests are answered by `handler` as
+    soon as their headers arrive; the bodies of all open streams are
+    interleaved frame by frame within the flow control windows.
+    """
+    preface = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+    def __init__(self, handler):
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(
+            client_side=False, header_encoding='utf-8'))
+        self.handler = handler  # Request -> Answer
+        self.bodies = OrderedDict()  # stream id -> H2Body being sent
+        self.closed = False  # by an error or the client
+        self.going_away = False  # GOAWAY sent, finishing open streams
+        self.settled = True  # the client's SETTINGS have arrived
+
+    @staticmethod
+    def detect(buf) -> bool or None:
+        """
+        Whether the buffered connection start is the HTTP/2 preface of a
+        client with prior knowledge, None while too short to tell.
+        """
+        if buf[:len(H2Session.preface)] != \
+                H2Session.preface[:len(buf)]:
+            return False
+        return True if len(buf) >= len(H2Session.preface) else None
+
+    @staticmethod
+    def upgrade_wanted(request) -> bool:
+        headers = request.headers or {}
+        return (request.version == 'HTTP/1.1'
+                and headers.get('upgrade', '').lower() == 'h2c'
+                and 'http2-settings' in headers)
+
+    def start(self, upgrade=None):
+        """
+        Send the server preface. After an h2c upgrade the request that
+        asked for it is answered as stream 1, its body held back until the
+        client's preface: some clients cannot buffer a window's worth of
+        frames right behind the 101.
+        """
+        if upgrade is None:
+            self.conn.initiate_connection()
+            return
+        self.conn.initiate_upgrade_connection(
+            upgrade.headers['http2-settings'])
+        self.settled = False
+        self.answer(1, upgrade._replace(version='HTTP/2'))
+
+    def feed(self, data: bytes):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError as exc:
+            logging.debug(f'HTTP/2 protocol error: {exc}')
+            self.closed = True  # GOAWAY is queued for pump()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.request(event.stream_id, event.headers)
+            elif isinstance(event, h2.events.DataReceived):
+                self.conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamReset):
+                body = self.bodies.pop(event.stream_id, None)
+                if body:
+                    body.close()
+            elif isinstance(event, h2.events.RemoteSettingsChanged):
+                self.settled = True
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.closed = True
+
+    def request(self, stream_id: int, headers: list):
+        fields = dict(headers)
+        method = fields.pop(':method', '')
+        path = fields.pop(':path', '/')
+        authority = fields.pop(':authority', None)
+        fields.pop(':scheme', None)
+        if authority and 'host' not in fields:
+            fields['host'] = authority
+        if method not in ('GET', 'HEAD'):
+            self.respond(stream_id,
+                         make_answer(code=HTTPStatus.METHOD_NOT_ALLOWED))
+            return
+        address, _, query_string = path.partition('?')
+        self.answer(stream_id, HTTPhelper.request(
+            method, unquote(address), 'HTTP/2', query_string or None,
+            fields, path))
+
+    def answer(self, stream_id: int, request):
+        self.respond(stream_id, self.handler(request))
+
+    def respond(self, stream_id: int, answer):
+        """
+        HEADERS for the answer's HTTP/1.1 head without the headers of
+        the connection; the body follows from pump().
+        """
+        end = answer.data.find(b'\r\n\r\n')
+        lines = answer.data[:end].decode('latin-1').split('\r\n')
+        headers = [(':status', lines[0].split(' ', 2)[1])]
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            if name not in HTTPhelper.hop_by_hop:
+                headers.append((name, value.strip()))
+        body = H2Body(answer, end + 4)
+        self.conn.send_headers(stream_id, headers, end_stream=body.empty)
+        if body.empty:
+            body.close()
+        else:
+            self.bodies[stream_id] = body
+
+    @property
+    def sending(self) -> bool:
+        """
+        Some body has data frames the flow control windows let through.
+        """
+        if not self.settled:
+            return False
+        for stream_id in self.bodies:
+            try:
+                if self.conn.local_flow_control_window(stream_id) > 0:
+                    return True
+            except h2.exceptions.StreamClosedError:
+                return True  # pump() drops it
+        return False
+
+    def pump(self, limit: int = 1 << 18) -> bytes:
+        """
+        Frames to send: up to `limit` body bytes, one frame per stream in
+        turn, plus whatever else the state machine has queued.
+        """
+        budget = limit if self.settled else 0
+        progress = True
+        while budget > 0 and progress:
+            progress = False
+            for stream_id in list(self.bodies):
+                body = self.bodies[stream_id]
+                try:
+                    window = min(
+                        self.conn.local_flow_control_window(stream_id),
+                        self.conn.max_outbound_frame_size, budget)
+                    if window <= 0:
+                        continue
+                    chunk = body.read(window)
+                    if chunk:
+                        self.conn.send_data(stream_id, chunk)
+                        budget -= len(chunk)
+                    else:
+                        self.conn.end_stream(stream_id)
+                        del self.bodies[stream_id]
+                        body.close()
+                except h2.exceptions.StreamClosedError:
+                    del self.bodies[stream_id]
+                    body.close()
+                progress = True
+                if budget <= 0:
+                    break
+        return self.conn.data_to_send()
+
+    @property
+    def finished(self) -> bool:
+        """
+        Nothing more to do once pump()'s last frames are sent.
+        """
+        return self.closed or (self.going_away and not self.bodies)
+
+    def close(self):
+        """
+        GOAWAY: streams already open are finished, no new ones taken.
+        """
+        if not self.going_away and not self.closed:
+            self.conn.close_connection(
+                last_stream_id=self.conn.highest_inbound_stream_id)
+            self.going_away = True
+
+    def abort(self):
+        for body in self.bodies.values():
+            body.close()
+        self.bodies.clear()
 
 
 class Worker(threading.Thread):
     """
     Consumes task from queue.
     """
-    def __init__(self, queue, handler, _id=str(uuid.uuid4())[:4]):
-        threading.Thread.__init__(self)
+    def __init__(self, queue, handler, _id=str(uuid.uuid4())[:4],
+                 metrics: Metrics or None = None,
+                 idle_timeout: float or None = None, on_idle=None):
+        threading.Thread.__init__(self, name=f'Worker-{_id}', daemon=True)
         self.queue = queue
         self.handler = handler
+        self.metrics = metrics
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle  # returns True if the worker may retire
         self.__id = _id
         self.__shutdown_request = False
 
     def run(self):
         logging.info(f'Worker {self.__id} started')
         while not self.__shutdown_request:
-            client_socket, addr = self.queue.get()
+            try:
+                client_socket, addr, queued_at, served = self.queue.get(
+                    timeout=self.idle_timeout)
+            except Empty:
+                if self.on_idle(self):
+                    logging.info(f'Worker {self.__id} retired')
+                    break
+                continue
             if client_socket is None and addr is None:
                 break
+            if self.metrics:
+                self.metrics.observe('otus_queue_wait_seconds',
+                                     time.perf_counter() - queued_at)
             logging.debug(f'Worker {self.__id} manages request from {addr}')
+            kept = False  # the handler parked the idle connection
             try:
-                self.handler(client_socket)
+                kept = self.handler(client_socket, addr, queued_at, served)
             except Exception as exc:
                 logging.error(
                     f'Worker {self.__id} cannot handle {addr}. '
@@ -125,66 +2082,647 @@ class Worker(threading.Thread):
                 logging.debug(f'Worker {self.__id} finished with {addr}')
             finally:
                 try:
-                    client_socket.close()
+                    if not kept:
+                        client_socket.close()
                 except Exception:
                     pass
                 self.queue.task_done()
 
 
+class Connection:
+    """
+    Per-connection state machine for the event-loop serving mode.
+    Collects request bytes until the headers are complete, asks the
+    handler for an answer and then writes it out without blocking.
+    Persistent connections go back to reading afterwards and pick up
+    pipelined requests that are already buffered. TLS connections start
+    with a non-blocking handshake. HTTP/2 connections hand all their
+    bytes to an H2Session instead.
+    """
+    HANDSHAKE, READING, WRITING, H2, CLOSED = range(5)
+    send_size = 1 << 20  # per sendfile call, keeps the loop responsive
+    read_size = 1 << 16  # per pread + send where sendfile does not work
+    use_sendfile = hasattr(os, 'sendfile')
+
+    def __init__(self, sock, addr, handler, max_requests: int = 1,
+                 metrics: Metrics or None = None, h2_handler=None,
+                 on_close=None, slow_log=None):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.addr = addr
+        self.handler = handler
+        self.max_requests = max_requests
+        self.served = 0
+        self.keep_alive = False
+        self.tls = isinstance(sock, ssl.SSLSocket)
+        self.state = Connection.HANDSHAKE if self.tls else Connection.READING
+        self.handshake_events = selectors.EVENT_READ
+        self.started = time.perf_counter()
+        if self.tls:  # until the handshake tells about kernel TLS
+            self.use_sendfile = False
+        self.parser = RequestParser()
+        self.outbuf = None
+        self.segments = deque()
+        self.stream = None
+        self.file = None
+        self.file_offset = 0
+        self.file_remaining = 0
+        self.metrics = metrics
+        self.send_time = 0.0
+        self.last_active = time.monotonic()
+        self.h2_handler = h2_handler  # Request -> Answer, if HTTP/2 is on
+        self.session = None
+        self.on_close = on_close  # called with addr once closed
+        self.slow_log = slow_log  # called with addr and Timings when sent
+        self.timings = None
+
+    @property
+    def events(self) -> int:
+        if self.state == Connection.HANDSHAKE:
+            return self.handshake_events
+        if self.state == Connection.H2:
+            if self.outbuf or self.session.sending:
+                return selectors.EVENT_READ | selectors.EVENT_WRITE
+            return selectors.EVENT_READ
+        if self.state == Connection.WRITING:
+            return selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    @property
+    def idle(self) -> bool:
+        """
+        Waiting for the next request on a persistent connection.
+        """
+        if self.state == Connection.H2:
+            return not self.session.bodies and not self.outbuf
+        return (self.state == Connection.READING and self.served > 0
+                and self.parser.empty)
+
+    def handshake(self):
+        self.last_active = time.monotonic()
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshake_events = selectors.EVENT_READ
+            return
+        except ssl.SSLWantWriteError:
+            self.handshake_events = selectors.EVENT_WRITE
+            return
+        except OSError as exc:
+            logging.debug(f'TLS handshake with {self.addr} failed: {exc}')
+            self.close()
+            return
+        count_handshake(self.metrics, self.sock, self.started)
+        self.use_sendfile = uses_ktls(self.sock)
+        self.state = Connection.READING
+        if self.h2_handler and self.sock.selected_alpn_protocol() == 'h2':
+            self.start_h2()
+
+    def start_h2(self):
+        self.session = H2Session(
+            lambda request: self.h2_handler(request, self.addr))
+        self.state = Connection.H2
+        self.session.start(self.parser.upgrade)
+        self.parser.upgrade = None
+        self.session.feed(bytes(self.parser.buf))
+        self.parser.buf.clear()
+        self.write_h2()
+
+    def read_h2(self):
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError,
+                ssl.SSLWantWriteError):
+            return
+        except OSError:
+            self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self.session.feed(data)
+        self.write_h2()
+        if (self.tls and self.state == Connection.H2
+                and self.sock.pending()):
+            self.read_h2()
+
+    def write_h2(self):
+        """
+        Send frames until the socket or the flow control windows are
+        full; the selector asks for more while some are left.
+        """
+        try:
+            while True:
+                while self.outbuf:
+                    self.outbuf = self.outbuf[self.sock.send(self.outbuf):]
+                out = self.session.pump()
+                if not out:
+                    break
+                self.outbuf = memoryview(out)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError,
+                ssl.SSLWantWriteError):
+            return
+        except OSError as exc:
+            logging.debug(f'Connection {self.addr} broken: {exc}')
+            self.close()
+            return
+        if self.session.finished:
+            self.close()
+
+    def on_readable(self):
+        if self.state == Connection.HANDSHAKE:
+            return self.handshake()
+        self.last_active = time.monotonic()
+        if self.state == Connection.H2:
+            return self.read_h2()
+        started = time.perf_counter()
+        try:
+            received = self.parser.read_from(self.sock)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError,
+                ssl.SSLWantWriteError):
+            return
+        except OSError:
+            self.close()
+            return
+        if self.metrics:
+            self.metrics.observe('otus_stage_seconds',
+                                 time.perf_counter() - started,
+                                 'stage="read"')
+        if not received:
+            self.close()
+            return
+        self.process_pending()
+        # decrypted bytes TLS already holds will not wake up the selector
+        if (self.tls and self.state == Connection.READING
+                and self.sock.pending()):
+            self.on_readable()
+
+    def process_pending(self):
+        while self.state == Connection.READING:
+            if self.h2_handler and self.served == 0:
+                preface = H2Session.detect(self.parser.buf)
+                if preface:
+                    return self.start_h2()
+                if preface is None:
+                    return
+            timings = Timings() if self.slow_log else None
+            try:
+                result = self.handler(
+                    self.parser, last=self.served + 1 >= self.max_requests,
+                    addr=self.addr, timings=timings)
+            except Exception as exc:
+                logging.error(f'Cannot handle {self.addr}. Error: {exc}')
+                self.close()
+                return
+            if result is None:  # head not complete yet
+                return
+            self.served += 1
+            answer, self.keep_alive = result
+            self.timings = timings
+            if answer.file and (answer.length or answer.more):
+                try:
+                    self.file = open(answer.file, 'rb')
+                except OSError as exc:
+                    logging.error(f'Cannot open {answer.file}: {exc}')
+                    self.close()
+                    return
+            self.segments.append((answer.data, answer.offset, answer.length))
+            self.segments.extend(answer.more)
+            self.stream = answer.stream
+            if self.stream:
+                nodelay(self.sock)
+            self.next_segment()
+            self.state = Connection.WRITING
+            self.write_out()
+
+    def next_segment(self):
+        data, self.file_offset, self.file_remaining = self.segments.popleft()
+        self.outbuf = memoryview(data)
+
+    def on_writable(self):
+        if self.state == Connection.HANDSHAKE:
+            return self.handshake()
+        if self.state == Connection.H2:
+            self.last_active = time.monotonic()
+            return self.write_h2()
+        self.write_out()
+        self.process_pending()
+
+    def write_out(self):
+        self.last_active = time.monotonic()
+        started = time.perf_counter()
+        try:
+            while True:
+                while self.outbuf:
+                    self.outbuf = self.outbuf[self.sock.send(self.outbuf):]
+                if self.file_remaining and not self.write_file():
+                    return
+                if self.segments:
+                    self.next_segment()
+                    continue
+                chunk = next(self.stream, None) if self.stream else None
+                if chunk is None:
+                    break
+                self.outbuf = memoryview(chunk)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError,
+                ssl.SSLWantWriteError):
+            return
+        except OSError as exc:
+            logging.debug(f'Connection {self.addr} broken: {exc}')
+            self.close()
+            return
+        finally:
+            self.send_time += time.perf_counter() - started
+        observe_stage(self.metrics, self.timings, 'send', self.send_time)
+        if self.slow_log:
+            self.slow_log(self.addr, self.timings)
+        self.send_time = 0.0
+        self.close_file()
+        self.stream = None
+        if self.parser.upgrade:
+            self.start_h2()
+        elif self.keep_alive:
+            self.state = Connection.READING
+        else:
+            self.close()
+
+    def write_file(self) -> bool:
+        """
+        Stream the current file region with os.sendfile (pread + send
+        where sendfile is not available). True once it is all sent.
+        """
+        fileno = self.file.fileno()
+        while self.file_remaining:
+            if self.use_sendfile:
+                count = min(self.file_remaining, self.send_size)
+                try:
+                    sent = os.sendfile(self.fd, fileno, self.file_offset,
+                                       count)
+                except OSError as exc:
+                    if exc.errno not in (errno.EINVAL, errno.ENOSYS,
+                                         errno.EOPNOTSUPP):
+                        raise
+                    self.use_sendfile = False
+                    continue
+            else:
+                # a TLS retry must offer the same bytes, which re-reading
+                # the same region does
+                sent = self.sock.send(os.pread(
+                    fileno, min(self.file_remaining, self.read_size),
+                    self.file_offset))
+            if not sent:
+                raise OSError(f'{self.file.name} changed while sending')
+            self.file_offset += sent
+            self.file_remaining -= sent
+        return True
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.state = Connection.CLOSED
+        self.close_file()
+        if self.session:
+            self.session.abort()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        if self.on_close:
+            self.on_close(self.addr)
+            self.on_close = None
+
+
 class MyServer:
 
+    modes = ('threads', 'events')
+    autoindex_page = 1000  # listing entries per page
+    autoindex_sorted_pages = 10  # sorted pages hold entries up to their end
+    warm_up_limit = 5.0  # seconds until ready is reported while warming
+    linger_timeout = 1.0  # seconds a refused client gets to read and close
+
     def __init__(self, host: str, port: int, max_workers: int = 3,
                  timeout: float = 5.0, basedir: str = '.',
-                 bind: bool = True, chunklen=24):
+                 bind: bool = True, chunklen=4096, mode: str = 'threads',
+                 processes: int = 1, keepalive_timeout: float = 5.0,
+                 max_requests: int = 100, cache_size: int = 32 << 20,
+                 cache_control: dict or None = None, compression: bool = True,
+                 metrics_path: str or None = None,
+                 access_log: AccessLog or None = None,
+                 stat_ttl: float = 1.0, min_workers: int or None = None,
+                 queue_size: int = 128, idle_timeout: float = 10.0,
+                 scale_wait: float = 0.01, retry_after: int = 1,
+                 mmap_size: int = 0, drain_timeout: float = 30.0,
+                 listen_fds: list or None = None,
+                 ready_fd: int or None = None,
+                 tls_context: ssl.SSLContext or None = None,
+                 autoindex: bool = False, listen: list or None = None,
+                 backlog: int = socket.SOMAXCONN, nodelay: bool = False,
+                 defer_accept: int = 0, fastopen: int = 0,
+                 proxy: dict or None = None,
+                 proxy_connect_timeout: float = 1.0,
+                 proxy_read_timeout: float = 30.0, proxy_pool: int = 32,
+                 http2: bool = False, preload: list or None = None,
+                 limits: ClientLimits or None = None,
+                 slow_log: float or None = None,
+                 profile_path: str or None = None,
+                 profile_dir: str or None = None,
+                 profile_seconds: float = 10.0):
+        if mode not in MyServer.modes:
+            raise ValueError(f'Unknown serving mode {mode}')
+        if proxy and mode == 'events':
+            # upstream I/O blocks, it would stall every connection
+            raise ValueError('Proxy routes need the threads mode')
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.processes = processes
+        self.children = {}  # pid -> start time, filled by the supervisor
+        self.reuse_port = processes > 1 and hasattr(socket, 'SO_REUSEPORT')
+        self.backlog = backlog
+        self.nodelay = nodelay
+        self.defer_accept = defer_accept
+        self.fastopen = fastopen
+        # (family, address) per listener, `host` and `port` without any
+        self.addresses = [listen_address(spec, port) for spec in listen] \
+            if listen else [(socket.AF_INET, (host, port))]
+        if listen_fds is None:
+            self.server_sockets = [self.make_server_socket(family)
+                                   for family, _ in self.addresses]
+        else:  # already bound and listening, handed over by reexec()
+            self.server_sockets = [socket.socket(fileno=fd)
+                                   for fd in listen_fds]
+            bind = False
+        self.acceptors = []  # accept threads of the extra listeners
+        self.ready_fd = ready_fd
+        if http2 and h2 is None:
+            raise ValueError('HTTP/2 needs the h2 package')
+        self.http2 = http2
+        self.tls_context = tls_context
+        if http2 and tls_context:
+            tls_context.set_alpn_protocols(['h2', 'http/1.1'])
+        self.handshaker = None
+        self.idler = None  # idle keep-alive connections, threads mode
+        self.lingerer = None  # started by the first shed()
+        self.successor = None
+        self.supervised = False
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.drain_deadline = None
         self.max_workers = max_workers
         self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.cache = ResponseCache(cache_size) if cache_size > 0 else None
+        self.compression = compression
+        self.metrics_path = metrics_path
+        self.metrics = Metrics() if metrics_path else None
+        self.access_log = access_log
+        # longest URL prefix first, so the most specific rule wins
+        self.cache_control = sorted((cache_control or {}).items(),
+                                    key=lambda item: -len(item[0]))
         self.basedir = Path(basedir)
         if not self.basedir.is_dir():
             raise FileNotFoundError(f'{basedir} is not a directory')
+        # resolved once: a file is inside the root iff its resolved path
+        # starts with this prefix
+        self.root_prefix = os.path.join(str(self.basedir.resolve()), '')
+        self.paths = PathCache(stat_ttl) if stat_ttl > 0 else None
+        self.mmaps = MmapCache(mmap_size) if mmap_size > 0 else None
+        self.autoindex = autoindex
+        self.preload = preload or []  # URL paths and globs to warm up
+        self.limits = limits
+        self.slow_log = slow_log  # seconds, requests taking longer are logged
+        self.profile_path = profile_path
+        self.profile_dir = profile_dir or tempfile.gettempdir()
+        self.profile_seconds = profile_seconds
+        self.profiler = None
+        self.warm = threading.Event()
+        # (prefix, upstreams, round-robin turns), longest prefix first
+        self.proxy_routes = sorted(
+            ((prefix, [Upstream(url, proxy_connect_timeout,
+                                proxy_read_timeout, proxy_pool)
+                       for url in urls], itertools.count())
+             for prefix, urls in (proxy or {}).items()),
+            key=lambda route: -len(route[0]))
         self.__shutdown_request = False
-        self.queue = Queue()
+        # the pool grows from min_workers to max_workers while sockets
+        # wait, idle workers retire; a full queue sheds connections
+        self.min_workers = max_workers if min_workers is None \
+            else max(1, min(min_workers, max_workers))
+        self.queue = Queue(queue_size)
+        self.idle_timeout = idle_timeout
+        self.scale_wait = scale_wait
+        self.retry_after = retry_after
         self.worker_pool = []
+        self.busy_workers = 0
+        self.pool_lock = threading.Lock()
+        self.worker_ids = 0
+        self.connections = {}  # fd -> Connection in the events mode
         self.chunklen = chunklen
-        self._bind = bind
+        self.mode = mode
+        self._bind = bind or listen_fds is not None
         if bind:
             self.bind_server_socket()
 
+    def make_server_socket(self, family: int = socket.AF_INET
+                           ) -> socket.socket:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            return sock
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:  # [::] next to 0.0.0.0 on one port
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        return sock
+
     def bind_server_socket(self):
         try:
-            self.server_socket.bind((self.host, self.port))
+            for sock, (family, address) in zip(self.server_sockets,
+                                                self.addresses):
+                if family == socket.AF_UNIX:
+                    remove_stale_socket(address)
+                sock.bind(address)
         except Exception:
             self.close()
             raise
+        self._bind = True
+
+    def listen_socket(self, sock):
+        """
+        Start listening with the configured backlog and TCP options.
+        """
+        if sock.family != socket.AF_UNIX:
+            options = ((socket.TCP_NODELAY, int(self.nodelay)),
+                       (getattr(socket, 'TCP_DEFER_ACCEPT', None),
+                        self.defer_accept),
+                       (getattr(socket, 'TCP_FASTOPEN', None),
+                        self.fastopen))
+            for option, value in options:
+                if not value:
+                    continue
+                if option is None:
+                    logging.warning('TCP option is not supported here')
+                    continue
+                try:  # accepted sockets inherit TCP_NODELAY on Linux
+                    sock.setsockopt(socket.IPPROTO_TCP, option, value)
+                except OSError as exc:
+                    logging.warning(f'Cannot set TCP option {option}: '
+                                    f'{exc}')
+        sock.listen(self.backlog)
 
     def init_workers(self):
-        for number in range(self.max_workers):
-            self.worker_pool.append(
-                Worker(self.queue, self.handle_client_connection,
-                       _id=(number + 1))
-            )
-        return len(self.worker_pool) == self.max_workers
+        for _ in range(self.min_workers):
+            self.worker_pool.append(self.make_worker())
+        return len(self.worker_pool) == self.min_workers
+
+    def make_worker(self) -> Worker:
+        self.worker_ids += 1
+        return Worker(self.queue, self.handle_client_connection,
+                      _id=self.worker_ids, metrics=self.metrics,
+                      idle_timeout=self.idle_timeout,
+                      on_idle=self.retire_worker)
 
     def start_workers(self):
         [worker.start() for worker in self.worker_pool]
 
-    def stop_workers(self):
+    def scale_workers(self):
+        """
+        Add a worker if none is idle for the queued sockets or the oldest
+        of them has waited longer than scale_wait.
+        """
+        with self.pool_lock:
+            if len(self.worker_pool) >= self.max_workers:
+                return
+            with self.queue.mutex:
+                waiting = len(self.queue.queue)
+                waited = time.perf_counter() - self.queue.queue[0][2] \
+                    if waiting else 0.0
+            idle = len(self.worker_pool) - self.busy_workers
+            if idle >= waiting and waited <= self.scale_wait:
+                return
+            worker = self.make_worker()
+            self.worker_pool.append(worker)
+        worker.start()
+
+    def retire_worker(self, worker: Worker) -> bool:
+        with self.pool_lock:
+            if len(self.worker_pool) <= self.min_workers:
+                return False
+            self.worker_pool.remove(worker)
+            return True
+
+    def shed(self, client_socket,
+             code: HTTPStatus = HTTPStatus.SERVICE_UNAVAILABLE):
+        """
+        Answer 503 right away when the queue is full (429 to a client
+        over its connection limit), without blocking the accepting thread
+        on a slow client. The rest of the answer and the close are left
+        to the Lingerer.
+        """
+        answer = make_answer(code=code,
+                             extra={'Retry-After': self.retry_after})
+        if self.metrics and code == HTTPStatus.SERVICE_UNAVAILABLE:
+            self.metrics.inc('otus_connections_shed_total')
+        try:
+            client_socket.setblocking(False)
+            sent = client_socket.send(answer.data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            client_socket.close()
+            return
+        with self.pool_lock:
+            if self.lingerer is None:
+                self.lingerer = Lingerer(self.linger_timeout)
+                self.lingerer.start()
+        self.lingerer.add(client_socket, answer.data[sent:])
+
+    def stop_workers(self, deadline: float or None = None):
+        """
+        Stop the pool. With a deadline (draining) the queued sockets are
+        still served and workers get until then to finish; otherwise the
+        queued sockets are dropped and every worker gets half a second.
+        """
         logging.info('Killing workers...')
-        for worker in self.worker_pool:
-            self.queue.put((None, None))
+        with self.pool_lock:
+            workers, self.max_workers = list(self.worker_pool), 0
+        while deadline is None:  # sockets nobody will serve
+            try:
+                client_socket, *_ = self.queue.get_nowait()
+            except Empty:
+                break
+            if client_socket:
+                client_socket.close()
+        for worker in workers:
+            timeout = 0.5 if deadline is None \
+                else max(deadline - time.monotonic(), 0.01)
+            try:
+                self.queue.put((None, None, None, 0), timeout=timeout)
+            except Full:
+                break
             worker.__shutdown_request = True
-            worker.join(timeout=0.5)
+        for worker in workers:
+            worker.join(timeout=0.5 if deadline is None
+                        else max(deadline - time.monotonic(), 0.01))
+        busy = sum(worker.is_alive() for worker in workers)
+        if busy:
+            logging.error(f'{busy} workers did not finish in time')
 
     @staticmethod
-    def send_answer(data, client_socket):
-        client_socket.sendall(data)
+    def send_answer(answer, client_socket):
+        data = answer.data
+        segments = ((answer.data, answer.offset, answer.length),) + \
+            tuple(answer.more)
+        f = open(answer.file, 'rb') if answer.file else None
+        # TLS without kernel offload has to encrypt in user space
+        chunked = (isinstance(client_socket, ssl.SSLSocket)
+                   and not uses_ktls(client_socket))
+        try:
+            for chunk, offset, length in segments:
+                client_socket.sendall(chunk)
+                if not length:
+                    continue
+                if chunked:
+                    sent = MyServer.send_chunks(client_socket, f, offset,
+                                                length)
+                else:  # os.sendfile where possible, chunked reads otherwise
+                    sent = client_socket.sendfile(f, offset, length)
+                if sent != length:
+                    raise socket.error(f'{answer.file} changed while sending')
+            if answer.stream:
+                # chunks are sent as they come, not held back by Nagle
+                nodelay(client_socket)
+                for chunk in answer.stream:
+                    client_socket.sendall(chunk)
+        finally:
+            if f:
+                f.close()
+            if answer.stream:
+                answer.stream.close()
         if len(data) > 70:
             data = data[:70]
         logging.debug(f'Send {data} to {client_socket}')
 
-    def check_file_path(self, request, client_socket) -> Path or None:
+    @staticmethod
+    def send_chunks(client_socket, f, offset: int, length: int,
+                    size: int = 1 << 16) -> int:
+        sent = 0
+        while sent < length:
+            chunk = os.pread(f.fileno(), min(size, length - sent),
+                             offset + sent)
+            if not chunk:
+                break
+            client_socket.sendall(chunk)
+            sent += len(chunk)
+        return sent
+
+    def check_file_path(self, request) -> Path or None:
         if request.address.endswith('/') and len(request.address) > 3:
             addr = request.address[1:-1]  # get rid of starting and ending /
             file = self.basedir / Path(addr) / Path('index.html')
@@ -192,103 +2730,1364 @@ class MyServer:
             file = self.basedir / Path('index.html')
         else:
             file = self.basedir / Path(request.address[1:])
-        if self.basedir.resolve() not in file.resolve().parents:
+        file = file.resolve()
+        if not str(file).startswith(self.root_prefix):
             logging.info('Someone tried to escape basedir. Forbidden')
-            MyServer.send_answer(
-                make_answer(code=HTTPStatus.FORBIDDEN),
-                client_socket
-            )
-            client_socket.close()
             return
         return file
 
-    def get_and_check_request(self, data, client_socket) -> NamedTuple:
+    def resolve_path(self, request) -> tuple:
+        """
+        check_file_path() and the stat of its result (None if missing),
+        served from the path cache while fresh.
+        """
+        entry = self.paths.get(request.address) if self.paths else None
+        if entry is not None:
+            return entry.file, entry.stat
+        file, stat = self.check_file_path(request), None
+        if file:
+            try:
+                stat = os.stat(file)
+            except OSError:
+                pass
+        if self.paths:
+            self.paths.put(request.address, file, stat)
+        return file, stat
+
+    def answer_next(self, parser: RequestParser, last: bool = True,
+                    addr=None, timings: Timings or None = None
+                    ) -> tuple or None:
+        """
+        Answer the next request buffered in the parser: (answer,
+        keep_alive), or None while its head is incomplete. Malformed and
+        oversized heads get an error answer and close the connection.
+        """
+        started = time.perf_counter()
+        request = None
         try:
-            request = get_request(data)
-            return request
-        except Exception as exc:
+            request = parser.next_request()
+        except HeadersTooLarge as exc:
             logging.error(f'Bad request. Exc: {exc}')
-            MyServer.send_answer(
-                make_answer(code=HTTPStatus.METHOD_NOT_ALLOWED),
-                client_socket
-            )
-            client_socket.close()
+            result = make_answer(
+                code=HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE), False
+        except MethodNotAllowed as exc:
+            logging.error(f'Bad request. Exc: {exc}')
+            result = make_answer(code=HTTPStatus.METHOD_NOT_ALLOWED), False
+        except ValueError as exc:
+            logging.error(f'Bad request. Exc: {exc}')
+            result = make_answer(code=HTTPStatus.BAD_REQUEST), False
+        else:
+            if request is None:
+                return
+            observe_stage(self.metrics, timings, 'parse',
+                          time.perf_counter() - started)
+            if (self.http2 and self.tls_context is None
+                    and H2Session.upgrade_wanted(request)):
+                parser.upgrade = request  # answered as stream 1 over h2c
+                result = HTTPhelper.answer(make_head(
+                    HTTPStatus.SWITCHING_PROTOCOLS, connection='Upgrade',
+                    extra={'Upgrade': 'h2c'})), True
+            else:
+                result = self.process_request(request, last, addr, timings)
+        if timings is not None:
+            timings.request = request
+            timings.code = result[0].data[9:12].decode('ascii')
+        if self.metrics:
+            self.metrics.count_answer(result[0])
+        if self.limits:
+            self.limits.charge(addr, answer_size(result[0]))
+        if self.access_log:
+            self.access_log.log(addr, request, result[0])
+        return result
 
-    def read_response(self, client_socket) -> str:
-        buf = b''
-        delim = b'\r\n\r\n'
-        while True:
-            r = client_socket.recv(self.chunklen)
-            buf += r
-            if delim in buf:
-                buf = buf.split(delim)[0]
-                break
-            elif not r:
-                raise socket.error('Server closed connection')
-        logging.debug(f'Received {buf}')
-        return buf.decode('utf-8')
+    def h2_answer(self, request, addr=None) -> NamedTuple:
+        """
+        Answer to one HTTP/2 stream, counted and logged like the others.
+        Its frames are interleaved with those of other streams, so a slow
+        stream is logged without the send stage.
+        """
+        timings = Timings() if self.slow_log is not None else None
+        answer, _ = self.process_request(request, last=False, addr=addr,
+                                         timings=timings)
+        if timings is not None:
+            timings.request = request
+            timings.code = answer.data[9:12].decode('ascii')
+            self.log_slow(addr, timings)
+        if self.metrics:
+            self.metrics.count_answer(answer)
+        if self.limits:
+            self.limits.charge(addr, answer_size(answer))
+        if self.access_log:
+            self.access_log.log(addr, request, answer)
+        return answer
 
-    def handle_client_connection(self, client_socket):
-        data = self.read_response(client_socket)
-        request = self.get_and_check_request(data, client_socket)
-        if not request:
+    def log_slow(self, addr, timings: Timings):
+        """
+        Log a request whose stages took `slow_log` seconds or more.
+        """
+        total = sum(timings.values())
+        if total < self.slow_log:
             return
-        file = self.check_file_path(request, client_socket)
-        if not file:
+        request = timings.request
+        what = f'{request.method} {request.address}' if request else '-'
+        host = addr[0] if isinstance(addr, tuple) else '-'
+        stages = ' '.join(f'{stage}={seconds * 1000:.1f}ms'
+                          for stage, seconds in timings.items())
+        logging.warning(f'Slow request {total * 1000:.0f}ms: {what} '
+                        f'{timings.code} from {host}: {stages}')
+
+    def profile_answer(self, request, addr, keep_alive: bool) -> NamedTuple:
+        """
+        Admin endpoint of the profiler, for local clients only:
+        `?seconds=N` starts a profile, a request while one runs stops it.
+        """
+        ip = ClientLimits.client(addr)
+        if ip and not ipaddress.ip_address(ip.partition('%')[0]).is_loopback:
+            return make_answer(code=HTTPStatus.FORBIDDEN,
+                               keep_alive=keep_alive)
+        seconds = parse_qs(request.query_string or '').get('seconds', [''])[0]
+        seconds = min(float(seconds), 600.0) \
+            if seconds.replace('.', '', 1).isdigit() else None
+        path = self.toggle_profile(seconds=seconds)
+        state = f'profiling into {path}' if path else 'profile stopped'
+        return make_body_answer(f'{state}\n'.encode('utf-8'),
+                                'text/plain; charset=utf-8',
+                                code=HTTPStatus.ACCEPTED,
+                                method=request.method,
+                                keep_alive=keep_alive)
+
+    def toggle_profile(self, *args, seconds: float or None = None
+                       ) -> str or None:
+        """
+        SIGUSR1 handler: start sampling this process's threads for
+        `profile_seconds`, or stop a running profile early. The
+        supervisor of the pre-fork mode passes the signal on to the
+        children instead. Returns the output path of a started profile.
+        """
+        if self.children:
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGUSR1)
+                except ProcessLookupError:
+                    pass
             return
-        if file.is_file():
-            answer = make_answer(code=HTTPStatus.OK,
-                                 file=file,
-                                 method=request.method)
+        if self.profiler and self.profiler.is_alive():
+            self.profiler.stop()
+            return
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.profile_dir,
+                            f'otus-{os.getpid()}-{stamp}.folded')
+        self.profiler = Profiler(path, seconds or self.profile_seconds)
+        self.profiler.start()
+        logging.info(f'Profiling for {self.profiler.seconds}s into {path}')
+        return path
+
+    def process_request(self, request, last: bool = True,
+                        addr=None, timings: Timings or None = None) -> tuple:
+        """
+        Run the check path -> answer pipeline on a parsed request.
+        Socket-agnostic, so both serving modes share it. Returns the
+        answer and whether the connection stays open; `last` forces it
+        closed.
+        """
+        keep_alive = (not last and not self.draining
+                      and self.keepalive_timeout > 0
+                      and wants_keep_alive(request))
+        # /api/../admin is no /api/ route
+        if request.address.startswith('/') and '.' in request.address:
+            request = request._replace(
+                address=remove_dot_segments(request.address))
+        if self.metrics and request.address == self.metrics_path:
+            return make_body_answer(
+                self.metrics.render(*self.sample_metrics()),
+                'text/plain; version=0.0.4; charset=utf-8',
+                method=request.method, keep_alive=keep_alive), keep_alive
+        if self.profile_path and request.address == self.profile_path:
+            return self.profile_answer(request, addr, keep_alive), keep_alive
+        wait = self.limits.allow(addr) if self.limits else 0
+        if wait:
+            if self.metrics:
+                self.metrics.inc('otus_limited_total',
+                                 labels='limit="requests"')
+            return make_answer(code=HTTPStatus.TOO_MANY_REQUESTS,
+                               keep_alive=keep_alive,
+                               extra={'Retry-After': int(wait) + 1}
+                               ), keep_alive
+        started = time.perf_counter()
+        for route in self.proxy_routes:
+            if request.address.startswith(route[0]):
+                result = self.proxy_answer(route, request, keep_alive, addr)
+                observe_stage(self.metrics, timings, 'upstream',
+                              time.perf_counter() - started)
+                return result
+        file, stat = self.resolve_path(request)
+        observe_stage(self.metrics, timings, 'path',
+                      time.perf_counter() - started)
+        if not file:
+            return make_answer(code=HTTPStatus.FORBIDDEN,
+                               keep_alive=keep_alive), keep_alive
+        if stat and stat_mode.S_ISREG(stat.st_mode):
             logging.debug('Sending back valid answer')
-            MyServer.send_answer(answer, client_socket)
+            started = time.perf_counter()
+            answer = self.file_answer(file, request, keep_alive, stat)
+            observe_stage(self.metrics, timings, 'file',
+                          time.perf_counter() - started)
+            return answer, keep_alive
+        if self.autoindex and request.address.endswith('/'):
+            result = self.directory_answer(file, stat, request, keep_alive)
+            if result:
+                return result
+        logging.debug(f'No such file {repr(file)}')
+        return make_answer(code=HTTPStatus.NOT_FOUND,
+                           keep_alive=keep_alive), keep_alive
+
+    def directory_answer(self, file: Path, stat: os.stat_result or None,
+                         request, keep_alive: bool) -> tuple or None:
+        """
+        Listing of a directory without index.html and whether the
+        connection stays open, None if there is no such directory. A page
+        is streamed while it is generated and cached until the directory
+        changes; HTTP/1.0 clients get it delimited by the close.
+        """
+        directory = file if stat else file.parent
+        try:
+            dir_stat = stat or os.stat(directory)
+        except OSError:
+            return
+        if not stat_mode.S_ISDIR(dir_stat.st_mode):
+            return
+        ctype = 'text/html; charset=utf-8'
+        key = f'autoindex:{directory}?{request.query_string or ""}'
+        entry = self.cache.get(key, dir_stat) if self.cache else None
+        if entry is not None:
+            return make_body_answer(entry.body, ctype, method=request.method,
+                                    keep_alive=keep_alive), keep_alive
+        chunks = list_directory(directory, request.address,
+                                request.query_string, self.autoindex_page,
+                                self.autoindex_sorted_pages)
+        if self.cache is not None:
+            chunks = self.cached_chunks(chunks, key, dir_stat)
+        chunked = request.version == 'HTTP/1.1'
+        keep_alive = keep_alive and chunked
+        return make_stream_answer(chunks, ctype, request.method, keep_alive,
+                                  chunked=chunked), keep_alive
+
+    def cached_chunks(self, chunks, key: str, stat: os.stat_result):
+        """
+        Pass the chunks through, putting the whole body into the response
+        cache at the end if it is small enough for it.
+        """
+        parts, size = [], 0
+        for chunk in chunks:
+            size += len(chunk)
+            if parts is not None:
+                parts = parts if size <= self.cache.max_file_size else None
+            if parts is not None:
+                parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            self.cache.put(key, stat, b'', b''.join(parts))
+
+    def proxy_answer(self, route: tuple, request, keep_alive: bool,
+                     addr=None) -> tuple:
+        """
+        Forward the request to the route's upstreams in turn, passing over
+        the ones that fail, and relay the first answer. A pooled
+        connection the backend closed meanwhile is retried on a new one.
+        """
+        _, upstreams, turns = route
+        start = next(turns) % len(upstreams)
+        upstreams = upstreams[start:] + upstreams[:start]
+        for upstream in [u for u in upstreams if u.available] or upstreams:
+            head = self.upstream_head(upstream, request, addr)
+            while True:
+                try:
+                    sock, reused = upstream.acquire()
+                except OSError as exc:
+                    upstream.failed(exc)
+                    break
+                if self.metrics:
+                    state = 'reused' if reused else 'new'
+                    self.metrics.inc('otus_upstream_requests_total',
+                                     labels=f'upstream="{upstream.name}",'
+                                            f'connection="{state}"')
+                reader = UpstreamReader(sock)
+                try:
+                    sock.sendall(head)
+                    answer_head = reader.head()
+                except socket.timeout as exc:
+                    sock.close()
+                    upstream.failed(exc)
+                    return make_answer(code=HTTPStatus.GATEWAY_TIMEOUT,
+                                       keep_alive=keep_alive), keep_alive
+                except (OSError, ValueError) as exc:
+                    sock.close()
+                    if reused:
+                        continue
+                    upstream.failed(exc)
+                    break
+                upstream.succeeded()
+                return self.relay(upstream, reader, answer_head, request,
+                                  keep_alive)
+        return make_answer(code=HTTPStatus.BAD_GATEWAY,
+                           keep_alive=keep_alive), keep_alive
+
+    def upstream_head(self, upstream: Upstream, request, addr) -> bytes:
+        headers = request.headers or {}
+        drop = set(HTTPhelper.hop_by_hop) | {
+            token.strip() for token in
+            headers.get('connection', '').lower().split(',')}
+        target = quote(request.address, safe="/:@!$&'()*+,;=~")
+        if request.query_string:
+            target += f'?{request.query_string}'
+        lines = [f'{request.method} {target} HTTP/1.1']
+        lines.extend(f'{name}: {value}' for name, value in headers.items()
+                     if name not in drop and name not in (
+                         'x-forwarded-for', 'x-forwarded-proto'))
+        if 'host' not in headers:
+            lines.append(f'host: {upstream.name}')
+        forwarded = [headers.get('x-forwarded-for')]
+        if isinstance(addr, tuple):
+            forwarded.append(addr[0])
+        forwarded = ', '.join(filter(None, forwarded))
+        if forwarded:
+            lines.append(f'x-forwarded-for: {forwarded}')
+        lines.append('x-forwarded-proto: '
+                     f'{"https" if self.tls_context else "http"}')
+        lines.append('connection: keep-alive\r\n\r\n')
+        return '\r\n'.join(lines).encode('utf-8')
+
+    def relay(self, upstream: Upstream, reader: UpstreamReader,
+              answer_head: tuple, request, keep_alive: bool) -> tuple:
+        """
+        Our answer for the upstream's one: its status and end-to-end
+        headers, with the body streamed from the upstream connection.
+        """
+        version, status, reason, headers = answer_head
+        fields = {name.lower(): value for name, value in headers}
+        tokens = {token.strip() for token in
+                  fields.get('connection', '').lower().split(',')}
+        reusable = ('close' not in tokens if version == 'HTTP/1.1'
+                    else 'keep-alive' in tokens)
+        chunked = 'chunked' in fields.get('transfer-encoding', '').lower()
+        length = fields.get('content-length', '')
+        length = int(length) if length.isdigit() and not chunked else None
+        bodyless = request.method == 'HEAD' or status in (204, 304)
+        drop = set(HTTPhelper.hop_by_hop) | tokens | {'content-length'}
+        lines = [f'{HTTPhelper.version} {status} {reason}']
+        lines.extend(f'{name}: {value}' for name, value in headers
+                     if name.lower() not in drop)
+        if length is not None:
+            lines.append(f'Content-Length: {length}')
+        if bodyless or (length is not None and len(reader.buf) >= length):
+            # nothing more to read, the body came with the head
+            body = None
+            tail = b'' if bodyless else bytes(reader.buf[:length])
+            if reusable and len(reader.buf) == len(tail):
+                upstream.release(reader.sock)
+            else:
+                reader.sock.close()
+        else:
+            if length is None and not chunked:
+                reusable = False  # the body ends with the close
+            body = self.relay_body(upstream, reader, length, chunked,
+                                   reusable)
+            if length is None:
+                if request.version != 'HTTP/1.1':  # HTTP/2 frames it
+                    keep_alive = False
+                else:
+                    lines.append('Transfer-Encoding: chunked')
+                    body = chunk_frames(body)
+        connection = 'keep-alive' if keep_alive else 'close'
+        head = ('\r\n'.join(lines) + '\r\n').encode('latin-1') + \
+            HTTPhelper.connection_headers[connection]
+        if body is None:
+            return HTTPhelper.answer(head + tail), keep_alive
+        return HTTPhelper.answer(head, stream=body), keep_alive
+
+    @staticmethod
+    def relay_body(upstream: Upstream, reader: UpstreamReader,
+                   length: int or None, chunked: bool, reusable: bool):
+        """
+        Body chunks read from the upstream. Its connection goes back to
+        the pool only once the whole body went through.
+        """
+        complete = False
+        try:
+            yield from reader.body(length, chunked)
+            complete = not reader.buf
+        finally:
+            if complete and reusable:
+                upstream.release(reader.sock)
+            else:
+                reader.sock.close()
+
+    def sample_metrics(self) -> tuple:
+        """
+        Gauges and externally kept counters for the /metrics page.
+        """
+        gauges = {'otus_queue_depth': self.queue.qsize(),
+                  'otus_workers': len(self.worker_pool),
+                  'otus_busy_workers': self.busy_workers,
+                  'otus_open_connections': len(self.connections)}
+        totals = {}
+        if self.cache is not None:
+            stats = self.cache.stats()
+            gauges['otus_cache_bytes'] = stats['bytes']
+            gauges['otus_cache_entries'] = stats['entries']
+            for name in ('hits', 'misses', 'evictions'):
+                totals[f'otus_cache_{name}_total'] = stats[name]
+        if self.mmaps is not None:
+            stats = self.mmaps.stats()
+            gauges['otus_mmap_bytes'] = stats['bytes']
+            gauges['otus_mmap_files'] = stats['files']
+        if self.access_log:
+            totals['otus_access_log_dropped_total'] = self.access_log.dropped
+        gauges['otus_warm'] = int(self.warm.is_set())
+        return gauges, totals
+
+    def cache_control_for(self, address: str) -> str:
+        for prefix, value in self.cache_control:
+            if address.startswith(prefix):
+                return value
+        return ''
+
+    def select_encoding(self, file: Path, stat: os.stat_result,
+                        request) -> tuple:
+        """
+        Pick the content coding for a compressible file: a precompressed
+        sibling (file.js.br, file.js.gz) that is newer than the file,
+        otherwise on-the-fly compression of files the response cache
+        takes, so a file is compressed once and not on every request.
+        Returns (encoding, sibling path or None, sibling stat or None).
+        """
+        headers = request.headers or {}
+        on_the_fly = self.cache is not None and (
+            HTTPhelper.compress_min_size <= stat.st_size
+            <= self.cache.max_file_size)
+        for encoding in accepted_encodings(headers.get('accept-encoding', '')):
+            suffix = HTTPhelper.encodings[encoding]
+            sibling = file.with_name(file.name + suffix)
+            try:
+                sibling_stat = os.stat(sibling)
+            except OSError:
+                sibling_stat = None
+            if sibling_stat and sibling_stat.st_mtime_ns >= stat.st_mtime_ns:
+                return encoding, sibling, sibling_stat
+            if encoding == 'br' and brotli is None:
+                continue
+            # ranges of a body made on the fly would not be stable
+            if on_the_fly and 'range' not in headers:
+                return encoding, None, None
+        return None, file, stat
+
+    def mapped(self, answer, file: Path, stat: os.stat_result) -> NamedTuple:
+        """
+        The answer with its file regions replaced by slices of the file's
+        shared mapping, when the mmap cache takes the file.
+        """
+        if self.mmaps is None or not answer.file:
+            return answer
+        view = self.mmaps.get(file, stat)
+        if view is None:
+            return answer
+        segments = []
+        for data, offset, length in ((answer.data, answer.offset,
+                                      answer.length),) + tuple(answer.more):
+            segments.append((data, 0, 0))
+            if length:
+                segments.append((view[offset:offset + length], 0, 0))
+        return HTTPhelper.answer(segments[0][0], more=tuple(segments[1:]))
+
+    def file_answer(self, file: Path, request, keep_alive: bool,
+                    stat: os.stat_result or None = None) -> NamedTuple:
+        """
+        200 answer for an existing file, or 304 if the client's copy is
+        still fresh. Small files and compressed bodies made on the fly
+        come from the response cache.
+        """
+        stat = stat or os.stat(file)
+        ctype = content_type(file)
+        encoding, source, source_stat = None, file, stat
+        vary = ''
+        if self.compression and is_compressible(ctype):
+            vary = 'Accept-Encoding'
+            encoding, source, source_stat = self.select_encoding(
+                file, stat, request)
+        etag = make_etag(source_stat or stat, encoding)
+        last_modified = httpdate(
+            datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+        cache_control = self.cache_control_for(request.address)
+        validators = {'Content-Type': ctype,
+                      'Content-Encoding': encoding or '',
+                      'Accept-Ranges': 'bytes',
+                      'Vary': vary,
+                      'Last-Modified': last_modified,
+                      'ETag': etag,
+                      'Cache-Control': cache_control}
+        if not_modified(request, stat, etag):
+            return make_answer(code=HTTPStatus.NOT_MODIFIED,
+                               keep_alive=keep_alive,
+                               extra={'Vary': vary,
+                                      'Last-Modified': last_modified,
+                                      'ETag': etag,
+                                      'Cache-Control': cache_control})
+        range_header = (request.headers or {}).get('range')
+        if (source and range_header and request.method == 'GET'
+                and if_range_matches(request, etag, last_modified)):
+            size = source_stat.st_size
+            ranges = parse_ranges(range_header, size)
+            if ranges == []:
+                return make_answer(
+                    code=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                    keep_alive=keep_alive,
+                    extra={'Content-Range': f'bytes */{size}'})
+            if ranges:
+                return self.mapped(
+                    make_range_answer(source, size, ranges,
+                                      keep_alive=keep_alive,
+                                      extra=validators), source, source_stat)
+        if source is None:  # compressed on the fly
+            key = f'{file}:{encoding}'
+        elif (self.cache is not None
+                and source_stat.st_size <= self.cache.max_file_size):
+            key, stat = str(source), source_stat
         else:
-            logging.info(f'No such file {repr(file)}')
-            MyServer.send_answer(
-                make_answer(code=HTTPStatus.NOT_FOUND),
-                client_socket
-            )
+            return self.mapped(
+                make_answer(code=HTTPStatus.OK, file=source,
+                            method=request.method, keep_alive=keep_alive,
+                            extra=validators, size=source_stat.st_size),
+                source, source_stat)
+        entry = self.cache.get(key, stat) if self.cache else None
+        if entry is None:
+            with open(source or file, 'rb') as f:
+                body = f.read()
+            if source is None:
+                body = compress(body, encoding)
+            # status, Server and Content-Type come from status_head()
+            fields = dict(validators, **{'Content-Type': '',
+                                         'Content-Length': len(body),
+                                         'Cache-Control': ''})
+            headers = ''.join(f'{h}: {fields[h]}\r\n'
+                              for h in HTTPhelper.headers
+                              if fields.get(h, '') != '')
+            entry = ResponseCache.entry(stat.st_mtime_ns, stat.st_size,
+                                        headers.encode('utf-8'), body)
+            # a body compressed on the fly is always kept: its file fits,
+            # and making it again is what the cache saves
+            if self.cache and (source is None
+                               or len(body) <= self.cache.max_file_size):
+                self.cache.put(key, stat, entry.headers, body)
+        if cache_control:
+            cache_control = f'Cache-Control: {cache_control}\r\n'
+        connection = 'keep-alive' if keep_alive else 'close'
+        return HTTPhelper.answer(b''.join((
+            status_head(HTTPStatus.OK, ctype), date_header(),
+            entry.headers, cache_control.encode('utf-8'),
+            HTTPhelper.connection_headers[connection],
+            entry.body if request.method == 'GET' else b'')))
+
+    def handle_client_connection(self, client_socket, addr=None,
+                                 queued_at: float or None = None,
+                                 served: int = 0) -> bool:
+        kept = False
+        with self.pool_lock:
+            self.busy_workers += 1
+        try:
+            kept = self.serve_client(client_socket, addr, queued_at, served)
+        finally:
+            with self.pool_lock:
+                self.busy_workers -= 1
+            if self.limits and not kept:
+                self.limits.disconnect(addr)
+        return kept
+
+    def serve_client(self, client_socket, addr=None,
+                     queued_at: float or None = None,
+                     served: int = 0) -> bool:
+        """
+        Serve requests on the connection until it closes. Returns True
+        when the idle connection went to the Idler instead, which queues
+        it again with the count of `served` requests once the next one
+        arrives.
+        """
+        parser = RequestParser(self.chunklen)
+        timings = Timings() if self.slow_log is not None else None
+        if timings is not None and queued_at:
+            timings['queue'] = time.perf_counter() - queued_at
+        if (self.http2 and isinstance(client_socket, ssl.SSLSocket)
+                and client_socket.selected_alpn_protocol() == 'h2'):
+            return self.serve_h2(client_socket, addr, parser)
+        while True:
+            preface = self.http2 and served == 0 and \
+                H2Session.detect(parser.buf)
+            if preface:
+                return self.serve_h2(client_socket, addr, parser)
+            result = None if preface is None else self.answer_next(
+                parser, last=served + 1 >= self.max_requests, addr=addr,
+                timings=timings)
+            if result is None:
+                # between requests a hang-up or keep-alive timeout is fine
+                idle = served > 0 and parser.empty
+                started = time.perf_counter()
+                try:
+                    received = parser.read_from(client_socket)
+                except socket.timeout:
+                    if idle:
+                        break
+                    raise
+                if self.metrics:
+                    self.metrics.observe('otus_stage_seconds',
+                                         time.perf_counter() - started,
+                                         'stage="read"')
+                if not received:
+                    if idle:
+                        break
+                    raise socket.error('Server closed connection')
+                continue
+            served += 1
+            answer, keep_alive = result
+            started = time.perf_counter()
+            MyServer.send_answer(answer, client_socket)
+            observe_stage(self.metrics, timings, 'send',
+                          time.perf_counter() - started)
+            if timings is not None:
+                self.log_slow(addr, timings)
+                timings = Timings()
+            if parser.upgrade:
+                return self.serve_h2(client_socket, addr, parser)
+            if not keep_alive:
+                break
+            if self.idler and parser.empty and not (
+                    isinstance(client_socket, ssl.SSLSocket)
+                    and client_socket.pending()):
+                self.idler.add(client_socket, addr, served)
+                return True
+            client_socket.settimeout(self.keepalive_timeout)
         client_socket.close()
+        return False
+
+    def serve_h2(self, client_socket, addr, parser: RequestParser):
+        """
+        Serve the rest of the connection as HTTP/2, which the client chose
+        by ALPN, the prior knowledge preface or an h2c upgrade. Body
+        frames go out while the windows allow, new frames from the client
+        are read in between.
+        """
+        session = H2Session(lambda request: self.h2_answer(request, addr))
+        # polled between frames; select() would fail past FD_SETSIZE
+        readable = selectors.DefaultSelector()
+        readable.register(client_socket, selectors.EVENT_READ)
+        try:
+            session.start(parser.upgrade)
+            parser.upgrade = None
+            session.feed(bytes(parser.buf))
+            while True:
+                if self.draining:
+                    session.close()
+                out = session.pump()
+                if out:
+                    client_socket.sendall(out)
+                if session.finished:
+                    break
+                if session.sending and not (
+                        isinstance(client_socket, ssl.SSLSocket)
+                        and client_socket.pending()) and not \
+                        readable.select(timeout=0):
+                    continue
+                client_socket.settimeout(
+                    self.timeout if session.bodies else
+                    self.keepalive_timeout)
+                try:
+                    data = client_socket.recv(65536)
+                except socket.timeout:
+                    if session.bodies:
+                        raise
+                    session.close()  # idle, say goodbye with GOAWAY
+                    client_socket.sendall(session.pump())
+                    break
+                if not data:
+                    break
+                session.feed(data)
+        finally:
+            session.abort()
+            readable.close()
+            client_socket.close()
 
     def serve_forever(self):
         if not self._bind:
             self.bind_server_socket()
+        if self.access_log:
+            signal.signal(signal.SIGHUP, self.reopen_logs)
+        signal.signal(signal.SIGUSR1, self.toggle_profile)
+        if not self.supervised:
+            signal.signal(signal.SIGUSR2, self.reexec)
+        if self.processes > 1:
+            return self.serve_prefork()
+        signal.signal(signal.SIGTERM, self.drain)
+        if self.access_log and not self.access_log.is_alive():
+            self.access_log.start()  # after fork, threads do not survive it
+        if self.mode == 'events':
+            return self.serve_events()
         self.init_workers()
         logging.info('Starting workers...')
         self.start_workers()
-        logging.info(f'Listening at {self.host}:{self.port}...')
+        if self.tls_context:
+            self.handshaker = Handshaker(
+                self.dispatch, self.timeout, self.metrics,
+                on_drop=self.limits and self.limits.disconnect)
+            self.handshaker.start()
+        if self.keepalive_timeout > 0:
+            self.idler = Idler(self.dispatch, self.keepalive_timeout,
+                               on_drop=self.limits and self.limits.disconnect)
+            self.idler.start()
+        for sock in self.server_sockets:
+            logging.info(f'Listening at {address_name(sock)}...')
+            self.listen_socket(sock)
+        logging.info(f'Serving files from: {self.basedir.absolute()}')
+        # every listener gets its own accept loop, the first one runs here
+        for sock in self.server_sockets[1:]:
+            acceptor = threading.Thread(target=self.accept_loop,
+                                        args=(sock,), daemon=True)
+            acceptor.start()
+            self.acceptors.append(acceptor)
+        self.start_warm_up()
+        self.accept_loop(self.server_sockets[0])
+
+    def accept_loop(self, sock, tick: float = 0.5):
+        """
+        Accept connections on one listener and hand them on. Waiting in
+        a selector lets a loop outside the main thread notice drain();
+        unlike select() it takes descriptors past FD_SETSIZE.
+        """
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(sock, selectors.EVENT_READ)
+            while not (self.__shutdown_request or self.draining):
+                if not selector.select(timeout=tick):
+                    continue
+                client_socket, addr = sock.accept()
+                logging.debug(f'Connected by {repr(addr)}')
+                if self.metrics:
+                    self.metrics.inc('otus_connections_accepted_total')
+                if not self.admit(client_socket, addr):
+                    continue
+                if self.handshaker:
+                    client_socket.setblocking(False)
+                    self.handshaker.add(self.wrap_tls(client_socket), addr)
+                    continue
+                self.dispatch(client_socket, addr)
+        except (OSError, ValueError):
+            if not (self.draining or self.__shutdown_request):
+                raise  # otherwise drain() closed the listening socket
+        finally:
+            selector.close()
+
+    def admit(self, client_socket, addr) -> bool:
+        """
+        Count an accepted connection against its client's limits. One
+        too many is answered 429 at once (plain HTTP) or closed (TLS).
+        """
+        if self.limits is None or self.limits.connect(addr):
+            return True
+        logging.debug(f'Too many connections from {repr(addr)}')
+        if self.metrics:
+            self.metrics.inc('otus_limited_total',
+                             labels='limit="connections"')
+        if self.tls_context:
+            client_socket.close()
+        else:
+            self.shed(client_socket, HTTPStatus.TOO_MANY_REQUESTS)
+        return False
+
+    def wrap_tls(self, client_socket) -> ssl.SSLSocket:
+        """
+        TLS server side of an accepted non-blocking socket, handshake not
+        started yet. Nagle is off: otherwise the first answer waits for
+        the client's delayed ACK of the session tickets.
+        """
+        nodelay(client_socket)
+        return self.tls_context.wrap_socket(client_socket, server_side=True,
+                                            do_handshake_on_connect=False)
+
+    def dispatch(self, client_socket, addr, served: int = 0):
+        """
+        Queue an accepted (and TLS-established) socket, or an idle one
+        whose next request arrived, for the workers, or answer 503 at
+        once if the queue is full.
+        """
+        client_socket.settimeout(self.timeout)
+        try:
+            self.queue.put_nowait((client_socket, addr, time.perf_counter(),
+                                   served))
+        except Full:
+            logging.warning(f'Queue is full, shedding {repr(addr)}')
+            self.shed(client_socket)
+            if self.limits:
+                self.limits.disconnect(addr)
+            return
+        self.scale_workers()
+
+    def serve_events(self, tick: float = 0.5):
+        """
+        Single-threaded event loop: multiplexes all client connections
+        with selectors (epoll on Linux) instead of the Worker pool.
+        """
+        selector = selectors.DefaultSelector()
+        for sock in self.server_sockets:
+            logging.info(f'Listening at {address_name(sock)} (events)...')
+            self.listen_socket(sock)
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
         logging.info(f'Serving files from: {self.basedir.absolute()}')
-        self.server_socket.listen(5)
+        connections = self.connections
+        self.start_warm_up()
+        listening = True
+        try:
+            while not self.__shutdown_request:
+                if self.draining:
+                    if listening:
+                        for sock in self.server_sockets:
+                            selector.unregister(sock)
+                            sock.close()
+                        listening = False
+                    for conn in list(connections.values()):
+                        if conn.idle:
+                            conn.close()
+                            self.update_connection(selector, connections,
+                                                   conn)
+                    if not connections:
+                        break
+                    if time.monotonic() > self.drain_deadline:
+                        logging.error(f'{len(connections)} connections did '
+                                      f'not finish in time')
+                        break
+                for key, mask in selector.select(timeout=tick):
+                    if key.data is None:
+                        self.accept_connections(selector, connections,
+                                                key.fileobj)
+                        continue
+                    conn = key.data
+                    if mask & selectors.EVENT_READ:
+                        conn.on_readable()
+                    elif mask & selectors.EVENT_WRITE:
+                        conn.on_writable()
+                    self.update_connection(selector, connections, conn)
+                self.sweep_connections(selector, connections)
+        finally:
+            for conn in list(connections.values()):
+                conn.close()
+            selector.close()
+
+    def accept_connections(self, selector, connections, sock):
+        while True:
+            try:
+                client_socket, addr = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:  # listening socket closed by close()
+                return
+            logging.debug(f'Connected by {repr(addr)}')
+            if self.metrics:
+                self.metrics.inc('otus_connections_accepted_total')
+            if not self.admit(client_socket, addr):
+                continue
+            client_socket.setblocking(False)
+            if self.tls_context:
+                client_socket = self.wrap_tls(client_socket)
+            conn = Connection(client_socket, addr, self.answer_next,
+                              max_requests=self.max_requests,
+                              metrics=self.metrics,
+                              h2_handler=self.http2 and self.h2_answer,
+                              on_close=self.limits and self.limits.disconnect,
+                              slow_log=self.slow_log is not None
+                              and self.log_slow)
+            connections[conn.fd] = conn
+            selector.register(conn.fd, conn.events, conn)
+
+    @staticmethod
+    def update_connection(selector, connections, conn):
+        if conn.state == Connection.CLOSED:
+            connections.pop(conn.fd, None)
+            try:
+                selector.unregister(conn.fd)
+            except (KeyError, ValueError):
+                pass
+            return
+        if selector.get_key(conn.fd).events != conn.events:
+            selector.modify(conn.fd, conn.events, conn)
+
+    def sweep_connections(self, selector, connections):
+        now = time.monotonic()
+        for conn in list(connections.values()):
+            limit = self.keepalive_timeout if conn.idle else self.timeout
+            if conn.last_active < now - limit:
+                logging.debug(f'Connection {conn.addr} timed out')
+                conn.close()
+                MyServer.update_connection(selector, connections, conn)
+
+    def serve_prefork(self):
+        """
+        Pre-fork supervisor: runs `processes` copies of the server in
+        child processes and restarts the ones that die. Every child
+        listens on its own SO_REUSEPORT socket, so the kernel spreads
+        connections between them; without SO_REUSEPORT the children
+        share the inherited listening socket.
+        """
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        for sock in self.server_sockets:
+            if not self.own_socket(sock):
+                self.listen_socket(sock)
+        logging.info(f'Starting {self.processes} processes...')
+        for _ in range(self.processes):
+            self.spawn_process()
+        self.notify_ready()
         while not self.__shutdown_request:
-            client_socket, addr = self.server_socket.accept()
-            logging.info(f'Connected by {repr(addr)}')
-            client_socket.settimeout(self.timeout)
-            self.queue.put((client_socket, addr))
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.__shutdown_request:
+                continue
+            logging.error(f'Process {pid} died with exit code '
+                          f'{os.waitstatus_to_exitcode(status)}, restarting')
+            if time.monotonic() - started < 1.0:  # don't respawn in a loop
+                time.sleep(1.0)
+            self.spawn_process()
+
+    def own_socket(self, sock) -> bool:
+        """
+        Whether every child binds a SO_REUSEPORT socket of its own for
+        this listener rather than sharing the supervisor's one.
+        """
+        return self.reuse_port and sock.family != socket.AF_UNIX
+
+    def spawn_process(self) -> int:
+        sockets = []
+        for sock in self.server_sockets:
+            if self.own_socket(sock):
+                # listening before the fork, so that connections queue up
+                # for the child from the moment the supervisor reports ready
+                own = self.make_server_socket(sock.family)
+                own.bind(sock.getsockname())
+                self.listen_socket(own)
+                sock = own
+            sockets.append(sock)
+        pid = os.fork()
+        if pid:
+            for sock in sockets:
+                if sock not in self.server_sockets:
+                    sock.close()
+            self.children[pid] = time.monotonic()
+            return pid
+        exit_code = 0
+        try:
+            self.children = {}
+            self.processes = 1
+            self.ready_fd = None
+            self.supervised = True  # SIGUSR2 goes to the supervisor
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            for sock in self.server_sockets:
+                if sock not in sockets:
+                    sock.close()
+            self.server_sockets = sockets
+            logging.info(f'Process {os.getpid()} started')
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except Exception as exc:
+            logging.error(f'Process {os.getpid()} crashed. Error: {exc}')
+            exit_code = 1
+        finally:
+            self.close()
+            os._exit(exit_code)
+
+    def stop_processes(self, timeout: float = 5.0):
+        if not self.children:
+            return
+        logging.info('Stopping processes...')
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + timeout
+        while self.children and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                time.sleep(0.05)
+                continue
+            self.children.pop(pid, None)
+        for pid in self.children:
+            logging.error(f'Process {pid} did not stop in time, killing')
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.children = {}
+
+    def drain(self, *args):
+        """
+        SIGTERM handler: stop accepting, finish the requests in flight
+        (answering them with Connection: close) and exit, at the latest
+        after drain_timeout seconds.
+        """
+        if self.draining:
+            return
+        logging.info('Draining connections...')
+        self.draining = True
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        if self.mode == 'threads':
+            # wakes up the accept loops; the event loop closes the
+            # sockets itself
+            for sock in self.server_sockets:
+                sock.close()
+            if self.idler:  # idle keep-alive connections are closed
+                self.idler.stop()
+
+    def reexec(self, *args):
+        """
+        SIGUSR2 handler: start a new server from the same command line on
+        the inherited listening socket. Once it reports ready, this
+        process drains and exits, so no connection is refused meanwhile.
+        """
+        if self.draining or self.successor:
+            return
+        read_fd, write_fd = os.pipe()
+        fds = [sock.fileno() for sock in self.server_sockets]
+        env = dict(os.environ, OTUS_LISTEN_FD=','.join(map(str, fds)),
+                   OTUS_READY_FD=str(write_fd))
+        logging.info('Starting a new server process...')
+        try:
+            self.successor = subprocess.Popen(
+                [sys.executable] + sys.argv, env=env,
+                pass_fds=fds + [write_fd])
+        except OSError as exc:
+            logging.error(f'Cannot start a new server process: {exc}')
+            os.close(read_fd)
+            return
+        finally:
+            os.close(write_fd)
+        threading.Thread(target=self.await_successor, args=(read_fd,),
+                         daemon=True).start()
+
+    def await_successor(self, read_fd: int, timeout: float = 10.0):
+        # a selector, as select() fails for descriptors past FD_SETSIZE
+        with selectors.DefaultSelector() as selector:
+            selector.register(read_fd, selectors.EVENT_READ)
+            ready = selector.select(timeout) and os.read(read_fd, 1)
+        os.close(read_fd)
+        if not ready:
+            logging.error('New server process did not start, '
+                          'keeping this one')
+            self.successor.kill()
+            self.successor.wait()
+            self.successor = None
+            return
+        logging.info(f'Process {self.successor.pid} took over')
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def start_warm_up(self):
+        """
+        Warm up the preload manifest's files in the background while
+        accepting connections. Ready is reported once warm, or after
+        `warm_up_limit` seconds for a reexec() parent waiting for it.
+        """
+        if not self.preload:
+            self.warm.set()
+            self.notify_ready()
+            return
+        threading.Thread(target=self.warm_up, daemon=True).start()
+        threading.Thread(target=self.await_warm_up, daemon=True).start()
+
+    def await_warm_up(self):
+        self.warm.wait(self.warm_up_limit)
+        self.notify_ready()
+
+    def preload_urls(self) -> list:
+        """
+        URL paths of the files and directories the manifest's globs
+        match under the root, without the proxied ones.
+        """
+        root = str(self.basedir)
+        urls = []
+        for pattern in self.preload:
+            pattern = os.path.join(glob.escape(root), pattern.lstrip('/'))
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                url = '/' + os.path.relpath(path, root).replace(os.sep, '/')
+                url = '/' if url == '/.' else url
+                if os.path.isdir(path) and not url.endswith('/'):
+                    url += '/'
+                if not any(url.startswith(route[0])
+                           for route in self.proxy_routes):
+                    urls.append(url)
+        return list(dict.fromkeys(urls))
+
+    def warm_up(self):
+        """
+        Resolve and stat the preloaded files, have the kernel read them
+        ahead and fill the path, response and mmap caches by answering a
+        GET for every content coding.
+        """
+        started = time.monotonic()
+        files = size = 0
+        codings = list(HTTPhelper.encodings) + ['identity'] \
+            if self.compression else ['identity']
+        for url in self.preload_urls():
+            if self.draining:
+                break
+            try:
+                file, stat = self.resolve_path(
+                    HTTPhelper.request('GET', url, 'HTTP/1.1'))
+                if not stat or not stat_mode.S_ISREG(stat.st_mode):
+                    continue
+                size += readahead(file)
+                compressible = (is_compressible(content_type(file)) and
+                                stat.st_size >= HTTPhelper.compress_min_size)
+                for coding in codings if compressible else ['identity']:
+                    answer, _ = self.process_request(HTTPhelper.request(
+                        'GET', url, 'HTTP/1.1', None,
+                        {'accept-encoding': coding}))
+                    if answer.file and str(answer.file) != str(file):
+                        readahead(answer.file)  # precompressed sibling
+                    if answer.stream:
+                        answer.stream.close()
+                files += 1
+            except OSError as exc:
+                logging.debug(f'Cannot preload {url}: {exc}')
+        self.warm.set()
+        logging.info(f'Warmed up {files} files ({size >> 20} MB) in '
+                     f'{time.monotonic() - started:.2f}s')
+
+    def notify_ready(self):
+        """
+        Tell the process that started this one by reexec() that this one
+        accepts connections now.
+        """
+        if self.ready_fd is None:
+            return
+        os.write(self.ready_fd, b'1')
+        os.close(self.ready_fd)
+        self.ready_fd = None
+
+    def reopen_logs(self, *args):
+        """
+        SIGHUP handler: reopen the access log here and in the children.
+        """
+        self.access_log.reopen()
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
 
     def close(self):
         logging.info('Got a shutdown request...')
+        if self.cache is not None and not self.children:
+            logging.info(f'Response cache: {self.cache.stats()}')
         self.__shutdown_request = True
-        self.server_socket.close()
-        self.stop_workers()
+        for sock in self.server_sockets:
+            sock.close()
+        for acceptor in self.acceptors:  # nothing gets queued after this
+            acceptor.join(timeout=1.0)
+        self.stop_processes(self.drain_timeout + 1.0)
+        if self.handshaker:
+            self.handshaker.close()
+        if self.idler:
+            self.idler.close()
+        if self.lingerer:
+            self.lingerer.close()
+        self.stop_workers(self.drain_deadline)
+        if self.access_log:
+            self.access_log.close()
+        for _, upstreams, _ in self.proxy_routes:
+            for upstream in upstreams:
+                upstream.close()
 
 
 if __name__ == '__main__':
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("--listen", action="append", default=[], metavar='ADDR',
+                  help='PORT, HOST:PORT, [IPV6]:PORT or unix:PATH, '
+                       'repeatable; replaces host and -p')
+    op.add_option("--backlog", action="store", type=int,
+                  default=socket.SOMAXCONN)
+    op.add_option("--nodelay", action="store_true", default=False,
+                  help='disable Nagle on accepted TCP connections')
+    op.add_option("--defer-accept", action="store", type=int, default=0,
+                  metavar='SECONDS', help='TCP_DEFER_ACCEPT: wake up only '
+                                          'when the request arrives')
+    op.add_option("--fastopen", action="store", type=int, default=0,
+                  metavar='QLEN', help='TCP Fast Open queue length')
     op.add_option("-r", "--root", action="store", type='string', default='.')
-    op.add_option("-w", "--workers", action="store", type=int, default=3)
+    op.add_option("-w", "--workers", action="store", type=int, default=3,
+                  help='maximum worker threads')
+    op.add_option("--min-workers", action="store", type=int, default=1,
+                  help='worker threads kept when idle')
+    op.add_option("-q", "--queue-size", action="store", type=int,
+                  default=128, help='accepted sockets waiting for a worker '
+                                    'before 503 answers')
     op.add_option("-t", "--timeout", action="store", type=float, default=3.0)
     op.add_option("-l", "--log", action="store", default=None)
     op.add_option("-v", "--level", action="store", type=int, default=None)
+    op.add_option("-m", "--mode", action="store", type='choice',
+                  choices=MyServer.modes, default='threads')
+    op.add_option("-n", "--processes", action="store", type=int, default=1)
+    op.add_option("-k", "--keepalive", action="store", type=float,
+                  default=5.0)
+    op.add_option("--max-requests", action="store", type=int, default=100)
+    op.add_option("-d", "--drain", action="store", type=float, default=30.0,
+                  help='seconds to finish requests in flight on SIGTERM')
+    op.add_option("-c", "--cache", action="store", type=int, default=32,
+                  help='response cache size in MB, 0 disables it')
+    op.add_option("--mmap", action="store", type=int, default=0,
+                  metavar='MB', help='map files of 1 MB and more into a '
+                                     'shared cache of this size')
+    op.add_option("--cache-control", action="append", default=[],
+                  metavar='PREFIX=VALUE',
+                  help='Cache-Control value for URLs under PREFIX')
+    op.add_option("--no-compress", action="store_false", dest="compress",
+                  default=True, help='disable gzip/brotli content coding')
+    op.add_option("--stat-ttl", action="store", type=float, default=1.0,
+                  help='seconds to reuse resolved paths and stat results, '
+                       '0 disables it')
+    op.add_option("--tls-cert", action="store", default=None,
+                  metavar='FILE', help='serve HTTPS with this certificate')
+    op.add_option("--tls-key", action="store", default=None, metavar='FILE')
+    op.add_option("--make-cert", action="store_true", default=False,
+                  help='write a self-signed --tls-cert/--tls-key and exit')
+    op.add_option("--proxy", action="append", default=[],
+                  metavar='PREFIX=URL[,URL]', help='forward URLs under '
+                  'PREFIX to http:// upstreams, repeatable')
+    op.add_option("--proxy-connect-timeout", action="store", type=float,
+                  default=1.0)
+    op.add_option("--proxy-read-timeout", action="store", type=float,
+                  default=30.0)
+    op.add_option("--proxy-pool", action="store", type=int, default=32,
+                  help='idle connections kept per upstream')
+    op.add_option("--http2", action="store_true", default=False,
+                  help='serve HTTP/2 too: ALPN with TLS, h2c otherwise '
+                       '(needs the h2 package)')
+    op.add_option("--max-conns", action="store", type=int, default=0,
+                  help='connections open per client address, 0 for no '
+                       'limit')
+    op.add_option("--max-subnet-conns", action="store", type=int,
+                  default=0, help='connections open per /24 (IPv6: /64)')
+    op.add_option("--rate", action="store", type=float, default=0.0,
+                  help='requests per second per client address')
+    op.add_option("--rate-burst", action="store", type=int, default=20)
+    op.add_option("--bandwidth", action="store", type=int, default=0,
+                  metavar='KB', help='answer KB per second per client '
+                                     'address')
+    op.add_option("--slow-log", action="store", type=float, default=None,
+                  metavar='SECONDS', help='log requests taking longer, '
+                                          'with their stage timings')
+    op.add_option("--profile", action="store", default=None, metavar='PATH',
+                  help='URL path that starts and stops the profiler, for '
+                       'local clients')
+    op.add_option("--profile-dir", action="store", default=None,
+                  metavar='DIR', help='where SIGUSR1 or --profile write '
+                                      'profiles (default: temp dir)')
+    op.add_option("--profile-seconds", action="store", type=float,
+                  default=10.0)
+    op.add_option("--preload", action="store", default=None, metavar='FILE',
+                  help='warm up the files of this manifest at startup, one '
+                       'URL path or glob a line')
+    op.add_option("--preload-log", action="store", default=None,
+                  metavar='FILE', help='warm up the most requested files '
+                                       'of this access log')
+    op.add_option("--preload-top", action="store", type=int, default=1000,
+                  help='paths taken from --preload-log')
+    op.add_option("--autoindex", action="store_true", default=False,
+                  help="list directories that have no index.html")
+    op.add_option("--metrics", action="store", default=None, metavar='PATH',
+                  help='serve Prometheus metrics at this URL path')
+    op.add_option("--access-log", action="store", default=None,
+                  metavar='FILE', help='write an access log, reopened on '
+                                       'SIGHUP')
+    op.add_option("--access-log-format", action="store", type='choice',
+                  choices=AccessLog.formats, default='combined')
+    op.add_option("--access-log-buffer", action="store", type=int,
+                  default=8192, help='lines held before dropping')
+    op.add_option("--access-log-block", action="store_true", default=False,
+                  help='wait for the writer instead of dropping lines')
+    op.add_option("--precompress", action="store_true", default=False,
+                  help='write .gz/.br siblings under --root and exit')
     (opts, args) = op.parse_args()
     logging.basicConfig(
         filename=opts.log, level=opts.level or logging.INFO,
         format='[%(asctime)s] %(levelname).1s %(message)s',
         datefmt='%Y.%m.%d %H:%M:%S'
     )
+    if opts.precompress:
+        logging.info(f'{precompress(opts.root)} files precompressed')
+        raise SystemExit
+    if opts.make_cert:
+        make_self_signed(opts.tls_cert or 'cert.pem',
+                         opts.tls_key or 'key.pem')
+        raise SystemExit
+    tls_context = None
+    if opts.tls_cert:
+        tls_context = make_tls_context(opts.tls_cert,
+                                       opts.tls_key or opts.tls_cert)
+    # set by reexec() of the server being replaced
+    listen_fds = os.environ.pop('OTUS_LISTEN_FD', None)
+    ready_fd = os.environ.pop('OTUS_READY_FD', None)
+    preload = read_manifest(opts.preload) if opts.preload else []
+    if opts.preload_log:
+        preload += top_paths(opts.preload_log, opts.preload_top)
+    limits = None
+    if (opts.max_conns or opts.max_subnet_conns or opts.rate
+            or opts.bandwidth):
+        limits = ClientLimits(opts.max_conns, opts.max_subnet_conns,
+                              opts.rate, opts.rate_burst,
+                              opts.bandwidth << 10)
+    access_log = None
+    if opts.access_log:
+        access_log = AccessLog(opts.access_log, fmt=opts.access_log_format,
+                               capacity=opts.access_log_buffer,
+                               block=opts.access_log_block)
     server = MyServer(host=args[0] if len(args) else '', port=opts.port,
                       max_workers=opts.workers,
-                      timeout=opts.timeout, basedir=opts.root)
+                      timeout=opts.timeout, basedir=opts.root,
+                      mode=opts.mode, processes=opts.processes,
+                      keepalive_timeout=opts.keepalive,
+                      max_requests=opts.max_requests,
+                      cache_size=opts.cache << 20,
+                      cache_control=dict(rule.split('=', 1)
+                                         for rule in opts.cache_control),
+                      compression=opts.compress,
+                      metrics_path=opts.metrics,
+                      access_log=access_log,
+                      stat_ttl=opts.stat_ttl,
+                      min_workers=opts.min_workers,
+                      queue_size=opts.queue_size,
+                      mmap_size=opts.mmap << 20,
+                      drain_timeout=opts.drain,
+                      listen_fds=listen_fds and [
+                          int(fd) for fd in listen_fds.split(',')],
+                      ready_fd=ready_fd and int(ready_fd),
+                      tls_context=tls_context,
+                      autoindex=opts.autoindex,
+                      listen=opts.listen, backlog=opts.backlog,
+                      nodelay=opts.nodelay,
+                      defer_accept=opts.defer_accept,
+                      fastopen=opts.fastopen,
+                      proxy={prefix: urls.split(',') for prefix, urls in (
+                          route.split('=', 1) for route in opts.proxy)},
+                      proxy_connect_timeout=opts.proxy_connect_timeout,
+                      proxy_read_timeout=opts.proxy_read_timeout,
+                      proxy_pool=opts.proxy_pool,
+                      http2=opts.http2, preload=preload, limits=limits,
+                      slow_log=opts.slow_log, profile_path=opts.profile,
+                      profile_dir=opts.profile_dir,
+                      profile_seconds=opts.profile_seconds)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
@@ -3,6 +3,7 @@
 import sys
 v3 = sys.version_info[0] == 3
 
+import os
 import re
 import socket
 if v3:
@@ -12,8 +13,9 @@ else:
 import unittest
 
 class HttpServer(unittest.TestCase):
-  host = "localhost"
-  port = 80
+  # HTTPTEST_PORT=8080 python httptest.py tests a server run without root
+  host = os.environ.get("HTTPTEST_HOST", "localhost")
+  port = int(os.environ.get("HTTPTEST_PORT", 80))
 
   def setUp(self):
     self.conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
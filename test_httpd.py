@@ -0,0 +1,1172 @@
+#!/usr/bin/env python
+"""
+Unit tests for httpd.py and checks against a running server.
+
+    python -m unittest test_httpd
+
+The server checks start httpd.py on a free local port (see
+benchmark.start_server), so they need no root and no running server;
+httptest.py is the suite for a server started by hand.
+"""
+import http.client
+import json
+import os
+import re
+import resource
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import httpd
+from benchmark import free_port, start_backend, start_server
+
+
+def receive_all(sock, timeout: float = 2.0) -> bytes:
+    """
+    Everything the server sends until it closes the connection. Raises
+    socket.timeout if it keeps the connection open longer than timeout.
+    """
+    sock.settimeout(timeout)
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+
+class TestParseRanges(unittest.TestCase):
+
+    def test_single_ranges(self):
+        self.assertEqual(httpd.parse_ranges('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(httpd.parse_ranges('bytes=990-', 1000),
+                         [(990, 999)])
+        self.assertEqual(httpd.parse_ranges('bytes=-10', 1000),
+                         [(990, 999)])
+        self.assertEqual(httpd.parse_ranges('bytes=900-5000', 1000),
+                         [(900, 999)])
+        self.assertEqual(httpd.parse_ranges('bytes=-5000', 1000),
+                         [(0, 999)])
+
+    def test_multiple_ranges_are_sorted_and_merged(self):
+        self.assertEqual(httpd.parse_ranges('bytes=500-599, 0-99', 1000),
+                         [(0, 99), (500, 599)])
+        self.assertEqual(httpd.parse_ranges('bytes=0-99,100-199,150-300',
+                                            1000), [(0, 300)])
+        self.assertEqual(httpd.parse_ranges('bytes=0-9,2000-3000', 1000),
+                         [(0, 9)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(httpd.parse_ranges('bytes=1000-', 1000), [])
+        self.assertEqual(httpd.parse_ranges('bytes=-0', 1000), [])
+
+    def test_empty_file(self):
+        """no range of an empty file is satisfiable"""
+        self.assertEqual(httpd.parse_ranges('bytes=-5', 0), [])
+        self.assertEqual(httpd.parse_ranges('bytes=0-', 0), [])
+        self.assertEqual(httpd.parse_ranges('bytes=0-0,-1', 0), [])
+
+    def test_ignored(self):
+        self.assertIsNone(httpd.parse_ranges('items=0-9', 1000))
+        self.assertIsNone(httpd.parse_ranges('bytes=abc', 1000))
+        self.assertIsNone(httpd.parse_ranges('bytes=9-0', 1000))
+        self.assertIsNone(httpd.parse_ranges('bytes=1-2-3', 1000))
+        too_many = ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(
+            httpd.HTTPhelper.max_ranges + 1))
+        self.assertIsNone(httpd.parse_ranges(f'bytes={too_many}', 1000))
+
+
+class TestNotModified(unittest.TestCase):
+    stat = os.stat_result((0o100644, 1, 1, 1, 0, 0, 100,
+                           1600000000, 1600000000, 1600000000))
+    etag = '"1-5f5e1000-64"'
+
+    def check(self, **headers) -> bool:
+        request = httpd.HTTPhelper.request('GET', '/', 'HTTP/1.1', None,
+                                           headers)
+        return httpd.not_modified(request, self.stat, self.etag)
+
+    def test_if_none_match(self):
+        self.assertTrue(self.check(**{'if-none-match': self.etag}))
+        self.assertTrue(self.check(**{'if-none-match': '"x", ' + self.etag}))
+        self.assertTrue(self.check(**{'if-none-match': 'W/' + self.etag}))
+        self.assertTrue(self.check(**{'if-none-match': '*'}))
+        self.assertFalse(self.check(**{'if-none-match': '"other"'}))
+
+    def test_if_modified_since(self):
+        self.assertTrue(self.check(
+            **{'if-modified-since': 'Sun, 13 Sep 2020 12:26:40 GMT'}))
+        self.assertTrue(self.check(
+            **{'if-modified-since': 'Mon, 14 Sep 2020 00:00:00 GMT'}))
+        self.assertFalse(self.check(
+            **{'if-modified-since': 'Sun, 13 Sep 2020 12:26:39 GMT'}))
+        self.assertFalse(self.check(**{'if-modified-since': 'yesterday'}))
+        self.assertFalse(self.check())
+
+    def test_if_none_match_wins(self):
+        self.assertFalse(self.check(
+            **{'if-none-match': '"other"',
+               'if-modified-since': 'Mon, 14 Sep 2020 00:00:00 GMT'}))
+
+
+class TestListDirectory(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.directory = httpd.Path(root.name)
+        for i in range(25):
+            (self.directory / f'f{i:02}.txt').write_bytes(b'x' * i)
+
+    def listing(self, query: str) -> str:
+        return b''.join(httpd.list_directory(
+            self.directory, '/d/', query, page_size=5,
+            max_sorted_pages=2)).decode('utf-8')
+
+    def names(self, query: str) -> list:
+        return re.findall(r'>(f\d+\.txt)<', self.listing(query))
+
+    def test_sorted_pages(self):
+        self.assertEqual(self.names('page=2'),
+                         [f'f{i:02}.txt' for i in range(5, 10)])
+        self.assertEqual(self.names('sort=size&order=desc'),
+                         [f'f{i:02}.txt' for i in range(24, 19, -1)])
+        self.assertIn('Entries 1-5 of 25', self.listing(''))
+        self.assertIn('page=2">next', self.listing(''))
+
+    def test_deep_sorted_page_is_capped(self):
+        """a huge page number does not hold the whole directory"""
+        held = []
+        nsmallest = httpd.heapq.nsmallest
+        with mock.patch.object(httpd.heapq, 'nsmallest',
+                               lambda n, *args, **kwargs: held.append(n)
+                               or nsmallest(n, *args, **kwargs)):
+            listing = self.listing('page=999999')
+        self.assertEqual(held, [10])
+        self.assertIn('Entries 6-10 of 25', listing)
+        self.assertIn('href="?sort=none">unsorted', listing)
+
+    def test_unsorted_pages_go_all_the_way(self):
+        self.assertEqual(len(self.names('sort=none&page=5')), 5)
+        self.assertEqual(self.names('sort=none&page=6'), [])
+        self.assertEqual(len({name for page in range(1, 6) for name in
+                              self.names(f'sort=none&page={page}')}), 25)
+
+
+class TestAccessLog(unittest.TestCase):
+
+    def format(self, head: str, fmt: str = 'combined') -> str:
+        log = httpd.AccessLog(os.devnull, fmt)
+        return log.format(('10.0.0.1', 0, httpd.get_request(head),
+                           '200', 34))
+
+    def test_line(self):
+        with mock.patch.dict(os.environ, {'TZ': 'UTC'}):
+            httpd.time.tzset()
+            line = self.format('GET /a%20b?x=1 HTTP/1.1\r\nReferer: /r\r\n'
+                               'User-Agent: curl/8')
+        httpd.time.tzset()
+        self.assertEqual(line, '10.0.0.1 - - [01/Jan/1970:00:00:00 +0000] '
+                               '"GET /a%20b?x=1 HTTP/1.1" 200 34 "/r" '
+                               '"curl/8"\n')
+        self.assertEqual(self.format('HEAD / HTTP/1.0', 'common')
+                         .partition('] ')[2], '"HEAD / HTTP/1.0" 200 34\n')
+
+    def test_no_forged_lines(self):
+        """encoded and control characters cannot start a new line"""
+        line = self.format('GET /x%0A6.6.6.6%20-%20-%20[x]%20%22GET%20/admin'
+                           '%20HTTP/1.1%22%20200%201 HTTP/1.1\r\n'
+                           'Referer: a"b\\c\r\nUser-Agent: x\ny\tz\x7f')
+        self.assertEqual(line.count('\n'), 1)
+        self.assertIn('"GET /x%0A6.6.6.6%20-%20-%20[x]%20%22GET', line)
+        self.assertTrue(line.endswith(' "a\\x22b\\x5Cc" "x\\x0Ay\\x09z'
+                                      '\\x7F"\n'))
+
+    def test_top_paths(self):
+        lines = [self.format(f'GET {path} HTTP/1.1')
+                 for path in ('/a%20b.css', '/a%20b.css?v=2', '/c[1].js')]
+        lines.append(self.format('GET /x%0A1.2.3.4%20-%20-%20[x]%20%22GET'
+                                 '%20/admin%20HTTP/1.1%22%20200%201 HTTP/1.1'))
+        with tempfile.NamedTemporaryFile('w', suffix='.log') as f:
+            f.writelines(lines)
+            f.flush()
+            self.assertEqual(httpd.top_paths(f.name, top=2),
+                             ['/a b.css', '/c[[]1].js'])
+            self.assertNotIn('/admin', httpd.top_paths(f.name))
+
+
+class TestClientLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(httpd.time, 'monotonic',
+                                    lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connections_per_client_and_subnet(self):
+        limits = httpd.ClientLimits(max_conns=2, max_subnet_conns=3)
+        a, b = ('10.0.0.1', 1), ('10.0.0.2', 1)
+        self.assertTrue(limits.connect(a))
+        self.assertTrue(limits.connect(a))
+        self.assertFalse(limits.connect(a))
+        self.assertTrue(limits.connect(b))
+        self.assertFalse(limits.connect(b))  # the /24 is full
+        self.assertTrue(limits.connect(('10.0.1.1', 1)))
+        limits.disconnect(a)
+        self.assertTrue(limits.connect(b))
+        self.assertTrue(limits.connect('/run/otus.sock'))
+
+    def test_request_bucket(self):
+        limits = httpd.ClientLimits(rate=2, burst=3)
+        addr = ('10.0.0.1', 1)
+        self.assertEqual([limits.allow(addr) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limits.allow(addr), 0.5)
+        self.now += 0.5
+        self.assertEqual(limits.allow(addr), 0)
+        self.assertAlmostEqual(limits.allow(addr), 0.5)
+        self.now += 10  # refills up to the burst only
+        self.assertEqual([limits.allow(addr) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(limits.allow(addr), 0)
+        self.assertEqual(limits.allow(('10.0.0.2', 1)), 0)
+
+    def test_bandwidth_debt(self):
+        limits = httpd.ClientLimits(bandwidth=1000)
+        addr = ('10.0.0.1', 1)
+        self.assertEqual(limits.allow(addr), 0)
+        limits.charge(addr, 3000)  # a big answer goes out in full
+        self.assertAlmostEqual(limits.allow(addr), 2.0)
+        self.now += 2
+        self.assertEqual(limits.allow(addr), 0)
+
+    def test_table_is_bounded(self):
+        limits = httpd.ClientLimits(rate=1, burst=1, max_entries=10)
+        for i in range(100):
+            limits.allow((f'10.0.{i}.1', 1))
+        self.assertEqual(len(limits.entries), 10)
+
+
+class RootTestCase(unittest.TestCase):
+    """
+    An unbound MyServer with `options` on a temporary root.
+    """
+    options = {}
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.server = httpd.MyServer('127.0.0.1', 0, basedir=self.root.name,
+                                     bind=False, **self.options)
+        self.addCleanup(lambda: [sock.close()
+                                 for sock in self.server.server_sockets])
+
+    def make_file(self, name: str, size: int, fill: bytes = b'a') -> tuple:
+        path = os.path.join(self.root.name, name)
+        with open(path, 'wb') as f:
+            f.write(fill * size)
+        return httpd.Path(path), os.stat(path)
+
+
+class TestResponseCache(RootTestCase):
+
+    @staticmethod
+    def stat(mtime: int = 1, size: int = 10) -> SimpleNamespace:
+        return SimpleNamespace(st_mtime_ns=mtime, st_size=size)
+
+    def test_validated_by_mtime_and_size(self):
+        cache = httpd.ResponseCache(1000)
+        cache.put('/a', self.stat(), b'h', b'body')
+        self.assertEqual(cache.get('/a', self.stat()).body, b'body')
+        self.assertIsNone(cache.get('/a', self.stat(mtime=2)))
+        self.assertIsNone(cache.get('/a', self.stat(size=11)))
+        self.assertIsNone(cache.get('/b', self.stat()))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_lru_eviction_and_byte_accounting(self):
+        cache = httpd.ResponseCache(100, max_file_size=50)
+        for key in ('/a', '/b'):
+            cache.put(key, self.stat(), b'h' * 10, b'x' * 30)
+        self.assertEqual(cache.total_bytes, 80)
+        cache.get('/a', self.stat())  # /b is now the least recently used
+        cache.put('/c', self.stat(), b'h' * 10, b'x' * 30)
+        self.assertEqual(list(cache.entries), ['/a', '/c'])
+        self.assertEqual((cache.total_bytes, cache.evictions), (80, 1))
+        cache.put('/a', self.stat(), b'', b'x' * 5)  # replaced in place
+        self.assertEqual(cache.stats()['bytes'], 45)
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(httpd.ResponseCache(20).max_file_size, 20)
+
+    def test_changed_file_is_read_again(self):
+        file, stat = self.make_file('a.bin', 10)
+        request = httpd.HTTPhelper.request('GET', '/a.bin', 'HTTP/1.1')
+
+        def body() -> bytes:
+            answer = self.server.file_answer(file, request, False)
+            return answer.data.partition(b'\r\n\r\n')[2]
+
+        self.assertEqual(body(), b'a' * 10)
+        self.assertEqual(body(), b'a' * 10)
+        self.assertEqual(self.server.cache.hits, 1)
+        self.make_file('a.bin', 12, b'b')  # new size
+        self.assertEqual(body(), b'b' * 12)
+        with open(file, 'r+b') as f:  # same size, new mtime
+            f.write(b'c' * 12)
+        os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(body(), b'c' * 12)
+        self.assertEqual(self.server.cache.stats()['entries'], 1)
+
+
+class TestPathCache(RootTestCase):
+
+    def setUp(self):
+        super().setUp()
+        clock = mock.patch.object(httpd.time, 'monotonic', return_value=100.0)
+        self.clock = clock.start()
+        self.addCleanup(clock.stop)
+
+    def resolve(self, address: str) -> tuple:
+        return self.server.resolve_path(
+            httpd.HTTPhelper.request('GET', address, 'HTTP/1.1'))
+
+    def test_ttl_and_bound(self):
+        cache = httpd.PathCache(ttl=1.0, max_entries=2)
+        for address in ('/a', '/b'):
+            cache.put(address, None, None)
+        self.clock.return_value = 101.0
+        self.assertIsNotNone(cache.get('/a'))  # /b is now the oldest
+        cache.put('/c', None, None)
+        self.assertEqual(list(cache.entries), ['/a', '/c'])
+        self.clock.return_value = 101.5
+        self.assertIsNone(cache.get('/a'))
+        self.assertNotIn('/a', cache.entries)
+        self.assertIsNotNone(cache.get('/c'))
+
+    def test_missing_file_is_cached_until_stale(self):
+        self.assertEqual(self.resolve('/a.bin')[1], None)
+        self.make_file('a.bin', 10)
+        self.assertEqual(self.resolve('/a.bin')[1], None)  # cached 404
+        self.clock.return_value = 100.0 + self.server.paths.ttl + 0.1
+        file, stat = self.resolve('/a.bin')
+        self.assertEqual((file.name, stat.st_size), ('a.bin', 10))
+
+    def test_escape_is_cached(self):
+        with mock.patch.object(self.server, 'check_file_path',
+                               wraps=self.server.check_file_path) as check:
+            self.assertEqual(self.resolve('/../x'), (None, None))
+            self.assertEqual(self.resolve('/../x'), (None, None))
+        self.assertEqual(check.call_count, 1)  # 403 from the cache
+
+
+class TestMmapCache(RootTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = httpd.MmapCache(300, min_file_size=50)
+
+    def replace(self, name: str, size: int, fill: bytes) -> tuple:
+        """
+        A new file under `name`: mappings of the old one stay valid.
+        """
+        path, _ = self.make_file('new', size, fill)
+        os.replace(path, os.path.join(self.root.name, name))
+        path = httpd.Path(self.root.name, name)
+        return path, os.stat(path)
+
+    def test_size_limits(self):
+        self.assertIsNone(self.cache.get(*self.make_file('small', 49)))
+        self.assertIsNone(self.cache.get(*self.make_file('large', 301)))
+        self.assertEqual(self.cache.stats(), {'files': 0, 'bytes': 0})
+
+    def test_mapping_is_shared(self):
+        file, stat = self.make_file('a', 100)
+        view = self.cache.get(file, stat)
+        self.assertEqual(bytes(view), b'a' * 100)
+        again = self.cache.get(file, stat)
+        self.assertIs(again.obj, view.obj)
+        self.assertEqual(self.cache.stats(), {'files': 1, 'bytes': 100})
+
+    def test_changed_file_replaces_the_mapping(self):
+        old = self.cache.get(*self.replace('a', 100, b'a'))
+        view = self.cache.get(*self.replace('a', 120, b'b'))
+        self.assertEqual(bytes(view), b'b' * 120)
+        self.assertEqual(bytes(old), b'a' * 100)  # still being sent
+        self.assertEqual(self.cache.stats(), {'files': 1, 'bytes': 120})
+
+    def test_lru_eviction(self):
+        files = [self.make_file(name, 100) for name in 'abc']
+        for file, stat in files:
+            self.cache.get(file, stat)
+        self.cache.get(*files[0])  # b is now the oldest
+        self.cache.get(*self.make_file('d', 100))
+        self.assertEqual(list(self.cache.entries),
+                         [os.path.join(self.root.name, name)
+                          for name in 'cad'])
+        self.assertEqual(self.cache.stats()['bytes'], 300)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        metrics = httpd.Metrics()
+        metrics.inc('otus_connections_accepted_total', 2)
+        metrics.count_answer(httpd.make_answer(code=httpd.HTTPStatus.OK))
+        metrics.count_answer(httpd.make_answer(code=httpd.HTTPStatus.OK))
+        for seconds in (0.0002, 0.003, 10.0):
+            metrics.observe('otus_stage_seconds', seconds, 'stage="read"')
+        lines = metrics.render(gauges={'otus_workers': 3},
+                               totals={'otus_cache_hits_total': 5}
+                               ).decode().splitlines()
+        self.assertIn('# TYPE otus_connections_accepted_total counter',
+                      lines)
+        self.assertIn('otus_connections_accepted_total 2', lines)
+        self.assertIn('otus_responses_total{code="200"} 2', lines)
+        self.assertEqual(lines.count('# TYPE otus_stage_seconds histogram'),
+                         1)
+        self.assertIn('otus_stage_seconds_bucket{stage="read",le="0.0001"} 0',
+                      lines)
+        self.assertIn('otus_stage_seconds_bucket{stage="read",le="0.0005"} 1',
+                      lines)
+        self.assertIn('otus_stage_seconds_bucket{stage="read",le="0.005"} 2',
+                      lines)
+        self.assertIn('otus_stage_seconds_bucket{stage="read",le="+Inf"} 3',
+                      lines)
+        self.assertIn('otus_stage_seconds_sum{stage="read"} 10.003200',
+                      lines)
+        self.assertIn('otus_stage_seconds_count{stage="read"} 3', lines)
+        self.assertIn('# TYPE otus_cache_hits_total counter', lines)
+        self.assertIn('otus_cache_hits_total 5', lines)
+        self.assertIn('# HELP otus_workers Threads in the worker pool.', lines)
+        self.assertIn('# TYPE otus_workers gauge', lines)
+        self.assertEqual(lines[-1], 'otus_workers 3')
+        for line in lines:  # every sample is `name{labels} value`
+            self.assertRegex(line, r'^(# (HELP|TYPE) \w+ .+'
+                                   r'|\w+(\{[^}]*\})? [\d.]+)$')
+
+
+class TestPreload(RootTestCase):
+    options = {'preload': ['/*.css', '/sub/**/*.js', '/[1].txt', '/none']}
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.root.name, 'sub', 'deep'))
+        for name in ('a.css', 'b.css', 'sub/deep/c.js', '[1].txt',
+                     '1.txt', 'sub/d.txt'):
+            self.make_file(name, 2000)
+
+    def test_read_manifest(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write('# hot files\n/httptest/*.css\n\n'
+                    '  /static/**/*.js  # scripts\n')
+            f.flush()
+            self.assertEqual(httpd.read_manifest(f.name),
+                             ['/httptest/*.css', '/static/**/*.js'])
+
+    def test_preload_urls(self):
+        self.assertEqual(self.server.preload_urls(),
+                         ['/a.css', '/b.css', '/sub/deep/c.js', '/1.txt'])
+        # '/[1].txt' is a glob: it matches 1.txt, not [1].txt
+        self.server.proxy_routes = [('/sub/', None)]
+        self.assertNotIn('/sub/deep/c.js', self.server.preload_urls())
+
+    def test_warm_up_fills_the_caches_then_reports_ready(self):
+        read_fd, self.server.ready_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.server.start_warm_up()
+        self.assertEqual(os.read(read_fd, 1), b'1')  # blocks until ready
+        self.assertEqual(os.read(read_fd, 1), b'')  # and closed after it
+        self.assertTrue(self.server.warm.is_set())
+        self.assertEqual(set(self.server.paths.entries),
+                         {'/a.css', '/b.css', '/sub/deep/c.js', '/1.txt'})
+        keys = {os.path.basename(key) for key in self.server.cache.entries}
+        self.assertIn('1.txt', keys)
+        self.assertIn('a.css:gzip', keys)  # compressed on the fly
+
+
+class TestSlowLog(RootTestCase):
+    options = {'slow_log': 0.5}
+
+    def timings(self, **stages) -> httpd.Timings:
+        timings = httpd.Timings(stages)
+        timings.request = httpd.HTTPhelper.request('GET', '/a', 'HTTP/1.1')
+        timings.code = '200'
+        return timings
+
+    def test_logged_over_the_threshold(self):
+        with self.assertLogs(level='WARNING') as logs:
+            self.server.log_slow(('10.0.0.1', 5000),
+                                 self.timings(read=0.4, send=0.2))
+        self.assertEqual(logs.output, [
+            'WARNING:root:Slow request 600ms: GET /a 200 from 10.0.0.1: '
+            'read=400.0ms send=200.0ms'])
+
+    def test_fast_requests_are_not_logged(self):
+        with self.assertNoLogs(level='WARNING'):
+            self.server.log_slow(('10.0.0.1', 5000), self.timings(read=0.4))
+
+
+class TestProfileEndpoint(RootTestCase):
+    options = {'profile_path': '/profile'}
+
+    def setUp(self):
+        super().setUp()
+        self.server.profile_dir = self.root.name
+
+    def profile(self, addr, query: str = 'seconds=30') -> tuple:
+        request = httpd.HTTPhelper.request('GET', '/profile', 'HTTP/1.1',
+                                           query)
+        answer, _ = self.server.process_request(request, addr=addr)
+        return answer.data[9:12], answer.data.partition(b'\r\n\r\n')[2]
+
+    def test_remote_clients_are_refused(self):
+        for addr in (('10.0.0.1', 5000), ('2001:db8::1', 5000, 0, 0)):
+            self.assertEqual(self.profile(addr)[0], b'403')
+        self.assertIsNone(self.server.profiler)
+
+    def test_local_clients_start_and_stop(self):
+        for addr in (('127.0.0.1', 5000), ('::1', 5000, 0, 0), ''):
+            code, body = self.profile(addr)
+            self.assertEqual(code, b'202')
+            self.assertTrue(body.startswith(b'profiling into '))
+            profiler = self.server.profiler
+            self.assertEqual(profiler.seconds, 30.0)
+            self.assertEqual(self.profile(addr), (b'202',
+                                                  b'profile stopped\n'))
+            profiler.join(2)
+            path = body.decode().split()[-1]
+            self.assertEqual(os.path.dirname(path), self.root.name)
+            self.assertTrue(os.path.exists(path))
+            os.remove(path)  # the next one may share the stamp
+
+
+class FakeSocket:
+
+    def __init__(self, *chunks: bytes):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buf) -> int:
+        data = self.chunks.pop(0) if self.chunks else b''
+        buf[:len(data)] = data
+        return len(data)
+
+
+class TestRequestParser(unittest.TestCase):
+
+    def test_head_in_pieces(self):
+        parser = httpd.RequestParser(chunk_size=32)
+        sock = FakeSocket(b'GET /a%20b?x=1 HT', b'TP/1.1\r\nHost: x\r',
+                          b'\n\r', b'\n')
+        for _ in range(3):
+            parser.read_from(sock)
+            self.assertIsNone(parser.next_request())
+        parser.read_from(sock)
+        request = parser.next_request()
+        self.assertEqual((request.method, request.address, request.version,
+                          request.query_string),
+                         ('GET', '/a b', 'HTTP/1.1', 'x=1'))
+        self.assertEqual(request.headers, {'host': 'x'})
+        self.assertTrue(parser.empty)
+        self.assertEqual(parser.read_from(sock), 0)
+
+    def test_pipelined_requests(self):
+        parser = httpd.RequestParser()
+        parser.feed(b'GET /1 HTTP/1.1\r\n\r\n'
+                    b'HEAD /2 HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello'
+                    b'GET /3 HTTP/1.1\r\n\r\nGET /4')
+        self.assertEqual(parser.next_request().address, '/1')
+        self.assertEqual(parser.next_request().method, 'HEAD')
+        self.assertEqual(parser.next_request().address, '/3')
+        self.assertIsNone(parser.next_request())
+        self.assertFalse(parser.empty)
+        parser.feed(b' HTTP/1.1\r\n\r\n')
+        self.assertEqual(parser.next_request().address, '/4')
+        self.assertTrue(parser.empty)
+
+    def test_body_split_across_reads(self):
+        parser = httpd.RequestParser()
+        parser.feed(b'GET /1 HTTP/1.1\r\nContent-Length: 10\r\n\r\n12345')
+        self.assertEqual(parser.next_request().address, '/1')
+        self.assertIsNone(parser.next_request())
+        parser.feed(b'67890GET /2 HTTP/1.1\r\n\r\n')
+        self.assertEqual(parser.next_request().address, '/2')
+
+    def test_too_large(self):
+        parser = httpd.RequestParser()
+        parser.feed(b'GET / HTTP/1.1\r\nX: ' + b'a' * 9000)
+        self.assertRaises(httpd.HeadersTooLarge, parser.next_request)
+        parser = httpd.RequestParser()
+        parser.feed(b'GET / HTTP/1.1\r\n' + b'X: a\r\n' * 101 + b'\r\n')
+        self.assertRaises(httpd.HeadersTooLarge, parser.next_request)
+
+    def test_malformed(self):
+        for head in (b'GET /\r\n\r\n', b'GET / HTTP/1.1 x\r\n\r\n',
+                     b'GET / HTTP/1.1\r\nno colon\r\n\r\n',
+                     b'GET / HTTP/1.1\r\nContent-Length: -1\r\n\r\n',
+                     b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked'
+                     b'\r\n\r\n', b'GET /\xff HTTP/1.1\r\n\r\n'):
+            with self.subTest(head=head):
+                parser = httpd.RequestParser()
+                parser.feed(head)
+                with self.assertRaises(ValueError) as caught:
+                    parser.next_request()
+                self.assertNotIsInstance(caught.exception,
+                                         (httpd.MethodNotAllowed,
+                                          httpd.HeadersTooLarge))
+
+    def test_method_not_allowed(self):
+        parser = httpd.RequestParser()
+        parser.feed(b'POST / HTTP/1.1\r\nContent-Length: 2\r\n\r\nhi')
+        self.assertRaises(httpd.MethodNotAllowed, parser.next_request)
+
+
+class TestEncodings(RootTestCase):
+
+    def select(self, file, stat, accept: str, **headers) -> str or None:
+        headers['accept-encoding'] = accept
+        request = httpd.HTTPhelper.request('GET', '/', 'HTTP/1.1',
+                                           None, headers)
+        return self.server.select_encoding(file, stat, request)[0]
+
+    def test_accepted_encodings(self):
+        self.assertEqual(httpd.accepted_encodings(''), [])
+        self.assertEqual(httpd.accepted_encodings('gzip'), ['gzip'])
+        self.assertEqual(httpd.accepted_encodings('gzip, deflate, br'),
+                         ['br', 'gzip'])
+        self.assertEqual(httpd.accepted_encodings('br;q=0.5, gzip;q=0.8'),
+                         ['gzip', 'br'])
+        self.assertEqual(httpd.accepted_encodings('gzip;q=0, br'), ['br'])
+        self.assertEqual(httpd.accepted_encodings('*'), ['br', 'gzip'])
+        self.assertEqual(httpd.accepted_encodings('*;q=0.1, br;q=0'),
+                         ['gzip'])
+        self.assertEqual(httpd.accepted_encodings('GZIP;Q=0.5'), ['gzip'])
+        self.assertEqual(httpd.accepted_encodings('gzip;q=bad'), [])
+        self.assertEqual(httpd.accepted_encodings('identity'), [])
+
+    def test_select_encoding(self):
+        file, stat = self.make_file('page.html', 4096)
+        self.assertEqual(self.select(file, stat, 'gzip;q=0.9, br;q=0.1'),
+                         'gzip')
+        self.assertIsNone(self.select(file, stat, 'identity'))
+        self.assertIsNone(self.select(file, stat, 'gzip', range='bytes=0-9'))
+        tiny = self.make_file('tiny.html', 10)
+        self.assertIsNone(self.select(*tiny, 'gzip'))
+
+    def test_precompressed_sibling(self):
+        file, stat = self.make_file('big.js', 2 << 20)
+        self.assertIsNone(self.select(file, stat, 'gzip'))
+        sibling, _ = self.make_file('big.js.gz', 100)
+        self.assertEqual(self.server.select_encoding(
+            file, stat, httpd.HTTPhelper.request(
+                'GET', '/', 'HTTP/1.1', None, {'accept-encoding': 'gzip'})),
+            ('gzip', sibling, os.stat(sibling)))
+
+    def test_no_on_the_fly_compression_beyond_the_cache(self):
+        """files the cache cannot hold are not compressed per request"""
+        limit = self.server.cache.max_file_size
+        self.assertEqual(self.select(*self.make_file('fits.css', limit),
+                                     'gzip'), 'gzip')
+        self.assertIsNone(self.select(*self.make_file('big.css', limit + 1),
+                                      'gzip'))
+        self.server.cache = None  # -c 0
+        self.assertIsNone(self.select(*self.make_file('small.css', 4096),
+                                      'gzip'))
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Runs httpd.py with `args` in every serving mode of `modes`.
+    """
+    args = []
+    modes = httpd.MyServer.modes
+
+    def serve(self, mode: str, args: list or None = None) -> int:
+        port = free_port()
+        server = start_server(port, ['-m', mode] + (args or self.args))
+        self.addCleanup(server.wait)
+        self.addCleanup(server.kill)
+        return port
+
+    def connect(self, port: int) -> socket.socket:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+        self.addCleanup(sock.close)
+        return sock
+
+
+class TestAutoindex(ServerTestCase):
+    args = ['--autoindex', '-k', '5']
+
+    def test_http10_keep_alive_listing_closes(self):
+        """an HTTP/1.0 listing is delimited by the close"""
+        for mode in self.modes:
+            with self.subTest(mode=mode):
+                sock = self.connect(self.serve(mode))
+                sock.sendall(b'GET /httptest/dir1/ HTTP/1.0\r\n'
+                             b'Connection: keep-alive\r\n\r\n')
+                data = receive_all(sock)
+                head, _, body = data.partition(b'\r\n\r\n')
+                self.assertTrue(head.startswith(b'HTTP/1.1 200'))
+                self.assertIn(b'Connection: close', head)
+                self.assertTrue(body.rstrip().endswith(b'</html>'))
+
+
+class TestErrors(ServerTestCase):
+
+    def answer_to(self, port: int, head: bytes) -> bytes:
+        sock = self.connect(port)
+        sock.sendall(head)
+        return receive_all(sock).partition(b'\r\n')[0]
+
+    def test_status_codes(self):
+        """400 for malformed heads, 405 for other methods, 431"""
+        for mode in self.modes:
+            with self.subTest(mode=mode):
+                port = self.serve(mode)
+                self.assertEqual(
+                    self.answer_to(port, b'GET /\r\n\r\n'),
+                    b'HTTP/1.1 400 Bad Request')
+                self.assertEqual(
+                    self.answer_to(port, b'GET / HTTP/1.1\r\nbad\r\n\r\n'),
+                    b'HTTP/1.1 400 Bad Request')
+                self.assertEqual(
+                    self.answer_to(port, b'POST / HTTP/1.1\r\n\r\n'),
+                    b'HTTP/1.1 405 Method Not Allowed')
+                self.assertEqual(
+                    self.answer_to(port, b'GET / HTTP/1.1\r\nX: '
+                                   + b'a' * 9000 + b'\r\n\r\n'),
+                    b'HTTP/1.1 431 Request Header Fields Too Large')
+
+
+@unittest.skipIf(httpd.h2 is None, 'needs the h2 package')
+class TestMetricsEndpoint(ServerTestCase):
+    args = ['--metrics', '/metrics']
+
+    def test_served(self):
+        for mode in self.modes:
+            with self.subTest(mode=mode):
+                port = self.serve(mode)
+                conn = http.client.HTTPConnection('127.0.0.1', port,
+                                                  timeout=2)
+                self.addCleanup(conn.close)
+                conn.request('GET', '/httptest/wikipedia_russia.html')
+                conn.getresponse().read()
+                conn.request('GET', '/metrics')
+                response = conn.getresponse()
+                body = response.read().decode()
+                self.assertEqual(response.status, 200)
+                self.assertTrue(response.getheader('Content-Type')
+                                .startswith('text/plain'))
+                self.assertIn('otus_responses_total{code="200"} 1', body)
+                self.assertIn('# TYPE otus_cache_entries gauge', body)
+
+
+class TestWarmUp(ServerTestCase):
+
+    def test_warm_gauge(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as manifest:
+            manifest.write('/httptest/*.html\n/httptest/dir2/*\n')
+            manifest.flush()
+            for mode in self.modes:
+                with self.subTest(mode=mode):
+                    port = self.serve(mode, ['--preload', manifest.name,
+                                             '--metrics', '/metrics'])
+                    deadline = time.monotonic() + 5
+                    while time.monotonic() < deadline:
+                        conn = http.client.HTTPConnection('127.0.0.1', port,
+                                                          timeout=2)
+                        conn.request('GET', '/metrics')
+                        metrics = conn.getresponse().read()
+                        conn.close()
+                        if re.search(rb'(?m)^otus_warm 1$', metrics):
+                            break
+                        time.sleep(0.05)
+                    self.assertRegex(metrics, rb'(?m)^otus_warm 1$')
+                    self.assertRegex(metrics,
+                                     rb'(?m)^otus_cache_entries [1-9]')
+
+
+class TestSlowLogFile(ServerTestCase):
+
+    def test_stages_are_logged(self):
+        for mode in self.modes:
+            with self.subTest(mode=mode), \
+                    tempfile.NamedTemporaryFile(suffix='.log') as log:
+                port = self.serve(mode, ['--slow-log', '0', '-l', log.name,
+                                         '-v', '30'])
+                conn = http.client.HTTPConnection('127.0.0.1', port,
+                                                  timeout=2)
+                self.addCleanup(conn.close)
+                conn.request('GET', '/httptest/dir2/page.html')
+                conn.getresponse().read()
+                deadline = time.monotonic() + 2
+                while True:  # logged once the answer is sent
+                    log.seek(0)
+                    text = log.read().decode()
+                    if 'Slow request' in text or time.monotonic() > deadline:
+                        break
+                    time.sleep(0.05)
+                self.assertRegex(text, r'Slow request \d+ms: GET '
+                                       r'/httptest/dir2/page.html 200 from '
+                                       r'127.0.0.1: .*send=[\d.]+ms')
+
+
+class TestHTTP2(ServerTestCase):
+    args = ['--http2']
+
+    def test_prior_knowledge(self):
+        """two multiplexed streams over one h2c connection"""
+        for mode in self.modes:
+            with self.subTest(mode=mode):
+                sock = self.connect(self.serve(mode))
+                conn = httpd.h2.connection.H2Connection()
+                conn.initiate_connection()
+                for stream_id, path in ((1, '/httptest/dir2/'),
+                                        (3, '/httptest/splash.css')):
+                    conn.send_headers(stream_id, [
+                        (':method', 'GET'), (':path', path),
+                        (':scheme', 'http'), (':authority', 'localhost')],
+                        end_stream=True)
+                sock.sendall(conn.data_to_send())
+                status, bodies, ended = {}, {1: b'', 3: b''}, set()
+                while len(ended) < 2:
+                    data = sock.recv(65536)
+                    self.assertTrue(data)
+                    for event in conn.receive_data(data):
+                        if isinstance(event, httpd.h2.events.ResponseReceived):
+                            status[event.stream_id] = dict(event.headers)[
+                                b':status']
+                        elif isinstance(event, httpd.h2.events.DataReceived):
+                            bodies[event.stream_id] += event.data
+                            conn.acknowledge_received_data(
+                                event.flow_controlled_length, event.stream_id)
+                        elif isinstance(event, httpd.h2.events.StreamEnded):
+                            ended.add(event.stream_id)
+                    sock.sendall(conn.data_to_send())
+                self.assertEqual(status, {1: b'200', 3: b'200'})
+                self.assertEqual(bodies[1],
+                                 b'<html>Directory index file</html>\n')
+                self.assertEqual(len(bodies[3]), 98620)
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'needs openssl')
+class TestTLS(ServerTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.certs = tempfile.TemporaryDirectory()
+        cls.cert = os.path.join(cls.certs.name, 'cert.pem')
+        key = os.path.join(cls.certs.name, 'key.pem')
+        httpd.make_self_signed(cls.cert, key)
+        cls.args = ['--tls-cert', cls.cert, '--tls-key', key,
+                    '--metrics', '/metrics']
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.certs.cleanup()
+
+    def get(self, port: int, path: str, session=None) -> tuple:
+        """
+        The answer to one request on a new TLS connection, and the
+        connection, closed by the server.
+        """
+        sock = self.context.wrap_socket(self.connect(port),
+                                        server_hostname='127.0.0.1',
+                                        session=session)
+        self.addCleanup(sock.close)
+        sock.sendall(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n'
+                     f'Connection: close\r\n\r\n'.encode())
+        return receive_all(sock), sock
+
+    def test_serving_and_resumption(self):
+        for mode in self.modes:
+            with self.subTest(mode=mode):
+                self.context = ssl.create_default_context(cafile=self.cert)
+                self.context.set_alpn_protocols(['http/1.1'])
+                port = self.serve(mode)
+                answer, first = self.get(port, '/httptest/dir2/page.html')
+                self.assertTrue(answer.startswith(b'HTTP/1.1 200 OK\r\n'))
+                self.assertTrue(answer.endswith(
+                    httpd.Path('httptest/dir2/page.html').read_bytes()))
+                self.assertEqual(first.selected_alpn_protocol(), 'http/1.1')
+                self.assertFalse(first.session_reused)
+                answer, second = self.get(port, '/httptest/dir2/page.html',
+                                          first.session)
+                self.assertTrue(second.session_reused)
+                self.assertTrue(answer.startswith(b'HTTP/1.1 200 OK\r\n'))
+                metrics, _ = self.get(port, '/metrics')
+                self.assertIn(b'otus_tls_handshakes_total{resumed="true"} 1',
+                              metrics)
+
+    def test_plain_http_is_refused(self):
+        port = self.serve('threads')
+        sock = self.connect(port)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        try:
+            answer = receive_all(sock)
+        except ConnectionResetError:
+            answer = b''
+        self.assertNotIn(b'HTTP/1.1', answer)
+
+
+class TestKeepAlive(ServerTestCase):
+    args = ['-w', '1', '--min-workers', '1', '-k', '5']
+
+    def test_idle_connections_free_the_worker(self):
+        """idle keep-alive connections do not hold the only worker"""
+        port = self.serve('threads')
+        request = b'GET /httptest/dir2/ HTTP/1.1\r\nHost: x\r\n\r\n'
+        idle = [self.connect(port) for _ in range(3)]
+        for sock in idle:
+            sock.sendall(request)
+            self.assertTrue(sock.recv(65536).startswith(b'HTTP/1.1 200'))
+        started = time.monotonic()
+        other = self.connect(port)
+        other.sendall(request)
+        self.assertTrue(other.recv(65536).startswith(b'HTTP/1.1 200'))
+        self.assertLess(time.monotonic() - started, 1.0)
+        for sock in idle:  # and they are still served afterwards
+            sock.sendall(request)
+            self.assertTrue(sock.recv(65536).startswith(b'HTTP/1.1 200'))
+
+    def test_idle_connection_times_out(self):
+        port = self.serve('threads', self.args[:-1] + ['0.5'])
+        sock = self.connect(port)
+        sock.sendall(b'GET /httptest/dir2/ HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = receive_all(sock)
+        self.assertTrue(data.startswith(b'HTTP/1.1 200'))
+        self.assertTrue(data.endswith(b'Directory index file</html>\n'))
+
+    def test_max_requests_across_idle_periods(self):
+        port = self.serve('threads', self.args + ['--max-requests', '3'])
+        sock = self.connect(port)
+        for i in range(3):
+            time.sleep(0.1)
+            sock.sendall(b'GET /httptest/dir2/ HTTP/1.1\r\n'
+                         b'Host: x\r\n\r\n')
+            head = sock.recv(65536).partition(b'\r\n\r\n')[0]
+            self.assertIn(b'Connection: close' if i == 2
+                          else b'Connection: keep-alive', head)
+        self.assertEqual(receive_all(sock), b'')
+
+
+class TestProxy(ServerTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend_port = free_port()
+        cls.backend = start_backend(cls.backend_port)
+        cls.dead = f'http://127.0.0.1:{free_port()}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.backend.kill()
+        cls.backend.wait()
+
+    def setUp(self):
+        backend = f'http://127.0.0.1:{self.backend_port}'
+        self.port = self.serve('threads', [
+            '--proxy', f'/api/={backend}',
+            '--proxy', f'/two/={self.dead},{backend}',
+            '--proxy', f'/dead/={self.dead}',
+            '--proxy-read-timeout', '0.5'])
+
+    def get(self, path: str, method: str = 'GET',
+            conn: http.client.HTTPConnection or None = None) -> tuple:
+        if conn is None:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                              timeout=5)
+            self.addCleanup(conn.close)
+        conn.request(method, path)
+        answer = conn.getresponse()
+        return answer, answer.read()
+
+    def test_content_length_body(self):
+        answer, body = self.get('/api/items?x=1')
+        self.assertEqual(answer.status, 200)
+        self.assertEqual(answer.getheader('Content-Length'), str(len(body)))
+        body = json.loads(body)
+        self.assertEqual(body['path'], '/api/items?x=1')
+        self.assertEqual(body['forwarded_for'], '127.0.0.1')
+
+    def test_chunked_body_is_rechunked(self):
+        answer, body = self.get('/api/chunked')
+        self.assertEqual(answer.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(json.loads(body)['path'], '/api/chunked')
+
+    def test_http10_client_body_ends_with_close(self):
+        sock = self.connect(self.port)
+        sock.sendall(b'GET /api/chunked HTTP/1.0\r\n'
+                     b'Connection: keep-alive\r\n\r\n')
+        head, _, body = receive_all(sock).partition(b'\r\n\r\n')
+        self.assertNotIn(b'Transfer-Encoding', head)
+        self.assertIn(b'Connection: close', head)
+        self.assertEqual(json.loads(body)['path'], '/api/chunked')
+
+    def test_head(self):
+        answer, body = self.get('/api/items', 'HEAD')
+        self.assertEqual(answer.status, 200)
+        self.assertEqual(body, b'')
+        self.assertGreater(int(answer.getheader('Content-Length')), 0)
+
+    def test_pool_survives_backend_restart(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        self.addCleanup(conn.close)
+        self.assertEqual(self.get('/api/a', conn=conn)[0].status, 200)
+        self.backend.kill()  # closes the pooled upstream connection
+        self.backend.wait()
+        type(self).backend = start_backend(self.backend_port)
+        answer, body = self.get('/api/b', conn=conn)
+        self.assertEqual(answer.status, 200)
+        self.assertEqual(json.loads(body)['path'], '/api/b')
+
+    def test_failover(self):
+        self.assertEqual(self.get('/two/x')[0].status, 200)
+        self.assertEqual(self.get('/dead/x')[0].status, 502)
+        self.assertEqual(self.get('/api/slow?seconds=2')[0].status, 504)
+
+    def test_dot_segments_stay_under_the_route(self):
+        answer, body = self.get('/api/a/./b/../c')
+        self.assertEqual(json.loads(body)['path'], '/api/a/c')
+        for path in ('/api/../httptest/dir2/', '/api/%2e%2e/httptest/dir2/'):
+            answer, body = self.get(path)
+            self.assertEqual(body, b'<html>Directory index file</html>\n')
+
+    def test_events_mode_is_refused(self):
+        result = subprocess.run(
+            [sys.executable, httpd.__file__, '-m', 'events', '-p',
+             str(free_port()), '--proxy', f'/api/={self.dead}'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=10)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn(b'Proxy routes need the threads mode', result.stderr)
+
+
+class TestReload(ServerTestCase):
+    request = b'GET /httptest/dir2/ HTTP/1.1\r\nHost: x\r\n\r\n'
+
+    def serve(self, mode: str, args: list or None = None) -> int:
+        port = free_port()
+        self.server = start_server(port, ['-m', mode] + (args or self.args))
+        self.addCleanup(self.kill_successor, port)
+        self.addCleanup(self.server.wait)
+        self.addCleanup(self.server.kill)
+        return port
+
+    def kill_successor(self, port: int):
+        pid = self.successor(port)
+        if pid:
+            os.kill(pid, signal.SIGKILL)
+
+    def successor(self, port: int) -> int or None:
+        """
+        Pid of another httpd.py serving the port, started by reexec().
+        """
+        for pid in filter(str.isdigit, os.listdir('/proc')):
+            try:
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    args = f.read().split(b'\0')
+            except OSError:
+                continue
+            if (int(pid) != self.server.pid and b'-p' in args
+                    and str(port).encode() in args
+                    and any(arg.endswith(b'httpd.py') for arg in args)):
+                return int(pid)
+
+    def reload(self, port: int):
+        self.server.send_signal(signal.SIGUSR2)
+        self.assertEqual(self.server.wait(10), 0)  # drained after takeover
+        self.assertIsNotNone(self.successor(port))
+        sock = self.connect(port)
+        sock.sendall(self.request)
+        self.assertTrue(sock.recv(65536).startswith(b'HTTP/1.1 200'))
+
+    def test_drain_finishes_requests_in_flight(self):
+        for mode in self.modes:
+            with self.subTest(mode=mode):
+                port = self.serve(mode)
+                idle = self.connect(port)
+                idle.sendall(self.request)
+                self.assertTrue(idle.recv(65536).startswith(b'HTTP/1.1 200'))
+                busy = self.connect(port)
+                busy.sendall(self.request[:20])
+                time.sleep(0.2)
+                self.server.send_signal(signal.SIGTERM)
+                time.sleep(0.2)
+                busy.sendall(self.request[20:])
+                head = receive_all(busy).partition(b'\r\n\r\n')[0]
+                self.assertTrue(head.startswith(b'HTTP/1.1 200'))
+                self.assertIn(b'Connection: close', head)
+                self.assertEqual(receive_all(idle), b'')
+                self.assertEqual(self.server.wait(5), 0)
+                self.assertRaises(OSError, socket.create_connection,
+                                  ('127.0.0.1', port), 1)
+
+    def test_reload(self):
+        for mode in self.modes:
+            with self.subTest(mode=mode):
+                self.reload(self.serve(mode))
+
+    @unittest.skipIf(resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 2200,
+                     'needs 2200 open files')
+    def test_reload_past_fd_setsize(self):
+        """the ready pipe may get a descriptor past FD_SETSIZE"""
+        port = self.serve('events')
+        clients = [self.connect(port) for _ in range(1100)]
+        clients[-1].sendall(self.request)  # all accepted by now
+        self.assertTrue(clients[-1].recv(65536).startswith(b'HTTP/1.1 200'))
+        self.reload(port)
+
+
+class TestShedding(ServerTestCase):
+    args = ['-w', '1', '--min-workers', '1', '-q', '1', '-k', '5']
+
+    def test_full_queue_answer_is_read(self):
+        """a shed client reads the whole 503 instead of a reset"""
+        port = self.serve('threads')
+        for _ in range(20):  # until start_server's probe is served
+            first = self.connect(port)
+            first.sendall(b'GET /httptest/dir2/ HTTP/1.1\r\nHost: x\r\n'
+                          b'Connection: close\r\n\r\n')
+            if receive_all(first).startswith(b'HTTP/1.1 200'):
+                break
+            time.sleep(0.05)
+        busy = self.connect(port)  # keeps the only worker reading
+        busy.sendall(b'GET /httptest/dir2/ HTTP/1.1\r\n')
+        time.sleep(0.2)
+        self.connect(port)  # waits in the queue
+        shed = self.connect(port)
+        shed.sendall(b'GET /httptest/dir2/ HTTP/1.1\r\nHost: x\r\n\r\n'
+                     * 100)
+        head, _, _ = receive_all(shed).partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.1 503'))
+        self.assertIn(b'Retry-After: 1', head)
+
+
+class TestConnectionLimits(ServerTestCase):
+    args = ['--max-conns', '1']
+
+    def test_over_limit_answer_is_read(self):
+        """a client over its connection limit reads the whole 429"""
+        for mode in self.modes:
+            with self.subTest(mode=mode):
+                port = self.serve(mode)
+                time.sleep(0.2)  # until start_server's probe is counted out
+                first = self.connect(port)
+                first.sendall(b'GET /httptest/dir2/ HTTP/1.1\r\n'
+                              b'Host: x\r\n\r\n')
+                self.assertTrue(first.recv(65536).startswith(b'HTTP/1.1 200'))
+                refused = self.connect(port)
+                refused.sendall(b'GET /httptest/dir2/ HTTP/1.1\r\n'
+                                b'Host: x\r\n\r\n' * 100)
+                head, _, _ = receive_all(refused).partition(b'\r\n\r\n')
+                self.assertTrue(head.startswith(b'HTTP/1.1 429'))
+                self.assertIn(b'Retry-After: 1', head)
+
+
+if __name__ == '__main__':
+    unittest.main()